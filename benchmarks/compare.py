@@ -0,0 +1,69 @@
+"""
+Compare two benchmark reports written by benchmarks/run.py, scenario by
+scenario. Exit with status 1 when a scenario p50 or p99 latency grew, or its
+throughput dropped, by more than the threshold.
+
+Usage:
+
+    python benchmarks/compare.py BASELINE.json CURRENT.json [--threshold T]
+"""
+import argparse
+import json
+import sys
+
+
+def _change(baseline: float, current: float) -> float:
+    return (current - baseline) / baseline if baseline else 0.0
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """
+    Rows of (scenario, metric, baseline, current, change, regressed)
+    """
+    previous = {scenario['name']: scenario
+                for scenario in baseline['scenarios']}
+    rows = []
+
+    for scenario in current['scenarios']:
+        before = previous.get(scenario['name'])
+
+        if before is None:
+            continue
+
+        for metric in ('p50', 'p99'):
+            change = _change(before['latency_ms'][metric],
+                             scenario['latency_ms'][metric])
+            rows.append((scenario['name'], metric,
+                         before['latency_ms'][metric],
+                         scenario['latency_ms'][metric],
+                         change, change > threshold))
+
+        change = _change(before['throughput_rps'],
+                         scenario['throughput_rps'])
+        rows.append((scenario['name'], 'rps', before['throughput_rps'],
+                     scenario['throughput_rps'], change, -change > threshold))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline, open(args.current) as current:
+        rows = compare(json.load(baseline), json.load(current),
+                       args.threshold)
+
+    for name, metric, before, after, change, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{name:28} {metric:4} {before:10.2f} -> {after:10.2f} '
+              f'{change:+7.1%}{flag}')
+
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+"""
+Benchmark every endpoint of the API through the Flask test client, against
+a synthetic repository and a pull_requests table seeded at scale.
+
+Each scenario is run sequentially to measure latency percentiles, then from
+concurrent threads to measure throughput. The result is written as JSON so
+runs can be compared with benchmarks/compare.py.
+
+Usage: python benchmarks/run.py [--workdir DIR] [--scale 0.05] [-o out.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from typing import Callable, List, Optional, Tuple
+
+import synthetic_repo
+
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+
+class Scenario:
+    """
+    One request, the url may be a callable returning a new url per request
+    """
+
+    def __init__(self,
+                 name: str,
+                 url,
+                 method: str = 'get',
+                 headers: Optional[dict] = None,
+                 json_body: Optional[Callable[[], dict]] = None,
+                 expected: tuple = (200,),
+                 requests: Optional[int] = None):
+        self.name = name
+        self.url = url
+        self.method = method
+        self.headers = headers or {}
+        self.json_body = json_body
+        self.expected = expected
+        self.requests = requests
+
+    def send(self, client) -> bool:
+        url = self.url() if callable(self.url) else self.url
+        kwargs = {'headers': self.headers}
+
+        if self.json_body is not None:
+            kwargs['json'] = self.json_body()
+
+        response = getattr(client, self.method)(url, **kwargs)
+        # consume streamed bodies, they are part of the request cost
+        response.get_data()
+        response.close()
+        return response.status_code in self.expected
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    index = min(int(round(percent / 100 * (len(values) - 1))),
+                len(values) - 1)
+    return values[index]
+
+
+def _peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(app, scenario: Scenario, requests: int, concurrency: int) -> dict:
+    client = app.test_client()
+    count = scenario.requests or requests
+    errors = 0
+
+    # warm up, then measure the python heap of one request
+    scenario.send(client)
+    tracemalloc.start()
+    scenario.send(client)
+    _, peak_heap = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = []
+
+    for _ in range(count):
+        start = time.perf_counter()
+        errors += not scenario.send(client)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    lock = threading.Lock()
+    remaining = [count]
+
+    def worker():
+        thread_client = app.test_client()
+        failed = 0
+
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+
+            failed += not scenario.send(thread_client)
+
+        with lock:
+            nonlocal errors
+            errors += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    return {'name': scenario.name,
+            'requests': count,
+            'errors': errors,
+            'latency_ms': {'p50': _percentile(latencies, 50),
+                           'p90': _percentile(latencies, 90),
+                           'p99': _percentile(latencies, 99),
+                           'max': max(latencies),
+                           'mean': statistics.fmean(latencies)},
+            'throughput_rps': count / elapsed,
+            'concurrency': concurrency,
+            'peak_heap_kb': peak_heap // 1024,
+            'peak_rss_kb': _peak_rss_kb()}
+
+
+def seed_pull_requests(db, models, count: int, branches: List[str],
+                       seed: int) -> float:
+    """
+    Insert count pull requests between the branches, return the seconds it
+    took
+    """
+    rng = random.Random(seed)
+    statuses = (models.PullRequest.OPEN, models.PullRequest.CLOSED,
+                models.PullRequest.MERGED)
+    created_at = datetime(2020, 1, 1)
+    start = time.perf_counter()
+
+    for offset in range(0, count, 10000):
+        rows = []
+
+        for number in range(offset, min(offset + 10000, count)):
+            created_at += timedelta(seconds=rng.randint(1, 600))
+            rows.append({'title': f'Pull request {number}',
+                         'description': 'Synthetic pull request',
+                         'status': rng.choice(statuses),
+                         'author': f'dev{number % 50}@example.com',
+                         'source_branch': rng.choice(branches),
+                         'destiny_branch': 'master',
+                         'created_at': created_at})
+
+        db.session.execute(insert(models.PullRequest), rows)
+        db.session.commit()
+
+    return time.perf_counter() - start
+
+
+def clone_repo(workdir: str) -> str:
+    """
+    Bare clone of the synthetic repository for one run, the merge and close
+    scenarios move its branches and the cached repository must keep the
+    history it was generated with. Objects are hard linked, not copied
+    """
+    path = os.path.join(workdir, 'run.git')
+    shutil.rmtree(path, ignore_errors=True)
+    subprocess.run(['git', 'clone', '-q', '--bare',
+                    os.path.join(workdir, 'repo'), path], check=True)
+    # pull requests are authored by the configured user
+    subprocess.run(['git', 'config', 'user.email', 'bench@example.com'],
+                   cwd=path, check=True)
+    return path
+
+
+def create_app(workdir: str) -> Tuple[object, dict]:
+    """
+    App initialized like app.py runs it, on a clone of the repository and
+    the database of workdir, and the seconds it took to build and to start
+    it
+    """
+    os.environ['REPO_PATH'] = clone_repo(workdir)
+    os.environ['REPOS_ROOT'] = workdir
+    database = os.path.join(workdir, 'bench.db')
+    os.environ['DATABASE_URI'] = f'sqlite:///{database}'
+    sys.path.insert(0, SRC)
+
+    import app as app_module
+
+    start = time.perf_counter()
+    app = app_module.create_app()
+    created = time.perf_counter()
+    app_module.start(app)
+
+    return app, {'create_seconds': created - start,
+                 'start_seconds': time.perf_counter() - created}
+
+
+def scenarios(app,
+              branches: List[str],
+              requests: int) -> List[Scenario]:
+    from db import db
+    from models import models
+    from resources.pull_request import _encode_cursor
+
+    rng = random.Random(0)
+    client = app.test_client()
+    api = '/api/v1'
+
+    first_page = client.get(f'{api}/branches/master/commits?limit=100')
+    link = first_page.headers['Link']
+    next_page = link[1:link.index('>')]
+    shas = [commit['commit'] for commit in first_page.get_json()]
+    branch_etag = client.get(f'{api}/branches/master').headers['ETag']
+    blobs = [entry['path'] for entry in client.get(
+        f'{api}/branches/master/tree/src/module00').get_json()['entries']
+        if entry['type'] == 'blob']
+
+    with app.app_context():
+        rows = models.PullRequest.query.order_by(db.func.random()).limit(
+            100).all()
+        cursors = [_encode_cursor(row) for row in rows]
+        pull_request_ids = [row.id for row in rows]
+        open_ids = [pull_request_id for pull_request_id, in db.session.query(
+            models.PullRequest.id).filter_by(
+                status=models.PullRequest.OPEN).limit(4 * requests + 8)]
+
+    # every close and merge needs its own open pull request, measure runs a
+    # scenario twice plus two warm up requests
+    per_scenario = max(min(requests, (len(open_ids) // 2 - 2) // 2), 1)
+    to_close = iter(open_ids[:len(open_ids) // 2])
+    to_merge = iter(open_ids[len(open_ids) // 2:])
+    jobs = []
+
+    def new_pull_request() -> dict:
+        return {'title': 'Benchmark pull request',
+                'description': 'Created by the benchmark',
+                'source_branch': rng.choice(branches),
+                'destiny_branch': 'master'}
+
+    def merge_url() -> str:
+        return f'{api}/pull-requests/{next(to_merge)}/merge'
+
+    def job_url() -> str:
+        if not jobs:
+            response = client.post(merge_url())
+            jobs.append(response.get_json()['id'])
+
+        return f'{api}/merge-jobs/{rng.choice(jobs)}'
+
+    return [
+        Scenario('branches.page', f'{api}/branches?limit=100'),
+        Scenario('branches.prefix',
+                 f'{api}/branches?prefix=feature-0&limit=100'),
+        Scenario('branches.stream', f'{api}/branches',
+                 headers={'Accept': 'application/x-ndjson'}, requests=20),
+        Scenario('branch.get',
+                 lambda: f'{api}/branches/{rng.choice(branches)}'),
+        Scenario('branch.not_modified', f'{api}/branches/master',
+                 headers={'If-None-Match': branch_etag}, expected=(304,)),
+        Scenario('branch.stats',
+                 lambda: f'{api}/branches/{rng.choice(branches)}/stats'),
+        Scenario('repos.branches.page',
+                 f'{api}/repos/repo/branches?limit=100'),
+        Scenario('commits.first_page',
+                 f'{api}/branches/master/commits?limit=100'),
+        Scenario('commits.next_page', next_page),
+        Scenario('commits.random_branch',
+                 lambda: f'{api}/branches/{rng.choice(branches)}/commits'),
+        Scenario('commits.stream_10k',
+                 f'{api}/branches/master/commits?stream=true&limit=10000',
+                 requests=10),
+        Scenario('commit.get',
+                 lambda: f'{api}/branches/master/commits/{rng.choice(shas)}'),
+        Scenario('tree.root', f'{api}/branches/master/tree'),
+        Scenario('tree.directory',
+                 f'{api}/branches/master/tree/src/module00'),
+        Scenario('blob.get',
+                 lambda: f'{api}/branches/master/blob/{rng.choice(blobs)}'),
+        Scenario('blob.range',
+                 lambda: f'{api}/branches/master/blob/{rng.choice(blobs)}',
+                 headers={'Range': 'bytes=10-99'}, expected=(206,)),
+        Scenario('commits.search', f'{api}/commits/search?q=feature+chang*'),
+        Scenario('pull_requests.page', f'{api}/pull-requests?limit=100'),
+        Scenario('pull_requests.filtered',
+                 f'{api}/pull-requests?status=open&limit=100'),
+        Scenario('pull_requests.projected',
+                 f'{api}/pull-requests?fields=id,title,status&limit=100'),
+        Scenario('pull_requests.deep_page',
+                 lambda: f'{api}/pull-requests?limit=100'
+                         f'&cursor={rng.choice(cursors)}'),
+        Scenario('pull_requests.stream',
+                 f'{api}/pull-requests?fields=id,status&stream=true',
+                 requests=5),
+        Scenario('pull_request.commits',
+                 lambda: f'{api}/pull-requests/'
+                         f'{rng.choice(pull_request_ids)}/commits'),
+        Scenario('pull_request.diffstat',
+                 lambda: f'{api}/pull-requests/'
+                         f'{rng.choice(pull_request_ids)}/diff'),
+        Scenario('pull_request.diff',
+                 lambda: f'{api}/pull-requests/'
+                         f'{rng.choice(pull_request_ids)}/diff?format=patch'),
+        Scenario('pull_request.create', f'{api}/pull-requests',
+                 method='post', json_body=new_pull_request,
+                 expected=(201,)),
+        Scenario('pull_requests.batch', f'{api}/pull-requests/batch',
+                 method='post', requests=20,
+                 json_body=lambda: {'operations': [
+                     dict(new_pull_request(), action='create')
+                     for _ in range(100)]}),
+        Scenario('pull_request.close',
+                 lambda: f'{api}/pull-requests/{next(to_close)}/close',
+                 method='post', requests=per_scenario),
+        Scenario('pull_request.merge', merge_url, method='post',
+                 expected=(202,), requests=per_scenario),
+        Scenario('merge_job.get', job_url),
+        Scenario('metrics', '/metrics'),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workdir', default='/tmp/guig-bench')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the repository and table sizes')
+    parser.add_argument('--pull-requests', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--only', action='append',
+                        help='run the scenarios starting with this name')
+    parser.add_argument('-o', '--output')
+    synthetic_repo.add_arguments(parser)
+    args = parser.parse_args()
+
+    repo_params = {name: getattr(args, name)
+                   for name in synthetic_repo.DEFAULTS}
+
+    for name in ('commits', 'branches', 'big_diffs'):
+        repo_params[name] = max(int(repo_params[name] * args.scale), 1)
+
+    pull_requests = max(int(args.pull_requests * args.scale), 1)
+    repo_path = os.path.join(args.workdir, 'repo')
+    generated = synthetic_repo.load_params(repo_path)
+
+    if generated is None or any(generated[name] != value
+                                for name, value in repo_params.items()):
+        shutil.rmtree(args.workdir, ignore_errors=True)
+        generated = synthetic_repo.generate(repo_path, **repo_params)
+
+    db_path = os.path.join(args.workdir, 'bench.db')
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    app, startup = create_app(args.workdir)
+
+    from db import db
+    from models import models
+
+    branches = ['master'] + [f'feature-{number:05d}'
+                             for number in range(repo_params['branches'])]
+
+    with app.app_context():
+        seed_seconds = seed_pull_requests(db, models, pull_requests,
+                                          branches, repo_params['seed'])
+
+    results = []
+
+    for scenario in scenarios(app, branches, args.requests):
+        if args.only and not any(scenario.name.startswith(prefix)
+                                 for prefix in args.only):
+            continue
+
+        result = measure(app, scenario, args.requests, args.concurrency)
+        results.append(result)
+        print(f'{result["name"]:28} p50 {result["latency_ms"]["p50"]:8.2f}ms'
+              f'  p99 {result["latency_ms"]["p99"]:8.2f}ms'
+              f'  {result["throughput_rps"]:8.1f} req/s'
+              f'  errors {result["errors"]}', file=sys.stderr)
+
+    git_version = subprocess.run(['git', '--version'], capture_output=True,
+                                 text=True).stdout.strip()
+    report = {'created_at': datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'git': git_version,
+              'platform': platform.platform(),
+              'repository': generated,
+              'pull_requests': {'count': pull_requests,
+                                'seed_seconds': seed_seconds},
+              'startup': startup,
+              'peak_rss_kb': _peak_rss_kb(),
+              'scenarios': results}
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Generate a synthetic repository shaped like a large monorepo, written in
+one `git fast-import` stream:
+
+- a master branch of trunk commits touching a few files each
+- side chains forking merge_depth commits back from master and merged into
+  it every merge_every commits, so history has deep merges
+- branches forking from random master commits with a few commits each
+- big-diff branches rewriting big_diff_files files at once
+
+Branch names have no slash, the branch routes take a single path segment.
+
+Usage: python benchmarks/synthetic_repo.py PATH [--commits N] [--branches N]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import time
+
+
+PARAMS_FILE = 'synthetic.json'
+# bumped whenever the generated history changes for the same parameters
+FORMAT = 1
+DEFAULTS = {'commits': 200000,
+            'branches': 10000,
+            'commits_per_branch': 2,
+            'merge_every': 50,
+            'merge_depth': 20,
+            'big_diffs': 10,
+            'big_diff_files': 2000,
+            'files': 5000,
+            'seed': 1}
+
+
+class FastImport:
+    """
+    Writer of a fast-import stream into the process importing it
+    """
+
+    def __init__(self, path: str):
+        self.process = subprocess.Popen(
+            ['git', 'fast-import', '--quiet', '--done'],
+            cwd=path,
+            stdin=subprocess.PIPE)
+        self.marks = 0
+        self.time = 1500000000
+
+    def write(self, data: bytes):
+        self.process.stdin.write(data)
+
+    def data(self, content: bytes):
+        self.write(b'data %d\n%s\n' % (len(content), content))
+
+    def commit(self,
+               ref: str,
+               message: str,
+               files: dict,
+               parent: int = None,
+               merge: int = None) -> int:
+        """
+        Write a commit on ref with the given path contents, return its mark
+        """
+        self.marks += 1
+        self.time += 60
+        who = b'Bench <bench@example.com> %d +0000' % self.time
+
+        self.write(b'commit %s\nmark :%d\n' % (ref.encode(), self.marks))
+        self.write(b'author %s\ncommitter %s\n' % (who, who))
+        self.data(message.encode())
+
+        if parent is not None:
+            self.write(b'from :%d\n' % parent)
+
+        if merge is not None:
+            self.write(b'merge :%d\n' % merge)
+
+        for path, content in files.items():
+            self.write(b'M 100644 inline %s\n' % path.encode())
+            self.data(content)
+
+        self.write(b'\n')
+        return self.marks
+
+    def close(self):
+        self.write(b'done\n')
+        self.process.stdin.close()
+
+        if self.process.wait() != 0:
+            raise RuntimeError('git fast-import failed')
+
+
+def _path(number: int) -> str:
+    return f'src/module{number % 97:02d}/file{number:05d}.txt'
+
+
+def _content(rng: random.Random, lines: int = 20) -> bytes:
+    return b''.join(b'line %d %d\n' % (index, rng.getrandbits(32))
+                    for index in range(lines))
+
+
+def generate(path: str, **params) -> dict:
+    """
+    Create the repository at path, return the parameters used and the time
+    it took
+    """
+    params = {**DEFAULTS, **params}
+    rng = random.Random(params['seed'])
+    start = time.perf_counter()
+
+    os.makedirs(path)
+    subprocess.run(['git', 'init', '-q', path], check=True)
+    subprocess.run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'],
+                   cwd=path, check=True)
+    subprocess.run(['git', 'config', 'user.email', 'bench@example.com'],
+                   cwd=path, check=True)
+
+    stream = FastImport(path)
+    trunk = []
+    side_commits = params['merge_depth'] if params['merge_every'] else 0
+    branch_commits = (params['branches'] * params['commits_per_branch']
+                      + params['big_diffs'])
+    # every merge_every trunk commits bring side_commits more
+    trunk_size = max(int((params['commits'] - branch_commits)
+                         / (1 + side_commits / (params['merge_every'] or 1))),
+                     1)
+
+    for number in range(trunk_size):
+        files = {_path(rng.randrange(params['files'])): _content(rng)
+                 for _ in range(rng.randint(1, 3))}
+        parent = trunk[-1] if trunk else None
+        merge = None
+
+        if (params['merge_every'] and trunk
+                and number % params['merge_every'] == 0
+                and len(trunk) > params['merge_depth']):
+            # a side chain forked merge_depth commits ago
+            merge = trunk[-params['merge_depth']]
+
+            for depth in range(side_commits):
+                merge = stream.commit(
+                    'refs/heads/side',
+                    f'Side change {number}.{depth}',
+                    {f'side/{number % 13}/change.txt': _content(rng)},
+                    merge)
+
+        if merge is None:
+            message = f'Change {number}'
+        else:
+            message = f'Merge side into master at {number}'
+
+        trunk.append(stream.commit('refs/heads/master', message, files,
+                                   parent, merge))
+
+    for number in range(params['branches']):
+        parent = rng.choice(trunk)
+
+        for change in range(params['commits_per_branch']):
+            parent = stream.commit(
+                f'refs/heads/feature-{number:05d}',
+                f'Feature {number} change {change}',
+                {_path(rng.randrange(params['files'])): _content(rng)},
+                parent)
+
+    for number in range(params['big_diffs']):
+        files = {_path(index): _content(rng, 50)
+                 for index in rng.sample(range(params['files']),
+                                         min(params['big_diff_files'],
+                                             params['files']))}
+        stream.commit(f'refs/heads/big-diff-{number:03d}',
+                      f'Rewrite {len(files)} files', files, trunk[-1])
+
+    stream.close()
+    subprocess.run(['git', 'update-ref', '-d', 'refs/heads/side'],
+                   cwd=path, check=True)
+    subprocess.run(['git', 'commit-graph', 'write', '--reachable'],
+                   cwd=path, check=True)
+
+    params['format'] = FORMAT
+    params['seconds'] = time.perf_counter() - start
+    params['trunk_commits'] = len(trunk)
+
+    with open(os.path.join(path, '.git', PARAMS_FILE), 'w') as params_file:
+        json.dump(params, params_file)
+
+    return params
+
+
+def load_params(path: str) -> dict:
+    """
+    Parameters a repository at path was generated with, None if it was not
+    or by another format of the generator
+    """
+    try:
+        with open(os.path.join(path, '.git', PARAMS_FILE)) as params_file:
+            params = json.load(params_file)
+    except FileNotFoundError:
+        return None
+
+    return params if params.get('format') == FORMAT else None
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    for name, default in DEFAULTS.items():
+        parser.add_argument(f'--{name.replace("_", "-")}',
+                            type=int,
+                            default=default)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    print(json.dumps(generate(args.pop('path'), **args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+import logging
+import queue
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import (bindparam, delete, func, insert, literal, select,
+                        update)
+from sqlalchemy.exc import IntegrityError
+from typing import Dict, Optional, Tuple
+
+from db import db
+from events import event_bus
+from git_repo import RepositoryNotFound, repositories, repository
+from models import models
+import git_log
+import git_refs
+
+
+logger = logging.getLogger(__name__)
+
+INTERVALS = ('day', 'week', 'month')
+
+# rows of a branch read at once, bounded by the variables a query can bind
+BATCH_SIZE = 500
+
+
+def _bucket(day: date, interval: str) -> date:
+    """
+    First day of the interval day falls in, weeks start on monday
+    """
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+
+    if interval == 'month':
+        return day.replace(day=1)
+
+    return day
+
+
+class Activity:
+    """
+    Commits, files changed and lines added and deleted by author and by day
+    for each branch, materialized in the branch_activity table.
+
+    The tip the rows of a branch were computed for is stored along them.
+    When the tip moves only the commits between the stored tip and the new
+    one are read, with one `git log --left-right --numstat`: the commits the
+    branch gained are added and those a force push dropped are subtracted.
+    A branch seen for the first time starts from a copy of the rows of
+    BRANCH_BASE and the commits between both tips, so the whole history is
+    only walked once, for the base branch.
+
+    Branches are updated when their stats are asked for, and in background
+    whenever a branch of the REPO_PATH repository with stats moves. Every
+    worker process does so, the stored tip is moved with a compare-and-set
+    in the transaction that applies the commits so only one of them does
+    """
+
+    def __init__(self):
+        self.app = None
+        self.base = 'master'
+        self._locks: Dict[Tuple[Optional[str], str], threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.base = app.config['BRANCH_BASE']
+
+        if repositories.pool is not None:
+            event_bus.subscribe(self._on_event)
+            self._thread = threading.Thread(target=self._run,
+                                            name='activity',
+                                            daemon=True)
+            self._thread.start()
+
+    def _on_event(self, event: str, data: dict):
+        if event == 'ref' and data['ref'].startswith('refs/heads/'):
+            self._schedule(data['ref'][len('refs/heads/'):])
+
+    def _schedule(self, branch: str):
+        with self._lock:
+            if branch in self._queued:
+                return
+
+            self._queued.add(branch)
+
+        self._queue.put(branch)
+
+    def _run(self):
+        while True:
+            branch = self._queue.get()
+
+            with self._lock:
+                self._queued.discard(branch)
+
+            try:
+                with self.app.app_context():
+                    # only the REPO_PATH repository is watched
+                    repositories.select(None)
+                    self.update(branch, tracked_only=True)
+            except RepositoryNotFound:
+                logger.warning('Repository of REPO_PATH not found')
+            except Exception:
+                logger.exception('Activity update of %s failed', branch)
+
+    def _branch_lock(self, name: Optional[str],
+                     branch: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault((name, branch), threading.Lock())
+
+    def update(self,
+               branch: str,
+               tracked_only: bool = False
+               ) -> Optional[models.BranchStatsState]:
+        """
+        Bring the rows of branch in the repository of the application
+        context up to its tip and return their state. The rows of a deleted
+        branch are dropped and None is returned. With tracked_only a branch
+        without rows is left alone
+        """
+        name = repositories.name()
+
+        # the lock keeps the threads of this process from doing the same
+        # work twice, other processes are kept out by the compare-and-set
+        # of the stored tip
+        with self._branch_lock(name, branch):
+            while True:
+                state = models.BranchStatsState.get_by_branch(name, branch)
+
+                if tracked_only and state is None:
+                    return None
+
+                tip = git_refs.resolve_branch(repository, branch)
+                stored = state.commit if state is not None else None
+
+                if tip == stored:
+                    return state
+
+                # no transaction is held while git is read
+                db.session.rollback()
+
+                if self._update(name, branch, stored, tip):
+                    if tip is None:
+                        return None
+
+                    return models.BranchStatsState.get_by_branch(name,
+                                                                 branch)
+
+                logger.info('Activity of %s moved by another worker, '
+                            'reading it again', branch)
+
+    @staticmethod
+    def _state_key(name: Optional[str], branch: str) -> tuple:
+        table = models.BranchStatsState.__table__
+        return table.c.repository == name, table.c.branch == branch
+
+    def _update(self,
+                name: Optional[str],
+                branch: str,
+                stored: Optional[str],
+                tip: Optional[str]) -> bool:
+        """
+        Move the rows of branch from the stored tip to tip, None when the
+        branch was deleted. False when another worker moved them first, then
+        nothing was changed
+        """
+        table = models.BranchStatsState.__table__
+
+        if tip is None:
+            deleted = db.session.execute(delete(table).where(
+                *self._state_key(name, branch), table.c.commit == stored))
+
+            if deleted.rowcount != 1:
+                db.session.rollback()
+                return False
+
+            self._clear(name, branch)
+            db.session.commit()
+            return True
+
+        old = stored
+        # rewritten and garbage collected, there is nothing to diff with
+        stale = old is not None and not git_log.exists(repository, old)
+
+        if old is None or stale:
+            old = base = self._base_commit(branch)
+        else:
+            base = None
+
+        deltas, count = self._deltas(tip, old)
+
+        # one transaction, the rows and their tip never disagree
+        try:
+            if not self._claim(name, branch, stored, tip):
+                db.session.rollback()
+                return False
+
+            if stale:
+                self._clear(name, branch)
+
+            if base is not None and not self._copy_base(name, branch, base):
+                db.session.rollback()
+                return False
+
+            self._apply(name, branch, deltas)
+            db.session.commit()
+        except IntegrityError:
+            # another worker seeded the branch first
+            db.session.rollback()
+            return False
+
+        logger.info('Activity of %s updated with %s commits', branch, count)
+        return True
+
+    @staticmethod
+    def _deltas(tip: str, old: Optional[str]) -> Tuple[dict, int]:
+        """
+        Author, commits, files, additions and deletions by (day, email) of
+        the commits between old and tip, and the number of those commits
+        """
+        deltas = defaultdict(lambda: [None, 0, 0, 0, 0])
+        count = 0
+
+        for change in git_log.iter_changes(repository, tip, old):
+            sign = -1 if change['removed'] else 1
+            day = datetime.fromtimestamp(change['timestamp'],
+                                         timezone.utc).date()
+            delta = deltas[day, change['email']]
+
+            # newest first, the latest name of an author is kept
+            if delta[0] is None and not change['removed']:
+                delta[0] = change['author']
+
+            delta[1] += sign
+            delta[2] += sign * change['files']
+            delta[3] += sign * change['additions']
+            delta[4] += sign * change['deletions']
+            count += 1
+
+        return deltas, count
+
+    def _claim(self,
+               name: Optional[str],
+               branch: str,
+               stored: Optional[str],
+               tip: str) -> bool:
+        """
+        Set the stored tip of branch to tip if it still is stored. The row
+        stays locked until the transaction ends, the rows of the branch are
+        only written by the worker that moved it
+        """
+        table = models.BranchStatsState.__table__
+
+        if stored is None:
+            # a concurrent insert fails on the unique index
+            db.session.execute(insert(table).values(repository=name,
+                                                    branch=branch,
+                                                    commit=tip))
+            return True
+
+        moved = db.session.execute(update(table).where(
+            *self._state_key(name, branch),
+            table.c.commit == stored).values(commit=tip))
+
+        return moved.rowcount == 1
+
+    def _base_commit(self, branch: str) -> Optional[str]:
+        """
+        Commit the rows of the base branch are up to, the start of a branch
+        seen for the first time. None when branch has to start from scratch
+        """
+        if branch == self.base:
+            return None
+
+        base = self.update(self.base)
+        return base.commit if base is not None else None
+
+    def _copy_base(self,
+                   name: Optional[str],
+                   branch: str,
+                   commit: str) -> bool:
+        """
+        Copy the rows of the base branch to branch, False if the base moved
+        away from commit since they were read
+        """
+        # the base state is locked until the copy is committed, its rows can
+        # not move between the check and the copy
+        state_table = models.BranchStatsState.__table__
+        current = db.session.execute(
+            select(state_table.c.commit).where(
+                *self._state_key(name, self.base)).with_for_update()
+        ).scalar()
+
+        if current != commit:
+            return False
+
+        table = models.BranchActivity.__table__
+        columns = ('day', 'email', 'author') + models.BranchActivity.TOTALS
+        rows = select(table.c.repository,
+                      literal(branch),
+                      *(table.c[column] for column in columns)).where(
+            table.c.repository == name, table.c.branch == self.base)
+        db.session.execute(insert(table).from_select(
+            ('repository', 'branch') + columns, rows))
+
+        return True
+
+    @staticmethod
+    def _clear(name: Optional[str], branch: str):
+        models.BranchActivity.query_branch(name, branch).delete(
+            synchronize_session=False)
+
+    @staticmethod
+    def _apply(name: Optional[str], branch: str, deltas: dict):
+        """
+        Add the deltas to the rows of branch in the database, rows left
+        without commits are deleted
+        """
+        table = models.BranchActivity.__table__
+        key = (table.c.repository == name, table.c.branch == branch)
+        keys = list(deltas)
+        existing = set()
+
+        for start in range(0, len(keys), BATCH_SIZE):
+            days = {day for day, _ in keys[start:start + BATCH_SIZE]}
+            existing.update(
+                (row.day, row.email) for row in db.session.execute(
+                    select(table.c.day, table.c.email).where(
+                        *key, table.c.day.in_(days))))
+
+        changes = []
+        new_rows = []
+
+        for (day, email), delta in deltas.items():
+            author, commits, files, additions, deletions = delta
+
+            if (day, email) in existing:
+                changes.append({'row_day': day,
+                                'row_email': email,
+                                'row_author': author or None,
+                                'commits_delta': commits,
+                                'files_delta': files,
+                                'additions_delta': additions,
+                                'deletions_delta': deletions})
+            elif commits > 0:
+                new_rows.append({'repository': name,
+                                 'branch': branch,
+                                 'day': day,
+                                 'email': email,
+                                 'author': author,
+                                 'commits': commits,
+                                 'files': files,
+                                 'additions': additions,
+                                 'deletions': deletions})
+
+        if changes:
+            # increments computed by the database, never from a stale read
+            db.session.execute(
+                update(table).where(
+                    *key,
+                    table.c.day == bindparam('row_day'),
+                    table.c.email == bindparam('row_email')).values(
+                    author=func.coalesce(bindparam('row_author'),
+                                         table.c.author),
+                    **{total: table.c[total] + bindparam(f'{total}_delta')
+                       for total in models.BranchActivity.TOTALS}),
+                changes)
+
+        if new_rows:
+            db.session.execute(insert(table), new_rows)
+
+        db.session.execute(delete(table).where(*key, table.c.commits <= 0))
+
+    def get(self,
+            branch: str,
+            interval: str = 'week',
+            since: Optional[date] = None,
+            until: Optional[date] = None) -> Optional[dict]:
+        """
+        Totals by author and activity by interval of branch, from the days
+        since to until when given. None if there is no such branch
+        """
+        state = self.update(branch)
+
+        if state is None:
+            return None
+
+        model = models.BranchActivity
+        query = model.query_branch(repositories.name(), branch)
+
+        if since is not None:
+            query = query.filter(model.day >= since)
+
+        if until is not None:
+            query = query.filter(model.day <= until)
+
+        totals = [func.sum(getattr(model, total)).label(total)
+                  for total in model.TOTALS]
+        authors = query.with_entities(
+            model.email,
+            func.max(model.author).label('author'),
+            func.min(model.day).label('first_day'),
+            func.max(model.day).label('last_day'),
+            *totals).group_by(model.email).order_by(
+                func.sum(model.commits).desc(), model.email)
+        days = query.with_entities(model.day, *totals).group_by(
+            model.day).order_by(model.day)
+
+        activity = {}
+
+        for row in days:
+            bucket = activity.setdefault(_bucket(row.day, interval),
+                                         dict.fromkeys(model.TOTALS, 0))
+
+            for total in model.TOTALS:
+                bucket[total] += getattr(row, total)
+
+        return {'branch': branch,
+                'commit': state.commit,
+                'interval': interval,
+                'commits': sum(bucket['commits']
+                               for bucket in activity.values()),
+                'authors': [{'author': row.author,
+                             'email': row.email,
+                             'first_day': row.first_day.isoformat(),
+                             'last_day': row.last_day.isoformat(),
+                             **{total: getattr(row, total)
+                                for total in model.TOTALS}}
+                            for row in authors],
+                'activity': [dict(bucket, date=day.isoformat())
+                             for day, bucket in activity.items()]}
+
+
+activity = Activity()
@@ -1,53 +1,441 @@
+import logging
 import os
+import threading
+import time
 import dotenv
 from flask import Flask
 from flask_restful import Api
 from flask_cors import CORS
+from sqlalchemy.exc import DatabaseError
 
-from db import db
+from activity import activity
+from db import (add_missing_columns, configure_engine, create_missing_indexes,
+                db, engine_options)
+from executors import executors
+from git_repo import repositories, repository
+from cache import commit_cache
+from commit_index import commit_index
+from compare import compare
+from merge_queue import merge_queue
+from mergeability import mergeability_worker
+from metrics import metrics
+from profiler import profiler
+from reachability import reachability
+from single_flight import single_flight
+from git_tree import trees
+from ref_watcher import ref_watcher
 from resources import branch
 from resources import commit
+from resources import event
+from resources import metric
+from resources import profile
 from resources import pull_request
+from resources import tree
+import git_log
+import git_refs
 
-dotenv.load_dotenv(verbose=True)
 
-app = Flask(__name__)
-api = Api(app)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['PROPAGATE_EXCEPTIONS'] = True
+logger = logging.getLogger(__name__)
 
-api.add_resource(branch.Branches, '/api/v1/branches', '/api/v1/branches/')
 
-api.add_resource(branch.Branch,
-                 '/api/v1/branches/<string:branch_name>',
-                 '/api/v1/branches/<string:branch_name>/')
+def _load_config(app: Flask):
+    """
+    Read the settings of the environment, and of .env, in app.config
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI')
+    app.config['REPO_PATH'] = os.environ.get('REPO_PATH')
+    app.config['REPOS_ROOT'] = os.environ.get('REPOS_ROOT')
+    app.config['REPOS_MAX_OPEN'] = int(os.environ.get('REPOS_MAX_OPEN', 64))
+    app.config['REPOS_IDLE_TIMEOUT'] = float(
+        os.environ.get('REPOS_IDLE_TIMEOUT', 600))
+    app.config['REPO_POOL_SIZE'] = int(os.environ.get('REPO_POOL_SIZE', 8))
+    app.config['REPO_POOL_TIMEOUT'] = float(
+        os.environ.get('REPO_POOL_TIMEOUT', 30))
+    app.config['REPO_POOL_MAX_USES'] = int(
+        os.environ.get('REPO_POOL_MAX_USES', 1000))
+    app.config['REPO_POOL_MAX_AGE'] = float(
+        os.environ.get('REPO_POOL_MAX_AGE', 3600))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # unset pool settings take the defaults of the backend
+    for name in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_POOL_RECYCLE'):
+        app.config[name] = (int(os.environ[name]) if os.environ.get(name)
+                            else None)
+    app.config['DB_POOL_TIMEOUT'] = float(
+        os.environ.get('DB_POOL_TIMEOUT', 30))
+    app.config['DB_STATEMENT_TIMEOUT'] = float(
+        os.environ.get('DB_STATEMENT_TIMEOUT', 30))
+    app.config['SQLITE_WAL'] = os.environ.get(
+        'SQLITE_WAL', 'true').lower() in ('1', 'true', 'yes')
+    app.config['SQLITE_BUSY_TIMEOUT'] = float(
+        os.environ.get('SQLITE_BUSY_TIMEOUT', 5))
+    app.config['SQLITE_CACHE_SIZE'] = int(
+        os.environ.get('SQLITE_CACHE_SIZE', 64 * 1024))
+    app.config['SQLITE_MMAP_SIZE'] = int(
+        os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    app.config['COMMIT_CACHE_SIZE'] = int(
+        os.environ.get('COMMIT_CACHE_SIZE', 10000))
+    app.config['COMMIT_PAGE_CACHE_SIZE'] = int(
+        os.environ.get('COMMIT_PAGE_CACHE_SIZE', 1000))
+    app.config['COMMIT_CACHE_PERSIST'] = os.environ.get(
+        'COMMIT_CACHE_PERSIST', '').lower() in ('1', 'true', 'yes')
+    app.config['COMMIT_CACHE_PERSIST_SIZE'] = int(
+        os.environ.get('COMMIT_CACHE_PERSIST_SIZE', 1000000))
+    app.config['MERGE_WORKERS'] = int(os.environ.get('MERGE_WORKERS', 4))
+    app.config['MERGE_QUEUE_MAX_JOBS'] = int(
+        os.environ.get('MERGE_QUEUE_MAX_JOBS', 1000))
+    app.config['MERGEABILITY_INTERVAL'] = int(
+        os.environ.get('MERGEABILITY_INTERVAL', 30))
+    app.config['MERGEABILITY_CACHE_SIZE'] = int(
+        os.environ.get('MERGEABILITY_CACHE_SIZE', 10000))
+    app.config['COMPARE_CACHE_SIZE'] = int(
+        os.environ.get('COMPARE_CACHE_SIZE', 1000))
+    app.config['COMPARE_DIFF_CACHE_SIZE'] = int(
+        os.environ.get('COMPARE_DIFF_CACHE_SIZE', 64))
+    app.config['COMPARE_MAX_COMMITS'] = int(
+        os.environ.get('COMPARE_MAX_COMMITS', 250))
+    app.config['COMPARE_MAX_FILES'] = int(
+        os.environ.get('COMPARE_MAX_FILES', 1000))
+    app.config['COMPARE_MAX_DIFF_BYTES'] = int(
+        os.environ.get('COMPARE_MAX_DIFF_BYTES', 1024 * 1024))
+    app.config['BRANCH_BASE'] = os.environ.get('BRANCH_BASE', 'master')
+    app.config['AHEAD_BEHIND_CACHE_SIZE'] = int(
+        os.environ.get('AHEAD_BEHIND_CACHE_SIZE', 100000))
+    app.config['ADMISSION_CONTROL'] = os.environ.get(
+        'ADMISSION_CONTROL', 'true').lower() in ('1', 'true', 'yes')
+    app.config['ADMISSION_TIMEOUT'] = float(
+        os.environ.get('ADMISSION_TIMEOUT', 10))
+    app.config['ADMISSION_RETRY_AFTER'] = int(
+        os.environ.get('ADMISSION_RETRY_AFTER', 1))
+    app.config['CHEAP_WORKERS'] = int(os.environ.get('CHEAP_WORKERS', 16))
+    app.config['CHEAP_QUEUE_SIZE'] = int(
+        os.environ.get('CHEAP_QUEUE_SIZE', 64))
+    app.config['HEAVY_WORKERS'] = int(os.environ.get('HEAVY_WORKERS', 4))
+    app.config['HEAVY_QUEUE_SIZE'] = int(
+        os.environ.get('HEAVY_QUEUE_SIZE', 16))
+    app.config['HEAVY_ENDPOINTS'] = os.environ.get(
+        'HEAVY_ENDPOINTS',
+        'commits,searchcommits,pullrequestcommits,pullrequestdiff,blob,'
+        'branchstats')
+    app.config['ASGI_WORKERS'] = int(os.environ.get('ASGI_WORKERS', 64))
+    app.config['TREE_CACHE_SIZE'] = int(
+        os.environ.get('TREE_CACHE_SIZE', 10000))
+    app.config['WARM_UP'] = os.environ.get(
+        'WARM_UP', 'true').lower() in ('1', 'true', 'yes')
+    app.config['WARM_UP_COMMITS'] = int(
+        os.environ.get('WARM_UP_COMMITS', 100))
+    app.config['SINGLE_FLIGHT_TIMEOUT'] = float(
+        os.environ.get('SINGLE_FLIGHT_TIMEOUT', 30))
+    app.config['REF_WATCHER'] = os.environ.get('REF_WATCHER', 'auto')
+    app.config['REF_WATCHER_POLL_INTERVAL'] = float(
+        os.environ.get('REF_WATCHER_POLL_INTERVAL', 1))
+    app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+    app.config['PROFILE_SAMPLE_RATE'] = float(
+        os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_INTERVAL'] = float(
+        os.environ.get('PROFILE_INTERVAL', 0.005))
+    app.config['PROFILE_MAX_PROFILES'] = int(
+        os.environ.get('PROFILE_MAX_PROFILES', 100))
 
-api.add_resource(commit.Commits,
-                 '/api/v1/branches/<string:branch_name>/commits',
-                 '/api/v1/branches/<string:branch_name>/commits/')
 
-api.add_resource(
-    commit.Commit,
-    '/api/v1/branches/<string:branch_name>/commits/<string:commit_sha>',
-    '/api/v1/branches/<string:branch_name>/commits/<string:commit_sha>/'
-    )
+def _add_resources(api: Api):
+    api.add_resource(branch.Branches,
+                     '/api/v1/branches',
+                     '/api/v1/branches/',
+                     '/api/v1/repos/<string:repo>/branches',
+                     '/api/v1/repos/<string:repo>/branches/')
 
-api.add_resource(pull_request.PullRequest,
-                 '/api/v1/pull-requests',
-                 '/api/v1/pull-requests/')
+    api.add_resource(
+        branch.Branch,
+        '/api/v1/branches/<string:branch_name>',
+        '/api/v1/branches/<string:branch_name>/',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>/'
+        )
 
-api.add_resource(pull_request.MergePullRequest,
-                 '/api/v1/pull-requests/<int:pull_request_id>/merge',
-                 '/api/v1/pull-requests/<int:pull_request_id>/merge/')
+    api.add_resource(
+        branch.BranchStats,
+        '/api/v1/branches/<string:branch_name>/stats',
+        '/api/v1/branches/<string:branch_name>/stats/',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>/stats',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>/stats/'
+        )
 
-api.add_resource(pull_request.ClosePullRequest,
-                 '/api/v1/pull-requests/<int:pull_request_id>/close',
-                 '/api/v1/pull-requests/<int:pull_request_id>/close/')
+    api.add_resource(
+        commit.Commits,
+        '/api/v1/branches/<string:branch_name>/commits',
+        '/api/v1/branches/<string:branch_name>/commits/',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>/commits',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>/commits/'
+        )
 
-if __name__ == '__main__':
+    api.add_resource(
+        commit.Commit,
+        '/api/v1/branches/<string:branch_name>/commits/<string:commit_sha>',
+        '/api/v1/branches/<string:branch_name>/commits/<string:commit_sha>/',
+        '/api/v1/repos/<string:repo>'
+        '/branches/<string:branch_name>/commits/<string:commit_sha>',
+        '/api/v1/repos/<string:repo>'
+        '/branches/<string:branch_name>/commits/<string:commit_sha>/'
+        )
+
+    api.add_resource(
+        tree.Tree,
+        '/api/v1/branches/<string:branch_name>/tree',
+        '/api/v1/branches/<string:branch_name>/tree/',
+        '/api/v1/branches/<string:branch_name>/tree/<path:path>',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>/tree',
+        '/api/v1/repos/<string:repo>/branches/<string:branch_name>/tree/',
+        '/api/v1/repos/<string:repo>'
+        '/branches/<string:branch_name>/tree/<path:path>'
+        )
+
+    api.add_resource(
+        tree.Blob,
+        '/api/v1/branches/<string:branch_name>/blob/<path:path>',
+        '/api/v1/repos/<string:repo>'
+        '/branches/<string:branch_name>/blob/<path:path>'
+        )
+
+    api.add_resource(commit.SearchCommits,
+                     '/api/v1/commits/search',
+                     '/api/v1/commits/search/',
+                     '/api/v1/repos/<string:repo>/commits/search',
+                     '/api/v1/repos/<string:repo>/commits/search/')
+
+    api.add_resource(pull_request.PullRequest,
+                     '/api/v1/pull-requests',
+                     '/api/v1/pull-requests/',
+                     '/api/v1/repos/<string:repo>/pull-requests',
+                     '/api/v1/repos/<string:repo>/pull-requests/')
+
+    api.add_resource(
+        pull_request.PullRequestBatch,
+        '/api/v1/pull-requests/batch',
+        '/api/v1/pull-requests/batch/',
+        '/api/v1/repos/<string:repo>/pull-requests/batch',
+        '/api/v1/repos/<string:repo>/pull-requests/batch/'
+        )
+
+    api.add_resource(
+        pull_request.MergePullRequest,
+        '/api/v1/pull-requests/<int:pull_request_id>/merge',
+        '/api/v1/pull-requests/<int:pull_request_id>/merge/',
+        '/api/v1/repos/<string:repo>'
+        '/pull-requests/<int:pull_request_id>/merge',
+        '/api/v1/repos/<string:repo>'
+        '/pull-requests/<int:pull_request_id>/merge/'
+        )
+
+    api.add_resource(
+        pull_request.PullRequestCommits,
+        '/api/v1/pull-requests/<int:pull_request_id>/commits',
+        '/api/v1/pull-requests/<int:pull_request_id>/commits/',
+        '/api/v1/repos/<string:repo>'
+        '/pull-requests/<int:pull_request_id>/commits',
+        '/api/v1/repos/<string:repo>'
+        '/pull-requests/<int:pull_request_id>/commits/'
+        )
+
+    api.add_resource(
+        pull_request.PullRequestDiff,
+        '/api/v1/pull-requests/<int:pull_request_id>/diff',
+        '/api/v1/pull-requests/<int:pull_request_id>/diff/',
+        '/api/v1/repos/<string:repo>/pull-requests/<int:pull_request_id>/diff',
+        '/api/v1/repos/<string:repo>/pull-requests/<int:pull_request_id>/diff/'
+        )
+
+    api.add_resource(pull_request.MergeJob,
+                     '/api/v1/merge-jobs/<string:job_id>',
+                     '/api/v1/merge-jobs/<string:job_id>/')
+
+    api.add_resource(
+        pull_request.ClosePullRequest,
+        '/api/v1/pull-requests/<int:pull_request_id>/close',
+        '/api/v1/pull-requests/<int:pull_request_id>/close/',
+        '/api/v1/repos/<string:repo>'
+        '/pull-requests/<int:pull_request_id>/close',
+        '/api/v1/repos/<string:repo>'
+        '/pull-requests/<int:pull_request_id>/close/'
+        )
+
+    api.add_resource(event.Events, '/api/v1/events', '/api/v1/events/')
+
+    api.add_resource(metric.Metrics, '/metrics', '/api/v1/metrics')
+
+    api.add_resource(profile.Profiles,
+                     '/api/v1/admin/profiles',
+                     '/api/v1/admin/profiles/')
+
+    api.add_resource(profile.Profile,
+                     '/api/v1/admin/profiles/<string:profile_id>',
+                     '/api/v1/admin/profiles/<string:profile_id>/')
+
+
+# process the background workers run in, they do not survive a fork
+_started_pid = None
+_start_lock = threading.Lock()
+# start of the process, or of the last fork, for the cold start time
+_process_start = time.monotonic()
+
+
+def _init_extensions(app: Flask):
+    """
+    Configure the extensions. Nothing here opens a database connection or a
+    repository handle or starts a thread, so the application can be built
+    in the parent of a pre-forking server
+    """
+    metrics.init_app(app)
+    profiler.init_app(app)
+    executors.init_app(app)
+    single_flight.init_app(app)
+    metrics.register_cache('commits', lambda: commit_cache.memory.stats())
+    metrics.register_cache('commit_pages',
+                           lambda: commit_cache.pages.stats())
+    metrics.register_cache('commits_persistent',
+                           lambda: commit_cache.stats()['persistent'])
+    metrics.register_cache('compare', lambda: compare.stats())
+    metrics.register_cache('ahead_behind', lambda: reachability.cache.stats())
+    metrics.register_cache('reachability_indexes',
+                           lambda: reachability.indexes.stats())
+    metrics.register_cache('trees', lambda: trees.cache.stats())
+    metrics.register_cache('single_flight', lambda: single_flight.stats())
+    metrics.register_cache('mergeability',
+                           lambda: mergeability_worker.cache.stats())
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config))
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, app.config)
+    repositories.init_app(app)
+    commit_cache.init_app(app)
+    compare.init_app(app)
+    trees.init_app(app)
     CORS(app)
+
+
+def _after_fork(app: Flask):
+    """
+    Drop what the child of a fork inherited and can not use: the database
+    connections and repository handles of the parent. They are abandoned,
+    not closed, the parent keeps using them
+    """
+    global _process_start
+
+    _process_start = time.monotonic()
+
+    if _started_pid is not None:
+        # locks held by the threads of the parent stay held in the child
+        logger.warning('Process %s forked after its workers started, start '
+                       'must run after the fork', os.getppid())
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+    repositories.reset()
+
+
+def _create_schema():
+    """
+    Create the missing tables and bring those of an older version up to the
+    models
+    """
+    db.create_all()
+    add_missing_columns(db.engine)
+    create_missing_indexes(db.engine)
+
+
+def _warm_up(app: Flask):
+    """
+    Read the branch tips and load the latest commits of the base branch in
+    the commit cache, and open a repository handle and a database
+    connection, so the first requests do not pay for them
+    """
     with app.app_context():
-        db.create_all()
+        db.session.execute(db.text('SELECT 1'))
+
+        if repositories.pool is None:
+            return
+
+        tips = git_refs.branch_tips(repository)
+        base = tips.get(app.config['BRANCH_BASE'])
+
+        if base is not None:
+            shas, _ = git_log.walk(repository, [base],
+                                   app.config['WARM_UP_COMMITS'])
+            commit_cache.load(repository, shas)
+
+
+def start(app: Flask):
+    """
+    Create the tables, start the background workers and warm up, once per
+    process and in the process that serves. Called by the first request
+    when it was not called before, servers with a post-fork hook can call
+    it there so workers are ready before they take traffic
+    """
+    global _started_pid
+
+    if _started_pid == os.getpid():
+        return
+
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+
+        with app.app_context():
+            try:
+                _create_schema()
+            except DatabaseError:
+                # another worker changed the schema at the same time
+                db.session.rollback()
+                _create_schema()
+
+        merge_queue.init_app(app)
+        mergeability_worker.init_app(app)
+        ref_watcher.init_app(app)
+        commit_index.init_app(app)
+        reachability.init_app(app)
+        activity.init_app(app)
+
+        warm_up_start = time.monotonic()
+
+        if app.config['WARM_UP']:
+            try:
+                _warm_up(app)
+            except Exception:
+                logger.exception('Warm up failed')
+
+        now = time.monotonic()
+        metrics.startup(now - _process_start, now - warm_up_start)
+        logger.info('Process %s ready in %.3fs, %.3fs warming up',
+                    os.getpid(), now - _process_start, now - warm_up_start)
+        _started_pid = os.getpid()
+
+
+def create_app() -> Flask:
+    """
+    Build the application from the environment. The database, repositories
+    and background workers are only touched by start, which must run after
+    the fork of a pre-forking server, the parent only builds the application:
+
+        gunicorn --preload 'app:create_app()'
+    """
+    dotenv.load_dotenv(verbose=True)
+
+    app = Flask(__name__)
+    _load_config(app)
+    _add_resources(Api(app))
+    _init_extensions(app)
+    app.before_request(lambda: start(app))
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: _after_fork(app))
+
+    return app
+
+
+if __name__ == '__main__':
+    app = create_app()
+    start(app)
     app.run(host="0.0.0.0", debug=True, port=80)
@@ -0,0 +1,255 @@
+"""
+ASGI serving mode, run from src with any ASGI server, for example:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 80
+
+Waiting requests are coroutines instead of threads. Each request is
+admitted by the lane of its endpoint before it takes a thread and runs in
+the bounded threads of that lane, a full lane answers 503 at once. Requests
+no lane admits, like event streams, share ASGI_WORKERS threads and wait as
+coroutines for a free one. Workers start and warm up on the lifespan startup
+event, before taking traffic
+"""
+import asyncio
+import io
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+from app import create_app, start
+from executors import Lane, executors
+
+
+class AsgiAdapter:
+    """
+    Run a WSGI application in the threads of the lanes of executors
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        # requests no lane admits, exempt endpoints or every request when
+        # admission control is off
+        self._executor = ThreadPoolExecutor(
+            wsgi_app.config['ASGI_WORKERS'], thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] == 'websocket':
+            # closing before the connection is accepted answers 403
+            await receive()
+            await send({'type': 'websocket.close'})
+            return
+
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported scope {scope["type"]}')
+
+        lane = self._lane(scope)
+
+        if lane is not None and not lane.admit():
+            await self._send_busy(lane, send)
+            return
+
+        try:
+            disconnected = threading.Event()
+            body = await self._read_body(receive, disconnected)
+            environ = self._environ(scope, body)
+            environ[executors.ENVIRON_KEY] = lane
+            watcher = asyncio.ensure_future(
+                self._watch_disconnect(receive, disconnected))
+
+            try:
+                await self._run(lane, environ, send, disconnected)
+            finally:
+                watcher.cancel()
+        finally:
+            if lane is not None:
+                lane.done()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                loop = asyncio.get_running_loop()
+
+                try:
+                    await loop.run_in_executor(None, start, self.wsgi_app)
+                except Exception as error:
+                    # the server reports it and exits instead of serving
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(error)})
+                    return
+
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _lane(self, scope) -> Optional[Lane]:
+        if not executors.enabled:
+            return None
+
+        urls = self.wsgi_app.url_map.bind('localhost',
+                                          scope.get('root_path', ''))
+
+        try:
+            endpoint, _ = urls.match(scope['path'], scope['method'])
+        except (HTTPException, RequestRedirect):
+            endpoint = None
+
+        return executors.lane(endpoint)
+
+    @staticmethod
+    async def _read_body(receive, disconnected: threading.Event) -> bytes:
+        chunks = []
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                break
+
+            chunks.append(message.get('body', b''))
+
+            if not message.get('more_body'):
+                break
+
+        return b''.join(chunks)
+
+    @staticmethod
+    async def _watch_disconnect(receive, disconnected: threading.Event):
+        """
+        Set disconnected when the client goes away while the response is
+        produced
+        """
+        while not disconnected.is_set():
+            message = await receive()
+
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+
+    @staticmethod
+    async def _send_busy(lane: Lane, send):
+        message, status, headers = executors.busy(lane)
+        body = json.dumps(message).encode()
+        headers = [(name.lower().encode(), value.encode())
+                   for name, value in headers.items()]
+        headers += [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode())]
+
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    def _environ(scope, body: bytes) -> dict:
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode(
+                'latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f'HTTP_{name}'
+
+            if name in environ:
+                value = f'{environ[name]},{value}'
+
+            environ[name] = value
+
+        return environ
+
+    async def _run(self,
+                   lane: Optional[Lane],
+                   environ: dict,
+                   send,
+                   disconnected: threading.Event):
+        """
+        Call the application in a thread of the lane, or of the adapter for
+        requests no lane admits. The thread sends the response as it is
+        produced and waits for every chunk to be sent, so a slow client
+        holds back the stream and not memory. Once the client disconnects
+        the response is closed at its next chunk, which frees the thread
+        """
+        loop = asyncio.get_running_loop()
+
+        def respond():
+            status_headers = []
+
+            def start_response(status, headers, exc_info=None):
+                status_headers[:] = [status, headers]
+
+            def send_message(message: dict):
+                asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+            def send_start():
+                status, headers = status_headers
+                send_message({
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'),
+                                 value.encode('latin-1'))
+                                for name, value in headers]})
+
+            response = self.wsgi_app(environ, start_response)
+
+            try:
+                started = False
+
+                for chunk in response:
+                    if disconnected.is_set():
+                        return
+
+                    if not chunk:
+                        continue
+
+                    if not started:
+                        send_start()
+                        started = True
+
+                    send_message({'type': 'http.response.body',
+                                  'body': chunk,
+                                  'more_body': True})
+
+                if not started:
+                    send_start()
+
+                send_message({'type': 'http.response.body', 'body': b''})
+            finally:
+                # stops streams still running after a client went away
+                if hasattr(response, 'close'):
+                    response.close()
+
+        executor = self._executor if lane is None else lane.executor
+        await loop.run_in_executor(executor, respond)
+
+
+application = AsgiAdapter(create_app())
@@ -0,0 +1,192 @@
+import json
+import threading
+from collections import OrderedDict
+from sqlalchemy.exc import IntegrityError
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+from db import db
+from git import Repo
+from models import models
+import git_log
+
+
+class LRUCache:
+    """
+    Thread safe in-process cache bounded to max_size entries, the least
+    recently used entry is evicted first
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class CommitCache:
+    """
+    Serialized commit payloads keyed by hexsha. Commits are immutable so
+    entries never need invalidation, only eviction: an in-process LRU tier in
+    front of an optional table in the application database that survives
+    restarts and is bounded by evicting the oldest rows.
+
+    Pages of a listing are kept as the list of their SHAs keyed by the SHAs
+    the walk started from and the page size, which makes them immutable too
+    """
+
+    def __init__(self):
+        self.memory = LRUCache()
+        self.pages = LRUCache()
+        self.persistent = False
+        self.persistent_size = 0
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        self._persistent_rows = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.memory = LRUCache(app.config['COMMIT_CACHE_SIZE'])
+        self.pages = LRUCache(app.config['COMMIT_PAGE_CACHE_SIZE'])
+        self.persistent = app.config['COMMIT_CACHE_PERSIST']
+        self.persistent_size = app.config['COMMIT_CACHE_PERSIST_SIZE']
+
+    def get(self, sha: str) -> Optional[dict]:
+        return self.get_many([sha]).get(sha)
+
+    def get_many(self, shas: Iterable[str]) -> Dict[str, dict]:
+        """
+        Return the cached payloads found for shas, missing ones are absent
+        from the result
+        """
+        found = {}
+        missing = []
+
+        for sha in shas:
+            commit = self.memory.get(sha)
+
+            if commit is None:
+                missing.append(sha)
+            else:
+                found[sha] = commit
+
+        if missing and self.persistent:
+            rows = models.CommitMetadata.query.filter(
+                models.CommitMetadata.sha.in_(missing)).all()
+
+            for row in rows:
+                commit = json.loads(row.payload)
+                self.memory.put(row.sha, commit)
+                found[row.sha] = commit
+
+            self.persistent_hits += len(rows)
+            self.persistent_misses += len(missing) - len(rows)
+
+        return found
+
+    def load(self, repo: Repo, shas: List[str]) -> List[dict]:
+        """
+        Payloads of shas in the same order, only the commits missing from
+        the cache are read from git
+        """
+        commits = self.get_many(shas)
+        missing = [sha for sha in shas if sha not in commits]
+
+        if missing:
+            loaded = git_log.get_commits(repo, missing)
+            self.put_many(loaded)
+            commits.update((commit['commit'], commit) for commit in loaded)
+
+        return [commits[sha] for sha in shas]
+
+    def put_many(self, commits: List[dict]):
+        for commit in commits:
+            self.memory.put(commit['commit'], commit)
+
+        if commits and self.persistent:
+            self._store(commits)
+
+    def _store(self, commits: List[dict]):
+        shas = [commit['commit'] for commit in commits]
+        stored = {sha for sha, in db.session.query(
+            models.CommitMetadata.sha).filter(
+                models.CommitMetadata.sha.in_(shas))}
+
+        new_rows = [models.CommitMetadata(sha=commit['commit'],
+                                          payload=json.dumps(commit))
+                    for commit in commits if commit['commit'] not in stored]
+
+        if not new_rows:
+            return
+
+        db.session.add_all(new_rows)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request stored the same commits first
+            db.session.rollback()
+            return
+
+        with self._lock:
+            if self._persistent_rows is None:
+                self._persistent_rows = models.CommitMetadata.query.count()
+            else:
+                self._persistent_rows += len(new_rows)
+
+            overflow = self._persistent_rows - self.persistent_size
+
+            if overflow > 0:
+                # evict a tenth of the table at once so eviction does not
+                # run again on every following write
+                evicted = models.CommitMetadata.evict_oldest(
+                    overflow + self.persistent_size // 10)
+                self._persistent_rows -= evicted
+
+    def stats(self) -> dict:
+        return {'memory': self.memory.stats(),
+                'pages': self.pages.stats(),
+                'persistent': {'enabled': self.persistent,
+                               'size': self._persistent_rows,
+                               'max_size': self.persistent_size,
+                               'hits': self.persistent_hits,
+                               'misses': self.persistent_misses}}
+
+
+commit_cache = CommitCache()
@@ -0,0 +1,322 @@
+import base64
+import binascii
+import json
+import logging
+import re
+import threading
+from sqlalchemy import insert, text, update
+from sqlalchemy.exc import IntegrityError
+from typing import Dict, List, Optional, Tuple
+
+from db import db
+from events import event_bus
+from git_repo import repositories, repository
+from models import models
+import git_log
+import git_refs
+
+
+logger = logging.getLogger(__name__)
+
+CREATE_TABLE = text('CREATE VIRTUAL TABLE IF NOT EXISTS commit_search '
+                    'USING fts5(repository UNINDEXED, sha UNINDEXED, '
+                    'author, email, message, datetime UNINDEXED)')
+
+INSERT = text('INSERT INTO commit_search '
+              '(repository, sha, author, email, message, datetime) '
+              'VALUES (:repository, :sha, :author, :email, :message, '
+              ':datetime)')
+
+# rows are only appended, the last rowid identifies a generation of the
+# index
+GENERATION = text('SELECT rowid FROM commit_search '
+                  'ORDER BY rowid DESC LIMIT 1')
+
+# bm25 rank, lower is better, then rowid to break ties. Ranks depend on
+# every row of the table, pages of a search read the same generation
+SEARCH = text('SELECT rowid, sha, author, email, message, datetime, rank '
+              'FROM commit_search '
+              'WHERE commit_search MATCH :query '
+              'AND repository IS :repository '
+              'ORDER BY rank, rowid LIMIT :limit OFFSET :offset')
+
+TERM = re.compile(r'[^\s"]+')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class ExpiredCursor(Exception):
+    pass
+
+
+def encode_cursor(generation: int, offset: int) -> str:
+    """
+    Pack the index generation of a search and the offset of its next page in
+    an url safe token
+    """
+    key = f'{generation}|{offset}'
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    """
+    Unpack a token built by encode_cursor
+    """
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        generation, offset = key.decode().split('|')
+        return int(generation), int(offset)
+    except (binascii.Error, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def match_query(query: str) -> str:
+    """
+    FTS5 query matching every word of query, words ending in * match as a
+    prefix. Words are quoted so FTS5 operators in them are searched as text
+    """
+    terms = []
+
+    for term in TERM.findall(query):
+        word = term.rstrip('*')
+
+        if word:
+            terms.append(f'"{word}"*' if term != word else f'"{word}"')
+
+    return ' '.join(terms)
+
+
+class CommitIndex:
+    """
+    Full-text index of commit messages, author names and emails in an
+    SQLite FTS5 table of the application database.
+
+    The tips it was last updated to are stored by repository, an update only
+    reads the commits reachable from the current branch tips and not from
+    those with one `git log`, so it costs the commits added since and never
+    a walk of the whole history. Commits only reachable from deleted
+    branches stay searchable. The REPO_PATH repository is updated in
+    background whenever a branch moves, the others when they are searched
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self._indexed: Dict[Optional[str], List[str]] = {}
+        self._locks: Dict[Optional[str], threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+        with app.app_context():
+            self.enabled = db.engine.dialect.name == 'sqlite'
+
+            if not self.enabled:
+                logger.warning('Commit search needs an SQLite database')
+                return
+
+            db.session.execute(CREATE_TABLE)
+            db.session.commit()
+
+        if repositories.pool is not None:
+            event_bus.subscribe(self._on_event)
+            self._thread = threading.Thread(target=self._run,
+                                            name='commit-index',
+                                            daemon=True)
+            self._thread.start()
+            self._wake.set()
+
+    def _on_event(self, event: str, data: dict):
+        if event == 'ref' and data['ref'].startswith('refs/heads/'):
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+
+            try:
+                with self.app.app_context():
+                    self.update()
+            except Exception:
+                logger.exception('Commit index update failed')
+
+    def _repository_lock(self, name: Optional[str]) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def update(self, wait: bool = True) -> Optional[int]:
+        """
+        Index the commits added to the repository of the application context
+        since its last update, return how many. When wait is False and
+        another update of the repository is running return None at once
+        """
+        name = repositories.name()
+        lock = self._repository_lock(name)
+
+        if not lock.acquire(blocking=wait):
+            return None
+
+        try:
+            return self._update(name)
+        finally:
+            lock.release()
+
+    def _update(self, name: Optional[str]) -> int:
+        tips = sorted(set(git_refs.branch_tips(repository).values()))
+
+        if self._indexed.get(name) == tips:
+            return 0
+
+        # the lock keeps the threads of this process apart, other processes
+        # are kept out by the compare-and-set of the stored tips
+        while True:
+            state = models.CommitIndexState.get_by_repository(name)
+            stored = state.tips if state is not None else None
+            known = json.loads(stored) if stored is not None else []
+
+            if known == tips:
+                self._indexed[name] = tips
+                return 0
+
+            count = self._index(name, stored, known, tips)
+
+            if count is not None:
+                self._indexed[name] = tips
+                return count
+
+            logger.info('Commit index of %s moved by another worker, '
+                        'reading it again', name or 'REPO_PATH')
+
+    def _index(self,
+               name: Optional[str],
+               stored: Optional[str],
+               known: List[str],
+               tips: List[str]) -> Optional[int]:
+        """
+        Index the commits reachable from tips and not from known and store
+        tips, None when another worker moved the stored tips first.
+
+        Commits come parents first and are written BATCH_SIZE at a time,
+        each batch in a transaction of its own that also stores the commits
+        whose history is then indexed. Other writers wait for one batch at
+        most and an update that stops half way goes on from its last batch
+        """
+        count = 0
+        rows = []
+        # the history of these commits is indexed
+        heads = set(known)
+
+        for commit in git_log.iter_new_commits(repository, tips, known):
+            heads.difference_update(commit['parents'])
+            heads.add(commit['commit'])
+            rows.append({'repository': name,
+                         'sha': commit['commit'],
+                         'author': commit['author'],
+                         'email': commit['email'],
+                         'message': commit['message'],
+                         'datetime': commit['datetime']})
+
+            if len(rows) == self.BATCH_SIZE:
+                stored = self._store(name, stored, sorted(heads), rows)
+
+                if stored is None:
+                    return None
+
+                count += len(rows)
+                rows = []
+
+        if self._store(name, stored, tips, rows) is None:
+            return None
+
+        count += len(rows)
+        logger.info('Indexed %s commits of %s', count, name or 'REPO_PATH')
+        return count
+
+    @staticmethod
+    def _store(name: Optional[str],
+               stored: Optional[str],
+               tips: List[str],
+               rows: List[dict]) -> Optional[str]:
+        """
+        Insert rows and move the stored tips from stored to tips in one
+        transaction, return the tips stored or None when another worker
+        moved them first
+        """
+        table = models.CommitIndexState.__table__
+        value = json.dumps(tips)
+
+        # the state is claimed first, only the worker that moved it inserts
+        # commits
+        try:
+            if stored is None:
+                db.session.execute(insert(table).values(repository=name,
+                                                        tips=value))
+            else:
+                claimed = db.session.execute(update(table).where(
+                    table.c.repository == name,
+                    table.c.tips == stored).values(tips=value))
+
+                if claimed.rowcount != 1:
+                    db.session.rollback()
+                    return None
+        except IntegrityError:
+            db.session.rollback()
+            return None
+
+        if rows:
+            db.session.execute(INSERT, rows)
+
+        db.session.commit()
+        return value
+
+    def search(self,
+               query: str,
+               limit: int,
+               after: Optional[Tuple[int, int]] = None
+               ) -> Tuple[List[dict], Optional[Tuple[int, int]]]:
+        """
+        Commits of the repository of the application context matching every
+        word of query, best ranked first, and the generation and offset of
+        the next page when there are more results. Raise ExpiredCursor when
+        commits were indexed since the first page, as they change the rank
+        of every result
+        """
+        # one read transaction, the generation and the page agree
+        generation = db.session.execute(GENERATION).scalar() or 0
+        offset = 0
+
+        if after is not None:
+            if after[0] != generation:
+                raise ExpiredCursor(after[0])
+
+            offset = after[1]
+
+        rows = db.session.execute(SEARCH, {
+            'query': match_query(query),
+            'repository': repositories.name(),
+            'limit': limit + 1,
+            'offset': offset}).all()
+
+        results = [{'commit': row.sha,
+                    'author': row.author,
+                    'email': row.email,
+                    'message': row.message,
+                    'datetime': row.datetime,
+                    'score': -row.rank}
+                   for row in rows[:limit]]
+
+        if len(rows) <= limit:
+            return results, None
+
+        return results, (generation, offset + limit)
+
+
+commit_index = CommitIndex()
@@ -0,0 +1,142 @@
+from git import Repo
+from typing import Iterator, List, Optional, Tuple
+
+from cache import LRUCache
+import git_diff
+import git_refs
+
+
+class BranchNotFound(LookupError):
+    pass
+
+
+class Comparison:
+    """
+    What a source tip brings to a destiny tip, destiny..source: the commits
+    reachable from source and not from their merge bases. The merge bases
+    and the source tip are its key, they fully determine the commits and the
+    diff
+    """
+
+    def __init__(self, repo: Repo, bases: List[str], source: str):
+        self.repo = repo
+        self.source = source
+        self.bases = bases
+        # like `git diff destiny...source`, the first base with criss-cross
+        # merges
+        self.base = bases[0] if bases else None
+        self.key = (*bases, source)
+
+    def as_dict(self) -> dict:
+        return {'merge_base': self.base, 'source': self.source}
+
+
+class Compare:
+    """
+    Commits, diffstat and diff of pull requests memoized by their merge
+    bases and source tip, which are commits: entries never need
+    invalidation and a pull request is only computed again when one of its
+    branches moves in a way that changes what it brings. The merge bases are
+    memoized by the pair of tips, a repeated view runs no git command.
+
+    Results are capped, to max_commits commits, max_files listed files and
+    max_diff_bytes of diff, and tell when they were truncated. Only diffs
+    read to the end or to the cap are stored
+    """
+
+    def __init__(self):
+        self.max_commits = 250
+        self.max_files = 1000
+        self.max_diff_bytes = 1024 * 1024
+        self.commits = LRUCache()
+        self.diffstats = LRUCache()
+        self.diffs = LRUCache(64)
+        self.merge_bases = LRUCache()
+
+    def init_app(self, app):
+        self.max_commits = app.config['COMPARE_MAX_COMMITS']
+        self.max_files = app.config['COMPARE_MAX_FILES']
+        self.max_diff_bytes = app.config['COMPARE_MAX_DIFF_BYTES']
+        self.commits = LRUCache(app.config['COMPARE_CACHE_SIZE'])
+        self.diffstats = LRUCache(app.config['COMPARE_CACHE_SIZE'])
+        self.diffs = LRUCache(app.config['COMPARE_DIFF_CACHE_SIZE'])
+        self.merge_bases = LRUCache(app.config['COMPARE_CACHE_SIZE'])
+
+    def comparison(self,
+                   repo: Repo,
+                   destiny_branch: str,
+                   source_branch: str) -> Comparison:
+        """
+        Comparison of the current tips of the branches, the merge bases of a
+        pair of tips are computed once
+        """
+        destiny = git_refs.resolve_branch(repo, destiny_branch)
+        source = git_refs.resolve_branch(repo, source_branch)
+
+        for name, sha in ((destiny_branch, destiny), (source_branch, source)):
+            if sha is None:
+                raise BranchNotFound(name)
+
+        bases = self.merge_bases.get((destiny, source))
+
+        if bases is None:
+            bases = git_diff.merge_bases(repo, destiny, source)
+            self.merge_bases.put((destiny, source), bases)
+
+        return Comparison(repo, bases, source)
+
+    def get_commits(self, comparison: Comparison) -> Tuple[List[str], bool]:
+        """
+        SHAs of the commits of comparison, newest first, and whether there
+        were more than max_commits
+        """
+        result = self.commits.get(comparison.key)
+
+        if result is None:
+            result = git_diff.commits(comparison.repo,
+                                      comparison.bases,
+                                      comparison.source,
+                                      self.max_commits)
+            self.commits.put(comparison.key, result)
+
+        return result
+
+    def get_diffstat(self, comparison: Comparison) -> dict:
+        result = self.diffstats.get(comparison.key)
+
+        if result is None:
+            result = git_diff.diffstat(comparison.repo,
+                                       comparison.base,
+                                       comparison.source,
+                                       self.max_files)
+            self.diffstats.put(comparison.key, result)
+
+        return result
+
+    def get_diff(self, comparison: Comparison) -> Optional[bytes]:
+        return self.diffs.get(comparison.key)
+
+    def iter_diff(self, comparison: Comparison) -> Iterator[bytes]:
+        """
+        Stream the diff of comparison from git and store it once complete
+        """
+        chunks = []
+
+        for chunk in git_diff.iter_diff(comparison.repo,
+                                        comparison.base,
+                                        comparison.source,
+                                        self.max_diff_bytes):
+            chunks.append(chunk)
+            yield chunk
+
+        self.diffs.put(comparison.key, b''.join(chunks))
+
+    def stats(self) -> dict:
+        caches = (self.commits, self.diffstats, self.diffs,
+                  self.merge_bases)
+        return {'size': sum(len(cache) for cache in caches),
+                'hits': sum(cache.hits for cache in caches),
+                'misses': sum(cache.misses for cache in caches)}
+
+
+compare = Compare()
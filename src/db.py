@@ -1,4 +1,141 @@
+import logging
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.schema import CreateColumn, CreateIndex
 
 
+logger = logging.getLogger(__name__)
+
 db = SQLAlchemy()
+
+# pool defaults by backend: SQLite connections are cheap files opened in
+# process, server backends cost a server process or thread each
+POOL_DEFAULTS = {
+    'sqlite': {'pool_size': 32, 'max_overflow': 16, 'pool_recycle': -1},
+    'default': {'pool_size': 10, 'max_overflow': 20, 'pool_recycle': 1800},
+}
+
+
+def _in_memory(url) -> bool:
+    return url.database in (None, '', ':memory:')
+
+
+def engine_options(config: dict) -> dict:
+    """
+    Engine and pool options for the backend of SQLALCHEMY_DATABASE_URI, from
+    the DB_* settings or the defaults of the backend
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+
+    if backend == 'sqlite' and _in_memory(url):
+        # a single connection holds the whole database
+        return {}
+
+    defaults = POOL_DEFAULTS.get(backend, POOL_DEFAULTS['default'])
+    options = {'pool_timeout': config['DB_POOL_TIMEOUT']}
+
+    for option in ('pool_size', 'max_overflow', 'pool_recycle'):
+        value = config[f'DB_{option.upper()}']
+        options[option] = defaults[option] if value is None else value
+
+    timeout = config['DB_STATEMENT_TIMEOUT']
+
+    if backend == 'sqlite':
+        # seconds a connection waits for the write lock before failing
+        options['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT']}
+    else:
+        # connections closed by the server are replaced before use
+        options['pool_pre_ping'] = True
+
+    if backend == 'postgresql' and timeout:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={int(timeout * 1000)}'}
+
+    return options
+
+
+def configure_engine(engine: Engine, config: dict):
+    """
+    Session settings each new connection of engine gets. SQLite runs in WAL
+    mode so readers never wait for the writer, MySQL gets the statement
+    timeout PostgreSQL gets from its connect options
+    """
+    statements = []
+    timeout = config['DB_STATEMENT_TIMEOUT']
+
+    if engine.dialect.name == 'sqlite' and not _in_memory(engine.url):
+        if config['SQLITE_WAL']:
+            # with WAL a commit is durable at the next checkpoint, a crash of
+            # the machine may lose the last transactions but never corrupts
+            statements += ['PRAGMA journal_mode=WAL',
+                           'PRAGMA synchronous=NORMAL']
+
+        statements += [f'PRAGMA cache_size=-{config["SQLITE_CACHE_SIZE"]}',
+                       f'PRAGMA mmap_size={config["SQLITE_MMAP_SIZE"]}',
+                       'PRAGMA temp_store=MEMORY']
+    elif engine.dialect.name == 'mysql' and timeout:
+        statements.append(
+            f'SET SESSION max_execution_time={int(timeout * 1000)}')
+
+    if not statements:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+def add_missing_columns(engine: Engine):
+    """
+    Add the columns of the models missing from tables created by an older
+    version, create_all only creates missing tables. Added columns must be
+    nullable or have a server default, the rows already there get it
+    """
+    existing = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not existing.has_table(table.name):
+                continue
+
+            names = {column['name']
+                     for column in existing.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name in names:
+                    continue
+
+                definition = CreateColumn(column).compile(
+                    dialect=engine.dialect)
+                logger.info('Adding column %s to table %s',
+                            column.name, table.name)
+                connection.exec_driver_sql(
+                    f'ALTER TABLE {preparer.format_table(table)} '
+                    f'ADD COLUMN {definition}')
+
+
+def create_missing_indexes(engine: Engine):
+    """
+    Create the indexes of the models missing from tables created by an
+    older version, create_all only creates them along a new table
+    """
+    # reflection skips expression indexes, backends that have it are asked
+    # for CREATE INDEX IF NOT EXISTS instead
+    if_not_exists = engine.dialect.name in ('sqlite', 'postgresql')
+
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if if_not_exists:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+                else:
+                    index.create(connection, checkfirst=True)
@@ -0,0 +1,73 @@
+import itertools
+import logging
+import queue
+import threading
+from typing import Callable, List
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventBus:
+    """
+    Publish server events to in-process subscribers and to the queues of the
+    clients listening to the events endpoint. A client queue that is full is
+    dropped instead of blocking the publisher, the client reconnects
+    """
+
+    def __init__(self, max_pending: int = 1000):
+        self.max_pending = max_pending
+        self._subscribers: List[Callable[[str, dict], None]] = []
+        self._listeners: List[queue.Queue] = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[str, dict], None]):
+        """
+        Call callback(event, data) on every event published
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def listen(self) -> queue.Queue:
+        """
+        Queue receiving (id, event, data) tuples until it is given to
+        unlisten, None is put when the listener is dropped
+        """
+        listener = queue.Queue(self.max_pending)
+
+        with self._lock:
+            self._listeners.append(listener)
+
+        return listener
+
+    def unlisten(self, listener: queue.Queue):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def publish(self, event: str, data: dict):
+        with self._lock:
+            event_id = next(self._ids)
+            subscribers = list(self._subscribers)
+            listeners = list(self._listeners)
+
+        for callback in subscribers:
+            try:
+                callback(event, data)
+            except Exception:
+                logger.exception('Subscriber of %s event failed', event)
+
+        for listener in listeners:
+            try:
+                listener.put_nowait((event_id, event, data))
+            except queue.Full:
+                logger.warning('Dropping event listener that does not read')
+                self.unlisten(listener)
+                # wake the listener up so its stream ends
+                with listener.mutex:
+                    listener.queue.clear()
+                listener.put_nowait(None)
+
+
+event_bus = EventBus()
@@ -0,0 +1,187 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, request
+from typing import Optional
+
+
+class Lane:
+    """
+    Bounded pool for one class of requests: at most workers run at once and
+    at most queue_size wait for a worker, up to timeout seconds. A request
+    that can not wait is rejected instead of making latency grow without
+    limit
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int,
+                 timeout: float):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(workers)
+        self._waiting = 0
+        self._pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Threads of the lane in the ASGI serving mode
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix=f'{self.name}-lane')
+
+            return self._executor
+
+    def acquire(self) -> bool:
+        """
+        Wait for a worker slot, False if the queue is full or the wait timed
+        out
+        """
+        if self._slots.acquire(blocking=False):
+            return True
+
+        with self._lock:
+            if self._waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+
+            self._waiting += 1
+
+        try:
+            acquired = self._slots.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+
+        return acquired
+
+    def release(self):
+        self._slots.release()
+
+    def admit(self) -> bool:
+        """
+        Count a request submitted to the executor, False if workers and
+        queue are full
+        """
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                return False
+
+            self._pending += 1
+            return True
+
+    def done(self):
+        with self._lock:
+            self._pending -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'workers': self.workers,
+                    'queue_size': self.queue_size,
+                    'waiting': self._waiting,
+                    'pending': self._pending,
+                    'rejected': self.rejected}
+
+
+class Executors:
+    """
+    Admission control of requests in two lanes, so slow git walks, diffs
+    and searches never take the workers cheap reads like Branch.get need.
+    Endpoints in HEAVY_ENDPOINTS go to the heavy lane, the exempt ones
+    (event streams, metrics and profiles) to none, every other one to the
+    cheap lane. A request rejected by its lane is answered with 503 and a
+    Retry-After header.
+
+    Under a WSGI server the lane is taken in a before_request hook and held
+    until the response is closed, streams included. In the ASGI serving
+    mode the adapter of asgi.py admits requests before they take a thread
+    and runs them in the threads of their lane
+    """
+
+    EXEMPT_ENDPOINTS = ('events', 'metrics', 'profiles', 'profile')
+    # set by the ASGI adapter on requests it already admitted
+    ENVIRON_KEY = 'guig.lane'
+
+    def __init__(self):
+        self.enabled = False
+        self.retry_after = 1
+        self.heavy_endpoints = frozenset()
+        self.cheap = None
+        self.heavy = None
+
+    def init_app(self, app):
+        self.enabled = app.config['ADMISSION_CONTROL']
+        self.retry_after = app.config['ADMISSION_RETRY_AFTER']
+        self.heavy_endpoints = frozenset(
+            endpoint.strip() for endpoint
+            in app.config['HEAVY_ENDPOINTS'].split(',') if endpoint.strip())
+        timeout = app.config['ADMISSION_TIMEOUT']
+        self.cheap = Lane('cheap', app.config['CHEAP_WORKERS'],
+                          app.config['CHEAP_QUEUE_SIZE'], timeout)
+        self.heavy = Lane('heavy', app.config['HEAVY_WORKERS'],
+                          app.config['HEAVY_QUEUE_SIZE'], timeout)
+
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+            app.teardown_request(self._teardown_request)
+
+    def lane(self, endpoint: Optional[str]) -> Optional[Lane]:
+        """
+        Lane of the requests to endpoint, None when they are exempt
+        """
+        if endpoint in self.EXEMPT_ENDPOINTS:
+            return None
+
+        return self.heavy if endpoint in self.heavy_endpoints else self.cheap
+
+    def busy(self, lane: Lane) -> tuple:
+        return ({'message': f'Too many {lane.name} requests, retry later'},
+                503,
+                {'Retry-After': str(self.retry_after)})
+
+    def _before_request(self):
+        if self.ENVIRON_KEY in request.environ:
+            return
+
+        lane = self.lane(request.endpoint)
+
+        if lane is None:
+            return
+
+        if not lane.acquire():
+            return self.busy(lane)
+
+        g.lane = lane
+
+    def _after_request(self, response):
+        lane = g.pop('lane', None)
+
+        if lane is not None:
+            # streamed responses hold their slot until the last chunk
+            response.call_on_close(lane.release)
+
+        return response
+
+    def _teardown_request(self, exception=None):
+        # the request failed before a response was made
+        lane = g.pop('lane', None)
+
+        if lane is not None:
+            lane.release()
+
+    def stats(self) -> dict:
+        return {'cheap': self.cheap.stats(), 'heavy': self.heavy.stats()}
+
+
+executors = Executors()
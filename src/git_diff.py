@@ -0,0 +1,124 @@
+from git import Repo
+from typing import Iterator, List, Optional, Tuple
+
+
+CHUNK_SIZE = 64 * 1024
+
+TRUNCATED = b'# diff truncated after %d bytes\n'
+
+# histories without a common ancestor are compared to an empty tree
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+
+def merge_bases(repo: Repo, destiny: str, source: str) -> List[str]:
+    """
+    Best common ancestors of the two commits, sorted. destiny..source is
+    exactly the commits reachable from source and not from them
+    """
+    status, output, _ = repo.git.merge_base('--all',
+                                            destiny,
+                                            source,
+                                            with_extended_output=True,
+                                            with_exceptions=False)
+    return sorted(output.split()) if status == 0 else []
+
+
+def commits(repo: Repo,
+            bases: List[str],
+            tip: str,
+            limit: int) -> Tuple[List[str], bool]:
+    """
+    SHAs of up to limit commits reachable from tip and not from bases,
+    newest first, and whether there are more
+    """
+    output = repo.git.rev_list('--date-order',
+                               f'--max-count={limit + 1}',
+                               tip,
+                               '--not',
+                               *bases,
+                               '--')
+    shas = output.split()
+    return shas[:limit], len(shas) > limit
+
+
+def diffstat(repo: Repo,
+             base: Optional[str],
+             tip: str,
+             max_files: int) -> dict:
+    """
+    Lines added and deleted by file between base and tip, the files beyond
+    max_files are counted in the totals but not listed. Binary files have
+    None counts. Without base tip is compared to an empty tree
+    """
+    output = repo.git.diff('--numstat',
+                           '--no-renames',
+                           '-z',
+                           base or EMPTY_TREE,
+                           tip,
+                           '--')
+    files = []
+    additions = deletions = changed = 0
+
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+
+        added, deleted, path = entry.split('\t', 2)
+        binary = added == '-'
+        changed += 1
+
+        if not binary:
+            additions += int(added)
+            deletions += int(deleted)
+
+        if len(files) < max_files:
+            files.append({'path': path,
+                          'additions': None if binary else int(added),
+                          'deletions': None if binary else int(deleted),
+                          'binary': binary})
+
+    return {'files': files,
+            'changed_files': changed,
+            'additions': additions,
+            'deletions': deletions,
+            'truncated': changed > len(files)}
+
+
+def iter_diff(repo: Repo,
+              base: Optional[str],
+              tip: str,
+              max_bytes: int) -> Iterator[bytes]:
+    """
+    Stream the unified diff between base and tip as git writes it. Past
+    max_bytes the diff is cut at the last whole line and a truncation marker
+    is sent instead, git is killed so it does not compute the rest
+    """
+    process = repo.git.diff('--no-renames',
+                            '--no-color',
+                            '--no-ext-diff',
+                            base or EMPTY_TREE,
+                            tip,
+                            '--',
+                            as_process=True)
+    finished = False
+    sent = 0
+
+    try:
+        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+            if sent + len(chunk) > max_bytes:
+                chunk = chunk[:max_bytes - sent]
+                cut = chunk.rfind(b'\n') + 1
+                yield chunk[:cut] if cut else chunk + b'\n'
+                yield TRUNCATED % max_bytes
+                return
+
+            sent += len(chunk)
+            yield chunk
+
+        finished = True
+    finally:
+        if finished:
+            process.wait()
+        else:
+            process.proc.kill()
+            process.proc.wait()
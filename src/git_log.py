@@ -0,0 +1,303 @@
+import base64
+import binascii
+import codecs
+import subprocess
+from git import Repo
+from typing import Iterator, List, Optional, Tuple
+
+
+# control characters git does not use in its own log output, used to split
+# the streamed log into records (RS) and a record into fields (US)
+RECORD_SEPARATOR = '\x1e'
+FIELD_SEPARATOR = '\x1f'
+
+LOG_FORMAT = '%x1e' + '%x1f'.join(('%H', '%an', '%ae', '%cI', '%B')) + '%x1f'
+
+# commit fields and parents without the numstat, for walks that do not need
+# diffs
+SEARCH_FORMAT = '%x1e' + '%x1f'.join(('%H', '%P', '%an', '%ae', '%cI', '%B'))
+
+# side of a symmetric difference, author and author date followed by the
+# numstat, for aggregates of the changes of each author
+CHANGES_FORMAT = '%x1e' + '%x1f'.join(('%m', '%an', '%ae', '%at')) + '%x1f'
+
+CHUNK_SIZE = 64 * 1024
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _parse_record(record: str) -> dict:
+    """
+    Build the commit payload from one raw log record, the numstat lines
+    follow the last field separator
+    """
+    sha, author, email, date, message, numstat = record.split(
+        FIELD_SEPARATOR, 5)
+
+    return {'commit': sha,
+            'author': author,
+            'message': message,
+            'email': email,
+            'files': sum(1 for line in numstat.splitlines() if line),
+            'datetime': date}
+
+
+def encode_cursor(revs: List[str]) -> str:
+    """
+    Pack the commits a walk has to resume from in an url safe token
+    """
+    raw = b''.join(bytes.fromhex(rev) for rev in revs)
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> List[str]:
+    """
+    Unpack a token built by encode_cursor, raise InvalidCursor if the token
+    was not produced by it
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except (binascii.Error, ValueError):
+        raise InvalidCursor(cursor)
+
+    if not raw or len(raw) % 20:
+        raise InvalidCursor(cursor)
+
+    return [raw[i:i + 20].hex() for i in range(0, len(raw), 20)]
+
+
+def iter_records(process, separator: str) -> Iterator[str]:
+    """
+    Split the output of a git process started with as_process=True in
+    records as it arrives. The process is killed if the consumer stops
+    early, so git does not keep writing output nobody reads
+    """
+    finished = False
+
+    try:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buffer = ''
+
+        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+            buffer += decoder.decode(chunk)
+            *records, buffer = buffer.split(separator)
+
+            for record in records:
+                if record:
+                    yield record
+
+        if buffer:
+            yield buffer
+
+        finished = True
+    finally:
+        if finished:
+            process.wait()
+        else:
+            process.proc.kill()
+            process.proc.wait()
+
+
+def _iter_log(repo: Repo, args: List[str]) -> Iterator[dict]:
+    """
+    Stream commits with their changed files count using a single
+    `git log --numstat` process, records are parsed as soon as they arrive so
+    the cost is bounded by the commits consumed and not by the branch history
+    """
+    process = repo.git.log(f'--format={LOG_FORMAT}',
+                           '--numstat',
+                           '--no-renames',
+                           '--diff-merges=first-parent',
+                           *args,
+                           '--',
+                           as_process=True)
+
+    for record in iter_records(process, RECORD_SEPARATOR):
+        yield _parse_record(record)
+
+
+def iter_commits(repo: Repo,
+                 revs: List[str],
+                 max_count: Optional[int] = None) -> Iterator[dict]:
+    """
+    Stream the payload of the commits reachable from revs, newest first
+    """
+    args = ['--date-order']
+
+    if max_count is not None:
+        args.append(f'--max-count={max_count}')
+
+    return _iter_log(repo, args + revs)
+
+
+def get_commits(repo: Repo, shas: List[str]) -> List[dict]:
+    """
+    Payload of the given commits, in the same order, without walking history
+    """
+    return list(_iter_log(repo, ['--no-walk=unsorted', *shas]))
+
+
+def walk(repo: Repo,
+         revs: List[str],
+         limit: int) -> Tuple[List[str], Optional[List[str]]]:
+    """
+    Return the SHAs of up to limit commits reachable from revs and the
+    commits the next page has to start from, or None when history is
+    exhausted. Only the commit graph is read, no diff is computed.
+
+    --date-order never shows a commit before all of its children, so the
+    revs and the parents of this page that were not shown are exactly the
+    tips of the remaining history: a rev the page did not reach, like the
+    tip of an old merged branch, is kept for the next one. With the
+    generation numbers of a commit-graph file (written by `git gc`) git walks
+    them incrementally, so a deep page costs the same as the first one
+    """
+    output = repo.git.rev_list('--date-order',
+                               '--parents',
+                               f'--max-count={limit}',
+                               *revs,
+                               '--')
+    shas = []
+    parents = []
+
+    for line in output.splitlines():
+        sha, *commit_parents = line.split()
+        shas.append(sha)
+        parents.extend(commit_parents)
+
+    seen = set(shas)
+    next_revs = list(dict.fromkeys(rev for rev in revs + parents
+                                   if rev not in seen))
+
+    return shas, next_revs or None
+
+
+def _existing(repo: Repo, shas: List[str]) -> List[str]:
+    """
+    The given commits that are still in the object database, checked with a
+    single `git cat-file --batch-check`
+    """
+    if not shas:
+        return []
+
+    process = repo.git.cat_file('--batch-check=%(objectname) %(objecttype)',
+                                istream=subprocess.PIPE,
+                                as_process=True)
+    stdout, _ = process.proc.communicate(
+        ''.join(f'{sha}\n' for sha in shas).encode())
+
+    return [line.split()[0] for line in stdout.decode().splitlines()
+            if not line.endswith(' missing')]
+
+
+def iter_new_commits(repo: Repo,
+                     tips: List[str],
+                     known: List[str]) -> Iterator[dict]:
+    """
+    Stream commit, parents, author, email, datetime and message of the
+    commits reachable from tips and not from known, parents first, no diff
+    is computed. Revisions are written to git on stdin so thousands of
+    branches fit, known commits that do not exist anymore are left out
+    """
+    if not tips:
+        return
+
+    process = repo.git.log(f'--format={SEARCH_FORMAT}',
+                           '--topo-order',
+                           '--reverse',
+                           '--stdin',
+                           as_process=True,
+                           istream=subprocess.PIPE)
+
+    revs = tips + [f'^{sha}' for sha in _existing(repo, known)]
+    process.proc.stdin.write(''.join(f'{rev}\n' for rev in revs).encode())
+    process.proc.stdin.close()
+
+    for record in iter_records(process, RECORD_SEPARATOR):
+        sha, parents, author, email, date, message = record.split(
+            FIELD_SEPARATOR, 5)
+        yield {'commit': sha,
+               'parents': parents.split(),
+               'author': author,
+               'email': email,
+               'datetime': date,
+               'message': message.strip()}
+
+
+def iter_new_parents(repo: Repo,
+                     tips: List[str],
+                     known: List[str]) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Stream the SHA and parent SHAs of the commits reachable from tips and not
+    from known, parents first. Only the commit graph is read, from the
+    commit-graph file when there is one
+    """
+    if not tips:
+        return
+
+    process = repo.git.rev_list('--topo-order',
+                                '--reverse',
+                                '--parents',
+                                '--stdin',
+                                as_process=True,
+                                istream=subprocess.PIPE)
+
+    revs = tips + [f'^{sha}' for sha in _existing(repo, known)]
+    process.proc.stdin.write(''.join(f'{rev}\n' for rev in revs).encode())
+    process.proc.stdin.close()
+
+    for record in iter_records(process, '\n'):
+        sha, *parents = record.split()
+        yield sha, parents
+
+
+def iter_changes(repo: Repo,
+                 tip: str,
+                 old: Optional[str] = None) -> Iterator[dict]:
+    """
+    Stream author, email, timestamp, files changed and lines added and
+    deleted of the commits reachable from tip and not from old. With old,
+    the commits reachable from old and not from tip follow with removed
+    set, so aggregates of old become those of tip by the commits between
+    them. Merges count with no change, their changes are in the commits
+    they merge
+    """
+    revs = [f'{old}...{tip}', '--left-right'] if old is not None else [tip]
+    process = repo.git.log(f'--format={CHANGES_FORMAT}',
+                           '--numstat',
+                           '--no-diff-merges',
+                           *revs,
+                           '--',
+                           as_process=True)
+
+    for record in iter_records(process, RECORD_SEPARATOR):
+        side, author, email, timestamp, numstat = record.split(
+            FIELD_SEPARATOR, 4)
+        files = additions = deletions = 0
+
+        for line in numstat.splitlines():
+            if not line:
+                continue
+
+            added, deleted, _ = line.split('\t', 2)
+            files += 1
+            # binary files have no line counts
+            additions += int(added) if added != '-' else 0
+            deletions += int(deleted) if deleted != '-' else 0
+
+        yield {'removed': side == '<',
+               'author': author,
+               'email': email,
+               'timestamp': int(timestamp),
+               'files': files,
+               'additions': additions,
+               'deletions': deletions}
+
+
+def exists(repo: Repo, sha: str) -> bool:
+    """
+    Tell if commit sha is still in the object database
+    """
+    return bool(_existing(repo, [sha]))
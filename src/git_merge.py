@@ -0,0 +1,162 @@
+from git import Repo
+from typing import Tuple
+
+import git_refs
+
+
+class MergeError(Exception):
+    pass
+
+
+class MergeConflict(MergeError):
+    pass
+
+
+class BranchMoved(MergeError):
+    pass
+
+
+def _is_ancestor(repo: Repo, ancestor: str, descendant: str) -> bool:
+    status, _, _ = repo.git.merge_base('--is-ancestor',
+                                       ancestor,
+                                       descendant,
+                                       with_extended_output=True,
+                                       with_exceptions=False)
+    return status == 0
+
+
+def _checked_out(repo: Repo, branch: str) -> bool:
+    """
+    Tell if branch is the branch of HEAD in the work tree of repo
+    """
+    if repo.bare:
+        return False
+
+    status, head, _ = repo.git.symbolic_ref('-q', 'HEAD',
+                                            with_extended_output=True,
+                                            with_exceptions=False)
+    return status == 0 and head == f'refs/heads/{branch}'
+
+
+def _read_tree(repo: Repo, old_sha: str, new_sha: str) -> Tuple[int, str]:
+    status, _, stderr = repo.git.read_tree('-m', '-u', old_sha, new_sha,
+                                           with_extended_output=True,
+                                           with_exceptions=False)
+    return status, stderr
+
+
+def _update_branch(repo: Repo, branch: str, new_sha: str, old_sha: str):
+    """
+    Move branch to new_sha only if it still points to old_sha, so a push
+    that happened while the merge was computed is never overwritten.
+
+    When branch is checked out in a non-bare repository its index and work
+    tree are moved along, like a checkout would: files changed locally
+    that the merge touches make it fail before anything is moved
+    """
+    checked_out = _checked_out(repo, branch)
+
+    if checked_out:
+        status, stderr = _read_tree(repo, old_sha, new_sha)
+
+        if status != 0:
+            raise MergeError(f'Branch {branch} is checked out with local '
+                             f'changes the merge would overwrite: {stderr}')
+
+    status, _, stderr = repo.git.update_ref(f'refs/heads/{branch}',
+                                            new_sha,
+                                            old_sha,
+                                            with_extended_output=True,
+                                            with_exceptions=False)
+    if status != 0:
+        if checked_out:
+            # the work tree goes back to the tip that was not moved
+            _read_tree(repo, new_sha, old_sha)
+
+        raise BranchMoved(f'Branch {branch} moved during the merge: {stderr}')
+
+
+def _merge_tree(repo: Repo,
+                destiny: str,
+                source: str) -> Tuple[int, str, str]:
+    return repo.git.merge_tree('--write-tree',
+                               '--name-only',
+                               destiny,
+                               source,
+                               with_extended_output=True,
+                               with_exceptions=False)
+
+
+def mergeability(repo: Repo, source: str, destiny: str) -> dict:
+    """
+    Tell if commit source merges cleanly into commit destiny, which files
+    conflict and how many commits source is ahead and behind destiny. Only
+    objects are written, no branch is moved
+    """
+    counts = repo.git.rev_list('--left-right', '--count',
+                               f'{destiny}...{source}')
+    behind, ahead = (int(count) for count in counts.split())
+    conflicts = []
+
+    if ahead and behind:
+        status, output, stderr = _merge_tree(repo, destiny, source)
+
+        if status not in (0, 1):
+            raise MergeError(stderr)
+
+        # conflicted files follow the tree up to the first empty line
+        conflicts = output.split('\n\n')[0].splitlines()[1:]
+
+    return {'mergeable': not conflicts,
+            'conflicts': conflicts,
+            'ahead': ahead,
+            'behind': behind}
+
+
+def merge(repo: Repo,
+          source_branch: str,
+          destiny_branch: str) -> Tuple[str, str]:
+    """
+    Merge source_branch into destiny_branch without a working tree: the
+    merged tree is written with `git merge-tree --write-tree` and the
+    destiny branch is moved to the merge commit. Only the checkout of a
+    destiny branch checked out in a non-bare repository is updated, so
+    merges on different branches can run at the same time. Return a
+    description of the merge and the new destiny tip
+    """
+    source = git_refs.resolve_branch(repo, source_branch)
+    destiny = git_refs.resolve_branch(repo, destiny_branch)
+
+    for name, sha in ((source_branch, source), (destiny_branch, destiny)):
+        if sha is None:
+            raise MergeError(f'No branch found with id {name}')
+
+    if _is_ancestor(repo, source, destiny):
+        return 'Already up to date.', destiny
+
+    if _is_ancestor(repo, destiny, source):
+        _update_branch(repo, destiny_branch, source, destiny)
+        return f'Fast-forward {destiny[:7]}..{source[:7]}', source
+
+    status, output, stderr = _merge_tree(repo, destiny, source)
+
+    if status == 1:
+        # first line is the tree with conflict markers, then the conflicted
+        # files and the merge messages
+        _, _, conflicts = output.partition('\n')
+        raise MergeConflict(
+            f'Merge was aborted because of conflicts: {conflicts.strip()}')
+
+    if status != 0:
+        raise MergeError(stderr)
+
+    tree = output.splitlines()[0]
+    commit = repo.git.commit_tree(
+        tree,
+        '-p', destiny,
+        '-p', source,
+        '-m', f"Merge branch '{source_branch}' into {destiny_branch}")
+
+    _update_branch(repo, destiny_branch, commit, destiny)
+
+    return f'Merge made with commit {commit}', commit
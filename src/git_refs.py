@@ -0,0 +1,181 @@
+import base64
+import binascii
+import hashlib
+import threading
+from git import Repo
+from git.refs.symbolic import SymbolicReference
+from typing import Dict, Iterator, Optional
+
+from git_log import iter_records
+
+
+BRANCH_FORMAT = '%00'.join(('%(refname:strip=2)',
+                            '%(objectname)',
+                            '%(committerdate:iso-strict)'))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class TipsCache:
+    """
+    Branch tips of one repository kept up to date by the ref watcher, so
+    listings and ETags do not run for-each-ref on every request. It is only
+    read while a watcher feeds it, otherwise and for other repositories the
+    tips are read from git
+    """
+
+    def __init__(self):
+        self._path = None
+        self._tips = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def reset(self, path: Optional[str], tips: Optional[Dict[str, str]]):
+        """
+        Start serving tips of the repository at path, or stop with None
+        """
+        with self._lock:
+            self._path = path
+            self._tips = None if tips is None else dict(tips)
+            self._digest = None
+
+    def update(self, name: str, sha: Optional[str]):
+        """
+        Move one branch, a None sha deletes it
+        """
+        with self._lock:
+            if self._tips is None:
+                return
+
+            # copy on write, readers keep the dict they were given
+            tips = dict(self._tips)
+
+            if sha is None:
+                tips.pop(name, None)
+            else:
+                tips[name] = sha
+
+            self._tips = tips
+            self._digest = None
+
+    def tips(self, path: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            return self._tips if path == self._path else None
+
+    def digest(self, path: str) -> Optional[str]:
+        with self._lock:
+            if path != self._path or self._tips is None:
+                return None
+
+            if self._digest is None:
+                self._digest = _digest(self._tips)
+
+            return self._digest
+
+
+tips_cache = TipsCache()
+
+
+def _digest(tips: Dict[str, str]) -> str:
+    lines = (f'{name} {sha}\n' for name, sha in sorted(tips.items()))
+    return hashlib.sha1(''.join(lines).encode()).hexdigest()
+
+
+def encode_cursor(name: str) -> str:
+    """
+    Pack the last branch name of a page in an url safe token
+    """
+    return base64.urlsafe_b64encode(name.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    Unpack a token built by encode_cursor
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return raw.decode()
+    except (binascii.Error, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def iter_branches(repo: Repo,
+                  prefix: str = '',
+                  after: Optional[str] = None) -> Iterator[dict]:
+    """
+    Stream the branches sorted by name with their tip SHA and committer date
+    from one `git for-each-ref` process, instead of one object lookup per
+    branch. Only branches starting with prefix and sorted after the branch
+    named after are returned.
+
+    for-each-ref patterns only match whole path components, so git is asked
+    for the deepest directory of prefix and the rest is filtered here
+    """
+    directory = prefix.rpartition('/')[0]
+    pattern = f'refs/heads/{directory}/' if directory else 'refs/heads/'
+
+    process = repo.git.for_each_ref(f'--format={BRANCH_FORMAT}',
+                                    '--sort=refname',
+                                    pattern,
+                                    as_process=True)
+
+    for record in iter_records(process, '\n'):
+        name, sha, date = record.split('\0')
+
+        if not name.startswith(prefix) or after is not None and name <= after:
+            continue
+
+        yield {'name': name, 'commit': sha, 'datetime': date}
+
+
+def resolve_branch(repo: Repo, name: str) -> Optional[str]:
+    """
+    Tip SHA of the branch read from the ref files, without listing every
+    head, or None if there is no branch with that name
+    """
+    try:
+        return SymbolicReference.dereference_recursive(repo,
+                                                       f'refs/heads/{name}')
+    except ValueError:
+        return None
+
+
+def ref_tips(repo: Repo) -> Dict[str, str]:
+    """
+    SHA of every ref and of HEAD by full ref name, no object is read
+    """
+    refs = repo.git.for_each_ref('--format=%(refname) %(objectname)')
+    tips = dict(line.rsplit(' ', 1) for line in refs.splitlines())
+
+    try:
+        tips['HEAD'] = SymbolicReference.dereference_recursive(repo, 'HEAD')
+    except ValueError:
+        # unborn HEAD
+        pass
+
+    return tips
+
+
+def branch_tips(repo: Repo) -> Dict[str, str]:
+    """
+    Tip SHA of every branch by name, no commit object is read. The result
+    must not be modified
+    """
+    tips = tips_cache.tips(repo.common_dir)
+
+    if tips is not None:
+        return tips
+
+    refs = repo.git.for_each_ref('--format=%(refname:strip=2) %(objectname)',
+                                 'refs/heads/')
+    return dict(line.rsplit(' ', 1) for line in refs.splitlines())
+
+
+def branches_digest(repo: Repo) -> str:
+    """
+    Digest of every branch name and tip SHA, it changes whenever a branch is
+    created, deleted or moved. No commit object is read to compute it
+    """
+    return tips_cache.digest(repo.common_dir) or _digest(branch_tips(repo))
@@ -1,6 +1,308 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import g
 from git import Repo
+from typing import Iterator, List, Optional
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+from werkzeug.local import LocalProxy
+import logging
 import os
+import re
+import threading
+import time
 
 
-repository = Repo(os.environ.get('REPO_PATH'),
-                  search_parent_directories=True)
+logger = logging.getLogger(__name__)
+
+
+# names of the repositories under REPOS_ROOT, a single directory level
+REPOSITORY_NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9._-]*$')
+
+
+class RepositoryPoolTimeout(ServiceUnavailable):
+    description = 'No repository handle available, try again later'
+
+
+class RepositoryNotFound(NotFound):
+    description = 'No repository found with that name'
+
+
+class RepositoryPool:
+    """
+    Pool of Repo handles on one repository. GitPython keeps one persistent
+    `git cat-file --batch` process per handle and those are not safe to share
+    between threads, so every thread checks out its own handle and object
+    reads scale with the number of handles.
+
+    Handles are checked before being handed out and replaced when one of
+    their cat-file processes died, they are also recycled after max_uses
+    checkouts or max_age seconds
+    """
+
+    def __init__(self,
+                 path: str,
+                 size: int = 8,
+                 timeout: float = 30,
+                 max_uses: int = 1000,
+                 max_age: float = 3600):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.last_used = time.monotonic()
+        self._idle = []
+        self._opened = 0
+        self._closed = False
+        self._available = threading.Condition()
+
+    def _open(self) -> Repo:
+        repo = Repo(self.path, search_parent_directories=True)
+        repo.pool_opened_at = time.monotonic()
+        repo.pool_uses = 0
+
+        try:
+            # start the long lived cat-file processes now, not on first read
+            repo.git.get_object_header('HEAD')
+            repo.git.get_object_data('HEAD')
+        except ValueError:
+            # unborn HEAD, the processes start on first read instead
+            pass
+
+        return repo
+
+    def _discard(self, repo: Optional[Repo]):
+        """
+        Give the slot of a handle back to the pool and close the handle
+        """
+        with self._available:
+            self._opened -= 1
+            self._available.notify()
+
+        if repo is not None:
+            repo.close()
+
+    def _healthy(self, repo: Repo) -> bool:
+        if time.monotonic() - repo.pool_opened_at > self.max_age:
+            return False
+
+        for process in (repo.git.cat_file_all, repo.git.cat_file_header):
+            if process is not None and process.proc.poll() is not None:
+                return False
+
+        return True
+
+    def _take(self, deadline: float) -> Optional[Repo]:
+        """
+        Take an idle handle, or None after reserving the slot of a new one
+        """
+        with self._available:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+
+                if self._opened < self.size:
+                    self._opened += 1
+                    return None
+
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    raise RepositoryPoolTimeout()
+
+                self._available.wait(remaining)
+
+    def acquire(self) -> Repo:
+        """
+        Check out a handle, open a new one while the pool is not full or wait
+        up to timeout for one to be released
+        """
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            repo = self._take(deadline)
+
+            if repo is None:
+                try:
+                    return self._open()
+                except Exception:
+                    self._discard(None)
+                    raise
+
+            if self._healthy(repo):
+                return repo
+
+            logger.info('Recycling repository handle of %s', self.path)
+            self._discard(repo)
+
+    def release(self, repo: Repo):
+        repo.pool_uses += 1
+
+        if self._closed or repo.pool_uses >= self.max_uses:
+            self._discard(repo)
+            return
+
+        with self._available:
+            self._idle.append(repo)
+            self._available.notify()
+
+    @contextmanager
+    def checkout(self) -> Iterator[Repo]:
+        repo = self.acquire()
+
+        try:
+            yield repo
+        finally:
+            self.release(repo)
+
+    def close(self):
+        """
+        Close the idle handles, handles checked out are closed on release
+        """
+        with self._available:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for repo in idle:
+            self._discard(repo)
+
+
+class Repositories:
+    """
+    Give each application context its own handle of a repository pool,
+    taken on first use and given back when the context ends.
+
+    Requests under /repos/<repo> use the repository named repo under
+    REPOS_ROOT, other requests the repository at REPO_PATH. Pools of named
+    repositories are opened on first use, the least recently used are
+    closed once more than max_open are open and any pool unused for
+    idle_timeout seconds is closed on the next lookup
+    """
+
+    def __init__(self):
+        self.pool: Optional[RepositoryPool] = None
+        self.root = None
+        self.max_open = 64
+        self.idle_timeout = 600
+        self.pool_options = {}
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.pool_options = {'size': app.config['REPO_POOL_SIZE'],
+                             'timeout': app.config['REPO_POOL_TIMEOUT'],
+                             'max_uses': app.config['REPO_POOL_MAX_USES'],
+                             'max_age': app.config['REPO_POOL_MAX_AGE']}
+
+        if app.config['REPO_PATH']:
+            self.pool = RepositoryPool(app.config['REPO_PATH'],
+                                       **self.pool_options)
+
+        self.root = app.config['REPOS_ROOT']
+        self.max_open = app.config['REPOS_MAX_OPEN']
+        self.idle_timeout = app.config['REPOS_IDLE_TIMEOUT']
+        app.url_value_preprocessor(self._pop_name)
+        app.teardown_appcontext(self._release)
+
+    def reset(self):
+        """
+        Forget every pool in the child of a fork: the cat-file processes of
+        their handles belong to the parent, reading them from both
+        processes would mix their answers. They are left to the parent
+        """
+        if self.pool is not None:
+            self.pool = RepositoryPool(self.pool.path, **self.pool_options)
+
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pop_name(self, endpoint: Optional[str], values: Optional[dict]):
+        if values and 'repo' in values:
+            self.select(values.pop('repo'))
+
+    def select(self, name: Optional[str]):
+        """
+        Use the repository named name for the rest of the application
+        context, None is the repository at REPO_PATH
+        """
+        g.repository_name = name
+
+    def name(self) -> Optional[str]:
+        """
+        Name of the repository of the application context
+        """
+        return g.get('repository_name')
+
+    def get_pool(self, name: Optional[str] = None) -> RepositoryPool:
+        if name is None:
+            if self.pool is None:
+                raise RepositoryNotFound()
+            return self.pool
+
+        if self.root is None or not REPOSITORY_NAME.match(name):
+            raise RepositoryNotFound()
+
+        now = time.monotonic()
+
+        with self._lock:
+            pool = self._pools.get(name)
+
+            if pool is None:
+                path = os.path.join(self.root, name)
+
+                # a work tree or a bare repository, never a parent of it
+                if not (os.path.isdir(os.path.join(path, '.git'))
+                        or os.path.isfile(os.path.join(path, 'HEAD'))):
+                    raise RepositoryNotFound()
+
+                pool = self._pools[name] = RepositoryPool(path,
+                                                          **self.pool_options)
+            else:
+                self._pools.move_to_end(name)
+
+            pool.last_used = now
+            evicted = self._evict(now)
+
+        for pool_evicted in evicted:
+            logger.info('Closing repository pool of %s', pool_evicted.path)
+            pool_evicted.close()
+
+        return pool
+
+    def _evict(self, now: float) -> List[RepositoryPool]:
+        """
+        Remove the pools over max_open and the idle ones, oldest first
+        """
+        evicted = []
+
+        while len(self._pools) > self.max_open:
+            evicted.append(self._pools.popitem(last=False)[1])
+
+        # the last pool is the one being looked up
+        for name, pool in list(self._pools.items())[:-1]:
+            if now - pool.last_used < self.idle_timeout:
+                break
+
+            evicted.append(self._pools.pop(name))
+
+        return evicted
+
+    def current(self) -> Repo:
+        if 'repository' not in g:
+            pool = self.get_pool(self.name())
+            g.repository = pool.acquire()
+            g.repository_pool = pool
+
+        return g.repository
+
+    def _release(self, exception=None):
+        repo = g.pop('repository', None)
+
+        if repo is not None:
+            g.pop('repository_pool').release(repo)
+
+
+repositories = Repositories()
+
+# handle of the current application context, it can be used as a Repo
+repository = LocalProxy(repositories.current)
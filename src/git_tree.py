@@ -0,0 +1,170 @@
+from git import Repo
+from typing import Iterator, List, Optional
+
+from cache import LRUCache
+
+
+CHUNK_SIZE = 64 * 1024
+
+# blobs up to this size are read from the persistent cat-file process, the
+# bytes a range leaves out are drained to keep it in sync. Bigger ones get
+# a process of their own that can be killed instead
+PIPE_MAX_SIZE = 1024 * 1024
+
+
+def _ls_tree(repo: Repo, sha: str) -> List[dict]:
+    """
+    Entries of tree sha with the size of their blobs, from one
+    `git ls-tree -l`
+    """
+    output = repo.git.ls_tree('-z', '-l', sha)
+    entries = []
+
+    for record in output.split('\0'):
+        if not record:
+            continue
+
+        info, name = record.split('\t', 1)
+        mode, kind, entry_sha, size = info.split()
+        entries.append({'name': name,
+                        'type': kind,
+                        'mode': mode,
+                        'sha': entry_sha,
+                        'size': None if size == '-' else int(size)})
+
+    return entries
+
+
+class Trees:
+    """
+    Tree listings cached by tree SHA in a bounded LRU. Trees are immutable
+    and shared by every commit that did not touch them, so entries never
+    need invalidation and a path is resolved from cached listings down to
+    the first tree changed since it was last read
+    """
+
+    def __init__(self):
+        self.cache = LRUCache()
+
+    def init_app(self, app):
+        self.cache = LRUCache(app.config['TREE_CACHE_SIZE'])
+
+    def entries(self, repo: Repo, sha: str) -> List[dict]:
+        """
+        Entries of tree sha sorted by name. The result is shared, it must
+        not be modified
+        """
+        entries = self.cache.get(sha)
+
+        if entries is None:
+            entries = _ls_tree(repo, sha)
+            self.cache.put(sha, entries)
+
+        return entries
+
+    def lookup(self, repo: Repo, commit: str, path: str) -> Optional[dict]:
+        """
+        Entry at path in the tree of commit, the root tree for an empty path,
+        None if there is nothing at path
+        """
+        entry = {'name': '',
+                 'type': 'tree',
+                 'mode': '040000',
+                 'sha': repo.commit(commit).tree.hexsha,
+                 'size': None}
+
+        for name in filter(None, path.split('/')):
+            if entry['type'] != 'tree':
+                return None
+
+            entry = next((child for child in self.entries(repo, entry['sha'])
+                          if child['name'] == name), None)
+
+            if entry is None:
+                return None
+
+        return entry
+
+
+trees = Trees()
+
+
+def _drain(stream, size: int):
+    while size > 0:
+        chunk = stream.read(min(size, CHUNK_SIZE))
+
+        if not chunk:
+            break
+
+        size -= len(chunk)
+
+
+def _iter_pipe(repo: Repo,
+               sha: str,
+               start: int,
+               stop: int) -> Iterator[bytes]:
+    _, _, size, stream = repo.git.stream_object_data(sha)
+    sent = start
+
+    try:
+        _drain(stream, start)
+
+        while sent < stop:
+            chunk = stream.read(min(stop - sent, CHUNK_SIZE))
+
+            if not chunk:
+                break
+
+            sent += len(chunk)
+            yield chunk
+    finally:
+        # the next object read from the pipe starts after this one
+        _drain(stream, size - sent)
+
+
+def _iter_process(repo: Repo,
+                  sha: str,
+                  size: int,
+                  start: int,
+                  stop: int) -> Iterator[bytes]:
+    process = repo.git.cat_file('blob', sha, as_process=True)
+    position = 0
+
+    try:
+        while position < stop:
+            chunk = process.stdout.read(CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            begin = max(start - position, 0)
+            end = min(stop - position, len(chunk))
+            position += len(chunk)
+
+            if begin < end:
+                yield chunk[begin:end]
+    finally:
+        if position >= size:
+            process.wait()
+        else:
+            # git would write the rest of the blob for nothing
+            process.proc.kill()
+            process.proc.wait()
+
+
+def iter_blob(repo: Repo,
+              sha: str,
+              size: int,
+              start: int = 0,
+              stop: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Stream bytes start to stop of blob sha in chunks, the blob is never
+    held in memory. Pipes can not seek, the bytes before start are read and
+    discarded
+    """
+    stop = size if stop is None else stop
+
+    if size <= PIPE_MAX_SIZE:
+        return _iter_pipe(repo, sha, start, stop)
+
+    return _iter_process(repo, sha, size, start, stop)
@@ -0,0 +1,39 @@
+import hashlib
+from flask import Response, request
+from typing import Optional
+
+
+# responses addressed by an object SHA never change
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def etag(*parts) -> str:
+    """
+    Strong validator for a response fully determined by parts
+    """
+    digest = hashlib.sha1('\0'.join(str(part) for part in parts).encode())
+    return digest.hexdigest()
+
+
+def headers(tag: str, cache_control: Optional[str] = None) -> dict:
+    """
+    Caching headers to send along the response validated by tag
+    """
+    result = {'ETag': f'"{tag}"'}
+
+    if cache_control:
+        result['Cache-Control'] = cache_control
+
+    return result
+
+
+def not_modified(tag: str,
+                 cache_control: Optional[str] = None) -> Optional[Response]:
+    """
+    Empty 304 response when the client already has the representation
+    validated by tag, None when the response has to be built
+    """
+    if not request.if_none_match.contains_weak(tag):
+        return None
+
+    return Response(status=304, headers=headers(tag, cache_control))
@@ -0,0 +1,254 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from typing import Optional, Tuple, Union
+
+from db import db
+from events import event_bus
+from git_repo import repositories, repository
+from mergeability import mergeability_worker
+from models import models
+import git_merge
+
+
+logger = logging.getLogger(__name__)
+
+
+class AlreadyQueued(Exception):
+    pass
+
+
+def _owner() -> str:
+    """
+    host:pid of this process, computed on use so children of a fork get
+    their own
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # a process of another user
+        return True
+
+    return True
+
+
+class MergeQueue:
+    """
+    Run pull request merges in a pool of worker threads. Merges into the
+    same destiny branch of a repository run one after the other in a lane,
+    lanes of different destiny branches run in parallel.
+
+    Jobs are stored in the merge_jobs table so they can be polled from any
+    worker process, and the unique pending column keeps two processes from
+    queueing the same pull request. A job runs in the process that queued
+    it, merges into the same branch from different processes are kept
+    apart by the compare-and-set of the branch and retried. Finished jobs
+    are kept for polling, the oldest ones are dropped once there are more
+    than max_jobs
+    """
+
+    # attempts of a merge whose destiny branch another process moved
+    MAX_ATTEMPTS = 3
+
+    def __init__(self):
+        self.app = None
+        self.max_jobs = 1000
+        self._executor = None
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.max_jobs = app.config['MERGE_QUEUE_MAX_JOBS']
+        self._executor = ThreadPoolExecutor(app.config['MERGE_WORKERS'],
+                                            thread_name_prefix='merge')
+
+    def submit(self, pull_request: models.PullRequest) -> models.MergeJob:
+        """
+        Queue the merge of pull_request, raise AlreadyQueued if a merge of
+        the same pull request is waiting or running in any process
+        """
+        job = self._insert(pull_request)
+
+        if job is None and self._release_abandoned(pull_request.id):
+            job = self._insert(pull_request)
+
+        if job is None:
+            raise AlreadyQueued(pull_request.id)
+
+        models.MergeJob.evict_finished(self.max_jobs)
+
+        with self._lock:
+            key = (job.repository, job.destiny_branch)
+            lane = self._lanes.setdefault(key, deque())
+            lane.append(job.id)
+
+            if len(lane) == 1:
+                self._executor.submit(self._run_lane, key)
+
+        return job
+
+    @staticmethod
+    def _insert(pull_request: models.PullRequest
+                ) -> Optional[models.MergeJob]:
+        job = models.MergeJob(id=uuid.uuid4().hex,
+                              pull_request_id=pull_request.id,
+                              pending=pull_request.id,
+                              repository=pull_request.repository,
+                              destiny_branch=pull_request.destiny_branch,
+                              status=models.MergeJob.QUEUED,
+                              owner=_owner())
+
+        try:
+            db.session.add(job)
+            db.session.commit()
+        except IntegrityError:
+            # another unfinished job holds the pull request
+            db.session.rollback()
+            return None
+
+        return job
+
+    def _release_abandoned(self, pull_request_id: int) -> bool:
+        """
+        Fail the unfinished job of the pull request when the process that
+        queued it on this host is gone, return if the pull request is free
+        """
+        job = models.MergeJob.get_pending(pull_request_id)
+
+        if job is None:
+            return True
+
+        host, _, pid = job.owner.rpartition(':')
+
+        if host != socket.gethostname():
+            return False
+
+        if int(pid) == os.getpid():
+            # the pid of a process that exited, reused by this one
+            with self._lock:
+                abandoned = not any(job.id in lane
+                                    for lane in self._lanes.values())
+        else:
+            abandoned = not _alive(int(pid))
+
+        if not abandoned:
+            return False
+
+        logger.warning('Merge job %s abandoned by process %s', job.id, pid)
+        return self._finish(job.id, models.MergeJob.FAILED,
+                            'The process running the merge exited')
+
+    def get(self, job_id: str) -> Union[models.MergeJob, None]:
+        return models.MergeJob.get_by_id(job_id)
+
+    @staticmethod
+    def _finish(job_id: str,
+                status: str,
+                message: str,
+                commit: str = None) -> bool:
+        """
+        Store the outcome of an unfinished job and publish it, False if the
+        job had already finished
+        """
+        finished = models.MergeJob.query.filter(
+            models.MergeJob.id == job_id,
+            models.MergeJob.pending.isnot(None)).update(
+            {'status': status,
+             'message': message,
+             'commit': commit,
+             'pending': None,
+             'finished_at': datetime.utcnow()},
+            synchronize_session=False)
+        db.session.commit()
+
+        if finished:
+            event_bus.publish('merge-job',
+                              models.MergeJob.get_by_id(job_id).as_dict())
+
+        return bool(finished)
+
+    def _run_lane(self, key: Tuple[Optional[str], str]):
+        """
+        Merge the jobs of one repository and destiny branch until its lane
+        is empty
+        """
+        while True:
+            with self._lock:
+                job_id = self._lanes[key][0]
+
+            with self.app.app_context():
+                try:
+                    self._merge(job_id)
+                except Exception as ex:
+                    logger.exception('Merge job %s failed', job_id)
+                    db.session.rollback()
+                    self._finish(job_id, models.MergeJob.FAILED, str(ex))
+
+            with self._lock:
+                lane = self._lanes[key]
+                lane.popleft()
+
+                if not lane:
+                    del self._lanes[key]
+                    return
+
+    def _merge(self, job_id: str):
+        job = models.MergeJob.get_by_id(job_id)
+
+        if job is None or job.pending is None:
+            # finished as abandoned meanwhile
+            return
+
+        job.status = models.MergeJob.RUNNING
+        db.session.commit()
+
+        repositories.select(job.repository)
+        pull_request = models.PullRequest.get_by_id(job.pull_request_id,
+                                                    job.repository)
+
+        if pull_request.status != models.PullRequest.OPEN:
+            self._finish(job_id, models.MergeJob.FAILED,
+                         'Cannot merge a pull request with status '
+                         f'{pull_request.status}')
+            return
+
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            try:
+                message, commit = git_merge.merge(repository,
+                                                  pull_request.source_branch,
+                                                  pull_request.destiny_branch)
+                break
+            except git_merge.BranchMoved as err:
+                # another process merged into the branch, merge again on
+                # top of it
+                if attempt == self.MAX_ATTEMPTS:
+                    self._finish(job_id, models.MergeJob.FAILED, str(err))
+                    return
+            except git_merge.MergeError as err:
+                self._finish(job_id, models.MergeJob.FAILED, str(err))
+                return
+
+        pull_request.status = models.PullRequest.MERGED
+        pull_request.commit = commit
+        pull_request.create_or_update()
+        event_bus.publish('pull-request', pull_request.as_dict())
+
+        self._finish(job_id, models.MergeJob.SUCCEEDED, message, commit)
+        # the destiny branch moved, pull requests into it changed
+        mergeability_worker.wake()
+
+
+merge_queue = MergeQueue()
@@ -0,0 +1,143 @@
+import logging
+import threading
+from sqlalchemy.engine import Row
+from typing import Dict, Optional, Union
+
+from cache import LRUCache
+from db import db
+from events import event_bus
+from git_repo import RepositoryNotFound, repositories, repository
+from models import models
+import git_merge
+import git_refs
+
+
+logger = logging.getLogger(__name__)
+
+
+def unknown(reason: str) -> dict:
+    """
+    Mergeability of a pull request that cannot be computed
+    """
+    return {'mergeable': None,
+            'conflicts': [],
+            'ahead': None,
+            'behind': None,
+            'reason': reason}
+
+
+class MergeabilityWorker:
+    """
+    Background thread computing conflict status and ahead/behind counts of
+    every open pull request. Results are cached by the pair of source and
+    destiny tip SHAs, a pull request is only computed again when one of its
+    tips moves. The worker runs every interval seconds or as soon as it is
+    woken up, by a new pull request or a branch update
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 30
+        self.cache = LRUCache()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['MERGEABILITY_INTERVAL']
+        self.cache = LRUCache(app.config['MERGEABILITY_CACHE_SIZE'])
+        self._thread = threading.Thread(target=self._run,
+                                        name='mergeability',
+                                        daemon=True)
+        self._thread.start()
+        event_bus.subscribe(self._on_event)
+
+    def wake(self):
+        self._wake.set()
+
+    def _on_event(self, event: str, data: dict):
+        if event == 'ref' and data['ref'].startswith('refs/heads/'):
+            self.wake()
+
+    def get(self,
+            pull_request: Union[models.PullRequest, Row],
+            tips: Dict[str, str]) -> Optional[dict]:
+        """
+        Cached mergeability of an open pull request for the current branch
+        tips, None if it is not open or not computed yet. A pull request
+        with a deleted branch, or one that cannot be merged, reports
+        mergeable null with the reason and does not wake the worker
+        """
+        if pull_request.status != models.PullRequest.OPEN:
+            return None
+
+        for branch in (pull_request.source_branch,
+                       pull_request.destiny_branch):
+            if branch not in tips:
+                return unknown(f'Branch {branch} not found')
+
+        key = (tips[pull_request.source_branch],
+               tips[pull_request.destiny_branch])
+        result = self.cache.get(key)
+
+        if result is None:
+            self.wake()
+
+        return result
+
+    def _run(self):
+        while True:
+            try:
+                self._refresh()
+            except Exception:
+                logger.exception('Mergeability refresh failed')
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _refresh(self):
+        with self.app.app_context():
+            branches = db.session.query(
+                models.PullRequest.repository,
+                models.PullRequest.source_branch,
+                models.PullRequest.destiny_branch
+            ).filter_by(status=models.PullRequest.OPEN).distinct().all()
+
+        by_repository = {}
+
+        for name, source_branch, destiny_branch in branches:
+            by_repository.setdefault(name, []).append((source_branch,
+                                                       destiny_branch))
+
+        for name, pairs in by_repository.items():
+            # one context per repository, each holds its own handle
+            with self.app.app_context():
+                repositories.select(name)
+
+                try:
+                    self._refresh_repository(pairs)
+                except RepositoryNotFound:
+                    logger.warning('Repository %s of open pull requests '
+                                   'not found', name)
+
+    def _refresh_repository(self, pairs: list):
+        tips = git_refs.branch_tips(repository)
+
+        for source_branch, destiny_branch in pairs:
+            key = (tips.get(source_branch), tips.get(destiny_branch))
+
+            if None in key or key in self.cache:
+                continue
+
+            try:
+                result = git_merge.mergeability(repository, *key)
+            except git_merge.MergeError as err:
+                logger.exception('Cannot compute mergeability of %s into %s',
+                                 source_branch, destiny_branch)
+                # cached for these tips so it is not computed again
+                result = unknown(str(err))
+
+            self.cache.put(key, result)
+
+
+mergeability_worker = MergeabilityWorker()
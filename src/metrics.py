@@ -0,0 +1,412 @@
+import bisect
+import threading
+import time
+from flask import g, has_request_context, request
+from git import Git, Repo
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+
+def _escape(value: str) -> str:
+    return (value.replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(names: Tuple[str, ...], values: tuple) -> str:
+    pairs = (f'{name}="{_escape(str(value))}"'
+             for name, value in zip(names, values))
+    return ','.join(pairs)
+
+
+def _series(name: str, labels: str) -> str:
+    return f'{name}{{{labels}}}' if labels else name
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic counter by label values
+    """
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+
+        with self._lock:
+            values = list(self._values.items())
+
+        for labels, value in values:
+            series = _series(self.name, _labels(self.labels, labels))
+            yield f'{series} {_number(value)}'
+
+
+class Histogram:
+    """
+    Cumulative histogram by label values, one bisect and one lock per
+    observation
+    """
+
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket and +Inf, sum]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(labels)
+
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+
+            counts[index] += 1
+            counts[-1] += value
+
+    def expose(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+
+        with self._lock:
+            values = [(labels, list(counts))
+                      for labels, counts in self._values.items()]
+
+        for labels, counts in values:
+            names = _labels(self.labels, labels)
+            total = 0
+
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                bucket = ','.join(filter(None, (names,
+                                                f'le="{_number(bound)}"')))
+                yield f'{self.name}_bucket{{{bucket}}} {total}'
+
+            yield (f'{_series(self.name + "_sum", names)} '
+                   f'{_number(counts[-1])}')
+            yield f'{_series(self.name + "_count", names)} {total}'
+
+
+class RequestStats:
+    """
+    Git and database work done while serving one request
+    """
+
+    __slots__ = ('git_commands', 'git_seconds', 'cat_file_reads',
+                 'cat_file_seconds', 'db_queries', 'db_seconds')
+
+    def __init__(self):
+        self.git_commands = 0
+        self.git_seconds = 0.0
+        self.cat_file_reads = 0
+        self.cat_file_seconds = 0.0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+
+def _request_stats() -> Optional[RequestStats]:
+    if has_request_context():
+        return g.get('request_stats')
+
+    return None
+
+
+def _subcommand(command) -> str:
+    """
+    Name of the git command run by a GitPython command line
+    """
+    if isinstance(command, str):
+        command = command.split()
+
+    args = iter(command[1:])
+
+    for arg in args:
+        if arg in ('-c', '-C'):
+            # global option with a value
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+
+    return 'git'
+
+
+class InstrumentedGit(Git):
+    """
+    Git command wrapper timing every subprocess run and every object read
+    from the persistent cat-file processes
+    """
+
+    def execute(self, command, *args, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            return super().execute(command, *args, **kwargs)
+        finally:
+            metrics.git_command(_subcommand(command),
+                                time.perf_counter() - start)
+
+    def get_object_header(self, ref):
+        start = time.perf_counter()
+
+        try:
+            return super().get_object_header(ref)
+        finally:
+            metrics.cat_file_read(time.perf_counter() - start)
+
+    def get_object_data(self, ref):
+        start = time.perf_counter()
+
+        try:
+            return super().get_object_data(ref)
+        finally:
+            metrics.cat_file_read(time.perf_counter() - start)
+
+    def stream_object_data(self, ref):
+        start = time.perf_counter()
+
+        try:
+            return super().stream_object_data(ref)
+        finally:
+            metrics.cat_file_read(time.perf_counter() - start)
+
+
+class Metrics:
+    """
+    Request latency by endpoint, git and database work by request and cache
+    hit ratios, exposed in the Prometheus text format.
+
+    Latency is measured until the response is closed, so streamed responses
+    count their whole stream. Git commands are counted by installing
+    InstrumentedGit as the command wrapper of every Repo opened afterwards,
+    commands streamed from their process only count the time to start it.
+    Queries are timed through SQLAlchemy engine events
+    """
+
+    def __init__(self):
+        self.requests = Histogram(
+            'http_request_duration_seconds',
+            'Time to serve a request until its response is closed',
+            ('endpoint', 'method', 'status'))
+        self.git_commands = Histogram(
+            'git_command_duration_seconds',
+            'Time to run a git subprocess',
+            ('command',))
+        self.cat_file_reads = Histogram(
+            'git_cat_file_read_duration_seconds',
+            'Time to read an object from a persistent cat-file process')
+        self.db_queries = Histogram(
+            'db_query_duration_seconds',
+            'Time to run a database statement')
+        self.request_git_commands = Histogram(
+            'http_request_git_commands',
+            'Git subprocesses run by a request',
+            ('endpoint',),
+            COUNT_BUCKETS)
+        self.request_git_seconds = Histogram(
+            'http_request_git_seconds',
+            'Time spent in git subprocesses by a request',
+            ('endpoint',))
+        self.request_cat_file_reads = Histogram(
+            'http_request_cat_file_reads',
+            'Objects read from cat-file processes by a request',
+            ('endpoint',),
+            COUNT_BUCKETS)
+        self.request_cat_file_seconds = Histogram(
+            'http_request_cat_file_seconds',
+            'Time spent reading objects from cat-file by a request',
+            ('endpoint',))
+        self.request_db_queries = Histogram(
+            'http_request_db_queries',
+            'Database statements run by a request',
+            ('endpoint',),
+            COUNT_BUCKETS)
+        self.request_db_seconds = Histogram(
+            'http_request_db_seconds',
+            'Time spent in database statements by a request',
+            ('endpoint',))
+        self.errors = Counter('http_request_exceptions_total',
+                              'Requests that raised an exception',
+                              ('endpoint',))
+        self._caches: Dict[str, Callable[[], dict]] = {}
+        self._startup: Optional[Tuple[float, float]] = None
+
+    def init_app(self, app):
+        Repo.GitCommandWrapperType = InstrumentedGit
+        event.listen(Engine, 'before_cursor_execute', self._before_query)
+        event.listen(Engine, 'after_cursor_execute', self._after_query)
+        event.listen(Engine, 'handle_error', self._query_error)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def register_cache(self, name: str, stats: Callable[[], dict]):
+        """
+        Expose the hits, misses and size returned by stats as cache name
+        """
+        self._caches[name] = stats
+
+    def startup(self, seconds: float, warm_up_seconds: float):
+        """
+        Record how long the process took to be ready to serve since it
+        started or was forked, warm up included
+        """
+        self._startup = (seconds, warm_up_seconds)
+
+    def git_command(self, command: str, seconds: float):
+        self.git_commands.observe((command,), seconds)
+        stats = _request_stats()
+
+        if stats is not None:
+            stats.git_commands += 1
+            stats.git_seconds += seconds
+
+    def cat_file_read(self, seconds: float):
+        self.cat_file_reads.observe((), seconds)
+        stats = _request_stats()
+
+        if stats is not None:
+            stats.cat_file_reads += 1
+            stats.cat_file_seconds += seconds
+
+    def _before_query(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        self.db_queries.observe((), seconds)
+        stats = _request_stats()
+
+        if stats is not None:
+            stats.db_queries += 1
+            stats.db_seconds += seconds
+
+    def _query_error(self, exception_context):
+        # a failed query has no after_cursor_execute, observe it here so its
+        # start does not stay on the connection
+        conn = exception_context.connection
+
+        if conn is not None and conn.info.get('query_start'):
+            seconds = time.perf_counter() - conn.info['query_start'].pop()
+            self.db_queries.observe((), seconds)
+
+    def _before_request(self):
+        g.request_start = time.perf_counter()
+        g.request_stats = RequestStats()
+
+    def _after_request(self, response):
+        endpoint = request.endpoint or 'none'
+        labels = (endpoint, request.method, str(response.status_code))
+        start = g.get('request_start', time.perf_counter())
+        stats = g.get('request_stats') or RequestStats()
+
+        response.call_on_close(
+            lambda: self._finish(labels, start, stats))
+        return response
+
+    def _teardown_request(self, exception=None):
+        if exception is not None:
+            self.errors.inc((request.endpoint or 'none',))
+
+    def _finish(self,
+                labels: Tuple[str, str, str],
+                start: float,
+                stats: RequestStats):
+        endpoint = (labels[0],)
+        self.requests.observe(labels, time.perf_counter() - start)
+        self.request_git_commands.observe(endpoint, stats.git_commands)
+        self.request_git_seconds.observe(endpoint, stats.git_seconds)
+        self.request_cat_file_reads.observe(endpoint, stats.cat_file_reads)
+        self.request_cat_file_seconds.observe(endpoint,
+                                              stats.cat_file_seconds)
+        self.request_db_queries.observe(endpoint, stats.db_queries)
+        self.request_db_seconds.observe(endpoint, stats.db_seconds)
+
+    def _expose_caches(self) -> Iterable[str]:
+        caches = [(name, stats()) for name, stats in self._caches.items()]
+        families = (('cache_hits_total', 'counter', 'Cache lookups found',
+                     lambda stats: stats['hits']),
+                    ('cache_misses_total', 'counter', 'Cache lookups missed',
+                     lambda stats: stats['misses']),
+                    ('cache_size', 'gauge', 'Entries in the cache',
+                     lambda stats: stats['size']),
+                    ('cache_hit_ratio', 'gauge', 'Share of lookups found',
+                     lambda stats: (stats['hits']
+                                    / max(stats['hits'] + stats['misses'],
+                                          1))))
+
+        for name, kind, help, value in families:
+            yield f'# HELP {name} {help}'
+            yield f'# TYPE {name} {kind}'
+
+            for cache, stats in caches:
+                if stats.get('size') is None and name == 'cache_size':
+                    continue
+
+                series = _series(name, _labels(('cache',), (cache,)))
+                yield f'{series} {_number(value(stats))}'
+
+    def _expose_startup(self) -> Iterable[str]:
+        if self._startup is None:
+            return
+
+        families = (('process_cold_start_seconds',
+                     'Time from the start or fork of the process until it '
+                     'was ready to serve'),
+                    ('process_warm_up_seconds',
+                     'Part of the cold start spent warming up caches'))
+
+        for (name, help), value in zip(families, self._startup):
+            yield f'# HELP {name} {help}'
+            yield f'# TYPE {name} gauge'
+            yield f'{name} {_number(value)}'
+
+    def expose(self) -> str:
+        lines: List[str] = []
+
+        for metric in (self.requests, self.errors, self.git_commands,
+                       self.cat_file_reads, self.db_queries,
+                       self.request_git_commands, self.request_git_seconds,
+                       self.request_cat_file_reads,
+                       self.request_cat_file_seconds,
+                       self.request_db_queries, self.request_db_seconds):
+            lines.extend(metric.expose())
+
+        lines.extend(self._expose_caches())
+        lines.extend(self._expose_startup())
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -1,14 +1,33 @@
 from __future__ import annotations
 from db import db
 from datetime import datetime
-from typing import Union
+from sqlalchemy.engine import Row
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 
 class PullRequest(db.Model):
 
     __tablename__ = 'pull_requests'
 
+    # listings are scoped to a repository and sorted by (created_at, id),
+    # each filter gets an index between them so a filtered page is a single
+    # index range
+    __table_args__ = (
+        db.Index('ix_pull_requests_repository_created_at_id',
+                 'repository', 'created_at', 'id'),
+        db.Index('ix_pull_requests_repository_status_created_at_id',
+                 'repository', 'status', 'created_at', 'id'),
+        db.Index('ix_pull_requests_repository_author_created_at_id',
+                 'repository', 'author', 'created_at', 'id'),
+        db.Index('ix_pull_requests_repository_source_branch_created_at_id',
+                 'repository', 'source_branch', 'created_at', 'id'),
+        db.Index('ix_pull_requests_repository_destiny_branch_created_at_id',
+                 'repository', 'destiny_branch', 'created_at', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    # name of the repository under REPOS_ROOT, None for REPO_PATH
+    repository = db.Column(db.String(255), nullable=True)
     title = db.Column(db.String(80))
     description = db.Column(db.String(255))
     status = db.Column(db.String(10))
@@ -16,13 +35,17 @@ class PullRequest(db.Model):
     source_branch = db.Column(db.String(200))
     destiny_branch = db.Column(db.String(200))
     commit = db.Column(db.String(50))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow())
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # status
     OPEN = 'open'
     CLOSED = 'closed'
     MERGED = 'merged'
 
+    FIELDS = ('id', 'repository', 'title', 'description', 'status', 'author',
+              'source_branch', 'destiny_branch', 'commit', 'created_at')
+    FILTERS = ('status', 'author', 'source_branch', 'destiny_branch')
+
     def __repr__(self):
         return f'<PullRequest( {self.id}, {self.title}, {self.status})>'
 
@@ -33,29 +56,322 @@ class PullRequest(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    @classmethod
+    def create_or_update_all(cls, pull_requests: List[PullRequest]):
+        """
+        Store every pull request in db in one transaction
+        """
+        db.session.add_all(pull_requests)
+        db.session.flush()
+        ids = [pull_request.id for pull_request in pull_requests]
+        db.session.commit()
+        # the commit expired them, one query loads them all again instead of
+        # one per pull request read
+        cls.query.filter(cls.id.in_(ids)).all()
+
+    def as_dict(self, fields: Optional[Iterable[str]] = None) -> dict:
+        """
+        Pull request restricted to fields
+        """
+        return self.serialize(self, fields)
+
+    @classmethod
+    def serialize(cls,
+                  record: Union[PullRequest, Row],
+                  fields: Optional[Iterable[str]] = None) -> dict:
+        """
+        Pull request or row of a listing restricted to fields, only their
+        columns are read so rows loaded with a projection are not refreshed
+        """
+        result = {field: getattr(record, field)
+                  for field in (cls.FIELDS if fields is None else fields)}
+
+        if result.get('created_at') is not None:
+            result['created_at'] = result['created_at'].isoformat()
+
+        return result
+
+    @classmethod
+    def _listing(cls,
+                 repository: Optional[str],
+                 after: Optional[Tuple[datetime, int]],
+                 fields: Optional[Iterable[str]],
+                 filters: dict):
+        """
+        Select of the pull requests of repository sorted by (created_at, id)
+        after the given key, with only the requested columns and the sort
+        key. Listings read plain rows: no object is built, tracked by the
+        session or refreshed
+        """
+        columns = (cls.FIELDS if fields is None
+                   else set(fields) | {'id', 'created_at'})
+        query = db.select(*(getattr(cls, column) for column in cls.FIELDS
+                            if column in columns))
+        query = query.where(cls.repository == repository, *(
+            getattr(cls, name) == value
+            for name, value in filters.items() if value is not None))
+
+        if after is not None:
+            query = query.where(db.tuple_(cls.created_at, cls.id) > after)
+
+        return query.order_by(cls.created_at, cls.id)
+
+    @classmethod
+    def get(cls,
+            limit: Optional[int] = None,
+            after: Optional[Tuple[datetime, int]] = None,
+            fields: Optional[Iterable[str]] = None,
+            repository: Optional[str] = None,
+            **filters) -> List[Row]:
+        """
+        Return up to limit pull requests of repository from db sorted by
+        creation, starting after the (created_at, id) key of the last pull
+        request of the previous page. filters are column values to match,
+        None is ignored
+        """
+        query = cls._listing(repository, after, fields, filters)
+        return db.session.execute(query.limit(limit)).all()
+
+    @classmethod
+    def iter_all(cls,
+                 after: Optional[Tuple[datetime, int]] = None,
+                 fields: Optional[Iterable[str]] = None,
+                 batch_size: int = 500,
+                 repository: Optional[str] = None,
+                 **filters) -> Iterator[Row]:
+        """
+        Iterate over every pull request of a listing of repository loading
+        batch_size rows at a time
+        """
+        query = cls._listing(repository, after, fields, filters)
+        return iter(db.session.execute(
+            query.execution_options(yield_per=batch_size)))
+
+    @classmethod
+    def get_by_id(cls,
+                  pull_request_id: int,
+                  repository: Optional[str] = None
+                  ) -> Union[PullRequest, None]:
+        """
+        Retrieve pull request of repository or None if id not found
+        """
+        return cls.query.filter_by(id=pull_request_id,
+                                   repository=repository).first()
+
+    @classmethod
+    def get_by_ids(cls,
+                   pull_request_ids: Iterable[int],
+                   repository: Optional[str] = None
+                   ) -> Dict[int, PullRequest]:
+        """
+        Retrieve the pull requests of repository for the ids in one query,
+        by id. Ids not found are missing from the result
+        """
+        query = cls.query.filter(cls.id.in_(set(pull_request_ids)),
+                                 cls.repository == repository)
+        return {pull_request.id: pull_request for pull_request in query}
+
+
+class MergeJob(db.Model):
+    """
+    Merge of a pull request queued, running or finished, shared by every
+    worker process so a job can be polled from any of them
+    """
+
+    __tablename__ = 'merge_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)
+    pull_request_id = db.Column(db.Integer, nullable=False, index=True)
+    # the pull request id until the job finishes, then NULL. NULLs never
+    # collide in a unique column: a pull request has at most one unfinished
+    # job across every process
+    pending = db.Column(db.Integer, nullable=True, unique=True)
+    # name of the repository under REPOS_ROOT, None for REPO_PATH
+    repository = db.Column(db.String(255), nullable=True)
+    destiny_branch = db.Column(db.String(200), nullable=False)
+    status = db.Column(db.String(10), nullable=False)
+    message = db.Column(db.Text)
+    commit = db.Column(db.String(40))
+    # host:pid of the process running the job
+    owner = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, index=True)
+
+    # status
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __repr__(self):
+        return f'<MergeJob( {self.id}, {self.pull_request_id}, {self.status})>'
+
     def as_dict(self) -> dict:
+        finished_at = self.finished_at and self.finished_at.isoformat()
+
         return {'id': self.id,
-                'title': self.title,
-                'description': self.description,
-                'status': self.status,
-                'author': self.author,
-                'source_branch': self.source_branch,
+                'pull_request_id': self.pull_request_id,
+                'repository': self.repository,
                 'destiny_branch': self.destiny_branch,
+                'status': self.status,
+                'message': self.message,
                 'commit': self.commit,
-                'created_at': self.created_at.isoformat()}
+                'created_at': self.created_at.isoformat(),
+                'finished_at': finished_at}
+
+    @classmethod
+    def get_by_id(cls, job_id: str) -> Union[MergeJob, None]:
+        return db.session.get(cls, job_id)
 
     @classmethod
-    def get(cls) -> list:
+    def get_pending(cls, pull_request_id: int) -> Union[MergeJob, None]:
+        return cls.query.filter_by(pending=pull_request_id).first()
+
+    @classmethod
+    def evict_finished(cls, keep: int) -> int:
         """
-        TODO: implement pagination
-        TODO: implement filters
-        Return a collection of pull requests from db
+        Delete the finished jobs but the keep most recent ones, return the
+        number of rows deleted
         """
-        return cls.query.all()
+        cutoff = db.session.query(cls.finished_at).filter(
+            cls.finished_at.isnot(None)).order_by(
+            cls.finished_at.desc()).offset(keep).limit(1).scalar()
+
+        if cutoff is None:
+            return 0
+
+        deleted = cls.query.filter(cls.finished_at <= cutoff).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class CommitMetadata(db.Model):
+    """
+    Persistent tier of the commit payload cache
+    """
+
+    __tablename__ = 'commit_metadata'
+
+    sha = db.Column(db.String(40), primary_key=True)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<CommitMetadata( {self.sha})>'
 
     @classmethod
-    def get_by_id(cls, pull_request_id: int) -> Union[PullRequest, None]:
+    def evict_oldest(cls, count: int) -> int:
         """
-        Retrieve pull request or None if id not found
+        Delete the count oldest rows, return the number of rows deleted
         """
-        return cls.query.filter_by(id=pull_request_id).first()
+        oldest = db.session.query(cls.sha).order_by(
+            cls.created_at).limit(count).subquery()
+        deleted = cls.query.filter(
+            cls.sha.in_(db.select(oldest.c.sha))
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class CommitIndexState(db.Model):
+    """
+    Branch tips of a repository whose history is in the commit search index
+    """
+
+    __tablename__ = 'commit_index_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # name of the repository under REPOS_ROOT, None for REPO_PATH
+    repository = db.Column(db.String(255), nullable=True)
+    # JSON list of the tip SHAs
+    tips = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CommitIndexState( {self.repository}, {self.updated_at})>'
+
+    @classmethod
+    def get_by_repository(cls,
+                          repository: Optional[str]
+                          ) -> Union[CommitIndexState, None]:
+        return cls.query.filter_by(repository=repository).first()
+
+
+# unique on an expression, NULL for REPO_PATH is distinct from NULL
+db.Index('uq_commit_index_state_repository',
+         db.func.coalesce(CommitIndexState.repository, ''),
+         unique=True)
+
+
+class BranchStatsState(db.Model):
+    """
+    Tip of a branch whose history is in the branch_activity aggregates
+    """
+
+    __tablename__ = 'branch_stats_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # name of the repository under REPOS_ROOT, None for REPO_PATH
+    repository = db.Column(db.String(255), nullable=True)
+    branch = db.Column(db.String(200), nullable=False)
+    commit = db.Column(db.String(40), nullable=False)
+    updated_at = db.Column(db.DateTime,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<BranchStatsState( {self.branch}, {self.commit})>'
+
+    @classmethod
+    def get_by_branch(cls,
+                      repository: Optional[str],
+                      branch: str) -> Union[BranchStatsState, None]:
+        return cls.query.filter_by(repository=repository,
+                                   branch=branch).first()
+
+
+# NULL is distinct from NULL in a unique constraint, the branches of REPO_PATH
+# are only unique on an expression. Two workers seeding the same branch race
+# on this index
+db.Index('uq_branch_stats_state_repository_branch',
+         db.func.coalesce(BranchStatsState.repository, ''),
+         BranchStatsState.branch,
+         unique=True)
+
+
+class BranchActivity(db.Model):
+    """
+    Commits, files changed and lines added and deleted by an author on one
+    day of the history of a branch. Every total is a sum, so the rows of a
+    branch are kept up to date by adding the commits a tip move brings and
+    subtracting those it drops
+    """
+
+    __tablename__ = 'branch_activity'
+    __table_args__ = (
+        db.UniqueConstraint('repository', 'branch', 'day', 'email'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # name of the repository under REPOS_ROOT, None for REPO_PATH
+    repository = db.Column(db.String(255), nullable=True)
+    branch = db.Column(db.String(200), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    email = db.Column(db.String(150), nullable=False)
+    author = db.Column(db.String(150))
+    commits = db.Column(db.Integer, nullable=False, default=0)
+    files = db.Column(db.Integer, nullable=False, default=0)
+    additions = db.Column(db.Integer, nullable=False, default=0)
+    deletions = db.Column(db.Integer, nullable=False, default=0)
+
+    TOTALS = ('commits', 'files', 'additions', 'deletions')
+
+    def __repr__(self):
+        return f'<BranchActivity( {self.branch}, {self.day}, {self.email})>'
+
+    @classmethod
+    def query_branch(cls, repository: Optional[str], branch: str):
+        return cls.query.filter_by(repository=repository, branch=branch)
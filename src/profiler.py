@@ -0,0 +1,171 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime
+from flask import g, request
+from typing import List, Optional
+
+
+class Profile:
+    """
+    Stacks of one request sampled every interval seconds from a separate
+    thread, counted by collapsed stack
+    """
+
+    def __init__(self, interval: float):
+        self.id = uuid.uuid4().hex
+        self.interval = interval
+        self.endpoint = request.endpoint
+        self.method = request.method
+        self.path = request.full_path.rstrip('?')
+        self.created_at = datetime.utcnow()
+        self.duration = None
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._start = time.perf_counter()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample,
+                                         name=f'profiler-{self.id[:8]}',
+                                         daemon=True)
+        self._sampler.start()
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        names = []
+
+        while frame is not None:
+            code = frame.f_code
+            filename = os.path.basename(code.co_filename)
+            names.append(f'{code.co_name} ({filename}:{frame.f_lineno})')
+            frame = frame.f_back
+
+        return ';'.join(reversed(names))
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+
+            if frame is not None:
+                self.stacks[self._collapse(frame)] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self._start
+
+    @property
+    def samples(self) -> int:
+        return sum(self.stacks.values())
+
+    def collapsed(self) -> str:
+        """
+        Stacks in the collapsed format read by flamegraph.pl and speedscope
+        """
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+    def as_dict(self) -> dict:
+        return {'id': self.id,
+                'endpoint': self.endpoint,
+                'method': self.method,
+                'path': self.path,
+                'created_at': self.created_at.isoformat(),
+                'duration': self.duration,
+                'interval': self.interval,
+                'samples': self.samples}
+
+
+class Profiler:
+    """
+    Opt-in sampling profiler of single requests. A request is profiled when
+    it sends the X-Profile-Token header with the PROFILE_TOKEN configured or
+    is picked at PROFILE_SAMPLE_RATE, its profile id is sent back in the
+    X-Profile-Id header. The last max_profiles profiles are kept.
+
+    Without a token nor a sample rate no hook is installed, requests do not
+    pay anything
+    """
+
+    HEADER = 'X-Profile-Token'
+    # endpoints reading the profiles are never profiled
+    ADMIN_ENDPOINTS = ('profiles', 'profile')
+
+    def __init__(self):
+        self.token = None
+        self.sample_rate = 0.0
+        self.interval = 0.005
+        self.max_profiles = 100
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.token = app.config['PROFILE_TOKEN']
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.interval = app.config['PROFILE_INTERVAL']
+        self.max_profiles = app.config['PROFILE_MAX_PROFILES']
+
+        if self.token or self.sample_rate > 0:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+            app.teardown_request(self._teardown_request)
+
+    def is_admin(self) -> bool:
+        """
+        Tell if the current request sent the admin token
+        """
+        token = request.headers.get(self.HEADER) or ''
+        # constant time, the time taken tells nothing about the token. Bytes
+        # as str arguments must be ASCII
+        return bool(self.token) and hmac.compare_digest(token.encode(),
+                                                        self.token.encode())
+
+    def _before_request(self):
+        if request.endpoint in self.ADMIN_ENDPOINTS:
+            return
+
+        if self.is_admin() or random.random() < self.sample_rate:
+            g.profile = Profile(self.interval)
+
+    def _after_request(self, response):
+        profile = g.pop('profile', None)
+
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile.id
+            # streamed responses are profiled until their last chunk
+            response.call_on_close(lambda: self._store(profile))
+
+        return response
+
+    def _teardown_request(self, exception=None):
+        # the request failed before a response was made
+        profile = g.pop('profile', None)
+
+        if profile is not None:
+            self._store(profile)
+
+    def _store(self, profile: Profile):
+        profile.stop()
+
+        with self._lock:
+            self._profiles[profile.id] = profile
+
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        return self._profiles.get(profile_id)
+
+    def profiles(self) -> List[Profile]:
+        """
+        Stored profiles, newest first
+        """
+        with self._lock:
+            return list(reversed(self._profiles.values()))
+
+
+profiler = Profiler()
@@ -0,0 +1,370 @@
+import heapq
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from git import Repo
+from typing import Dict, List, Optional, Set, Tuple
+
+from cache import LRUCache
+from events import event_bus
+from git_repo import RepositoryNotFound, repositories, repository
+import git_log
+import git_refs
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReachabilityIndex:
+    """
+    Commit graph of one repository in memory with, for every commit, its
+    generation number, one more than the highest of its parents, and the
+    exact number of its ancestors including itself.
+
+    Commits are only ever added: an update reads the commits reachable from
+    the current tips and not from the tips of the previous update, parents
+    first, so it costs the commits added since. The ancestor count of a new
+    commit is the count of its first parent plus the commits only its other
+    parents reach, found with a walk in generation order that stops as soon
+    as every commit left is reachable from the first parent
+    """
+
+    # ancestor sets of the last bases compared against
+    MAX_BASES = 4
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.parents: List[Tuple[int, ...]] = []
+        self.generations: List[int] = []
+        self.counts: List[int] = []
+        self.tips: List[str] = []
+        self.lock = threading.Lock()
+        self._bases = OrderedDict()
+
+    def update(self, repo: Repo, tips: List[str]):
+        """
+        Add the commits reachable from tips, must hold lock
+        """
+        tips = sorted(set(tips))
+
+        if tips == self.tips:
+            return
+
+        for sha, parent_shas in git_log.iter_new_parents(repo, tips,
+                                                         self.tips):
+            if sha in self.ids:
+                # only reachable from a branch deleted since
+                continue
+
+            # parents out of the index are beyond a shallow boundary
+            parents = tuple(self.ids[parent] for parent in parent_shas
+                            if parent in self.ids)
+            commit = len(self.parents)
+            self.ids[sha] = commit
+            self.parents.append(parents)
+
+            if parents:
+                self.generations.append(
+                    1 + max(self.generations[parent] for parent in parents))
+                self.counts.append(
+                    1 + self.counts[parents[0]]
+                    + self._exclusive_count(parents[1:], parents[:1]))
+            else:
+                self.generations.append(1)
+                self.counts.append(1)
+
+        self.tips = tips
+
+    def _exclusive_count(self,
+                         include: Tuple[int, ...],
+                         exclude: Tuple[int, ...]) -> int:
+        """
+        Number of commits reachable from include and not from exclude.
+        Commits are visited by decreasing generation, so a commit is counted
+        only once every descendant that could reach it from exclude was seen
+        """
+        if not include:
+            return 0
+
+        colors: Dict[int, int] = {}
+        heap = []
+        # queued commits not reachable from both sides yet
+        pending = 0
+        count = 0
+
+        def paint(commit: int, color: int):
+            nonlocal pending
+            old = colors.get(commit, 0)
+            new = old | color
+
+            if new == old:
+                return
+
+            colors[commit] = new
+
+            if not old:
+                heapq.heappush(heap, (-self.generations[commit], commit))
+                pending += new != 3
+            elif new == 3:
+                pending -= 1
+
+        for commit in include:
+            paint(commit, 1)
+
+        for commit in exclude:
+            paint(commit, 2)
+
+        while pending:
+            _, commit = heapq.heappop(heap)
+            color = colors[commit]
+
+            if color != 3:
+                pending -= 1
+
+            count += color == 1
+
+            for parent in self.parents[commit]:
+                paint(parent, color)
+
+        return count
+
+    def _ancestors(self, commit: int) -> Set[int]:
+        """
+        Every ancestor of commit including itself, derived from the set of
+        a previous base when commit descends from it
+        """
+        for base, ancestors in reversed(self._bases.items()):
+            if len(ancestors) >= self.counts[commit]:
+                continue
+
+            result = set(ancestors)
+            self._walk(commit, result)
+
+            # exactly its ancestors only if the previous base was one
+            if len(result) == self.counts[commit]:
+                return result
+
+        result = set()
+        self._walk(commit, result)
+        return result
+
+    def _walk(self, commit: int, seen: Set[int]) -> int:
+        """
+        Add to seen the ancestors of commit not reachable from seen, return
+        how many were added
+        """
+        if commit in seen:
+            return 0
+
+        seen.add(commit)
+        stack = [commit]
+        added = 1
+
+        while stack:
+            for parent in self.parents[stack.pop()]:
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+                    added += 1
+
+        return added
+
+    def ahead_behind(self,
+                     sha: str,
+                     base_sha: str) -> Optional[Tuple[int, int]]:
+        """
+        Commits sha has that base_sha has not and the other way around, None
+        if one of them is not indexed. Only the commits ahead are walked,
+        the commits behind follow from the ancestor counts. Must hold lock
+        """
+        commit = self.ids.get(sha)
+        base = self.ids.get(base_sha)
+
+        if commit is None or base is None:
+            return None
+
+        ancestors = self._bases.get(base)
+
+        if ancestors is None:
+            ancestors = self._bases[base] = self._ancestors(base)
+
+            while len(self._bases) > self.MAX_BASES:
+                self._bases.popitem(last=False)
+        else:
+            self._bases.move_to_end(base)
+
+        # the walk adds to a copy only the commits base does not reach
+        ahead = self._walk(commit, _Overlay(ancestors))
+        behind = self.counts[base] - (self.counts[commit] - ahead)
+
+        return ahead, behind
+
+
+class _Overlay(set):
+    """
+    Set of the commits added to a base set, the base set is never modified
+    """
+
+    def __init__(self, base: Set[int]):
+        super().__init__()
+        self.base = base
+
+    def __contains__(self, commit) -> bool:
+        return commit in self.base or super().__contains__(commit)
+
+
+class Reachability:
+    """
+    Ahead and behind counts of branches against a base branch, BRANCH_BASE
+    by default, from a reachability index by repository. Counts are cached
+    by the pair of tip SHAs.
+
+    An index is built in background the first time a repository is asked
+    for, counts are None until it is ready. Afterwards it is updated when a
+    branch tip is not in it yet, and in background on every ref event of the
+    REPO_PATH repository so requests rarely wait for it.
+
+    The index of REPO_PATH is kept for the life of the process, those of the
+    repositories under REPOS_ROOT in an LRU bounded like their pools by
+    REPOS_MAX_OPEN
+    """
+
+    def __init__(self):
+        self.app = None
+        self.base = 'master'
+        self.cache = LRUCache()
+        self._index: Optional[ReachabilityIndex] = None
+        self.indexes = LRUCache()
+        self._building: Dict[Optional[str], ReachabilityIndex] = {}
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.base = app.config['BRANCH_BASE']
+        self.cache = LRUCache(app.config['AHEAD_BEHIND_CACHE_SIZE'])
+        self.indexes = LRUCache(app.config['REPOS_MAX_OPEN'])
+        self._thread = threading.Thread(target=self._run,
+                                        name='reachability',
+                                        daemon=True)
+        self._thread.start()
+        event_bus.subscribe(self._on_event)
+
+        if repositories.pool is not None:
+            self._schedule(None)
+
+    def _on_event(self, event: str, data: dict):
+        if event == 'ref' and data['ref'].startswith('refs/heads/'):
+            # only the REPO_PATH repository is watched
+            self._schedule(None)
+
+    def _schedule(self, name: Optional[str]):
+        with self._lock:
+            if name in self._queued:
+                return
+
+            self._queued.add(name)
+
+        self._queue.put(name)
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+
+            with self._lock:
+                self._queued.discard(name)
+
+            try:
+                with self.app.app_context():
+                    repositories.select(name)
+                    self._update(name, git_refs.branch_tips(repository))
+            except RepositoryNotFound:
+                logger.warning('Repository %s not found', name)
+            except Exception:
+                logger.exception('Reachability index update of %s failed',
+                                 name)
+
+    def _get_index(self, name: Optional[str]) -> Optional[ReachabilityIndex]:
+        if name is None:
+            return self._index
+
+        return self.indexes.get(name)
+
+    def _update(self,
+                name: Optional[str],
+                tips: Dict[str, str]) -> ReachabilityIndex:
+        with self._lock:
+            index = self._get_index(name) or self._building.get(name)
+            building = index is None
+
+            if building:
+                # threads asking meanwhile update this one instead of
+                # building an index of their own
+                index = self._building[name] = ReachabilityIndex()
+
+        try:
+            with index.lock:
+                index.update(repository, list(tips.values()))
+        finally:
+            if building:
+                with self._lock:
+                    del self._building[name]
+
+        if building:
+            with self._lock:
+                if name is None:
+                    self._index = index
+                else:
+                    self.indexes.put(name, index)
+
+            logger.info('Reachability index of %s built, %s commits',
+                        name or 'REPO_PATH', len(index.ids))
+
+        return index
+
+    def ready(self) -> bool:
+        """
+        Tell if the index of the repository of the request is built
+        """
+        name = repositories.name()
+
+        if name is None:
+            return self._index is not None
+
+        return name in self.indexes
+
+    def get(self, sha: str, base_sha: str) -> Optional[dict]:
+        """
+        Ahead and behind counts of commit sha against commit base_sha in the
+        repository of the request, None while its index is being built
+        """
+        result = self.cache.get((sha, base_sha))
+
+        if result is not None:
+            return result
+
+        name = repositories.name()
+        index = self._get_index(name)
+
+        if index is None:
+            self._schedule(name)
+            return None
+
+        if sha not in index.ids or base_sha not in index.ids:
+            index = self._update(name, git_refs.branch_tips(repository))
+
+        with index.lock:
+            counts = index.ahead_behind(sha, base_sha)
+
+        if counts is None:
+            return None
+
+        result = {'ahead': counts[0], 'behind': counts[1]}
+        self.cache.put((sha, base_sha), result)
+        return result
+
+
+reachability = Reachability()
@@ -0,0 +1,264 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from events import event_bus
+from git_repo import repositories, repository
+import git_refs
+
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# files of the git directory holding refs, the rest of it is not watched
+REF_FILES = ('HEAD', 'packed-refs')
+# wait for the other writes of a ref transaction before reading the refs
+DEBOUNCE = 0.05
+# refs are read again after this many seconds without notification, in case
+# an inotify event was lost
+RESCAN_INTERVAL = 60
+
+
+class Inotify:
+    """
+    Minimal inotify binding through ctypes, Linux only
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int,
+                                    ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def watch(self, path: str) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        return wd
+
+    def read(self, timeout: Optional[float]) -> List[tuple]:
+        """
+        (wd, mask, name) of the events read within timeout seconds
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RefWatcher:
+    """
+    Background thread watching the ref files of the repository, with inotify
+    when it is available or by polling their stat otherwise. Every ref that
+    moved is published as a `ref` event with its old and new SHA, and the
+    branch tips cache is updated with the branches that moved only
+    """
+
+    def __init__(self):
+        self.app = None
+        self.mode = 'auto'
+        self.interval = 1.0
+        self.refs: Dict[str, str] = {}
+        self.git_dir = None
+        self.common_dir = None
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.mode = app.config['REF_WATCHER']
+        self.interval = app.config['REF_WATCHER_POLL_INTERVAL']
+
+        if self.mode == 'off' or repositories.pool is None:
+            # repositories under REPOS_ROOT are not watched
+            return
+
+        with app.app_context():
+            self.git_dir = repository.git_dir
+            self.common_dir = repository.common_dir
+            self.refs = git_refs.ref_tips(repository)
+
+        git_refs.tips_cache.reset(self.common_dir, self._branches(self.refs))
+        self._thread = threading.Thread(target=self._run,
+                                        name='ref-watcher',
+                                        daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _branches(refs: Dict[str, str]) -> Dict[str, str]:
+        return {ref[len('refs/heads/'):]: sha for ref, sha in refs.items()
+                if ref.startswith('refs/heads/')}
+
+    def _run(self):
+        try:
+            for _ in self._changes():
+                try:
+                    self._rescan()
+                except Exception:
+                    logger.exception('Cannot read refs of %s', self.git_dir)
+        except Exception:
+            logger.exception('Ref watcher of %s stopped', self.git_dir)
+        finally:
+            # nothing keeps the cached tips fresh anymore
+            git_refs.tips_cache.reset(None, None)
+
+    def _changes(self) -> Iterator[None]:
+        if self.mode != 'poll':
+            try:
+                inotify = Inotify()
+            except OSError:
+                if self.mode == 'inotify':
+                    raise
+                logger.info('inotify unavailable, polling refs every %ss',
+                            self.interval)
+            else:
+                return self._inotify_changes(inotify)
+
+        return self._poll_changes()
+
+    def _watch_refs(self, inotify: Inotify):
+        """
+        Watch every directory under refs, watching one twice is harmless
+        """
+        for directory, _, _ in os.walk(os.path.join(self.common_dir, 'refs')):
+            try:
+                inotify.watch(directory)
+            except FileNotFoundError:
+                # removed by git while walking
+                pass
+
+    def _inotify_changes(self, inotify: Inotify) -> Iterator[None]:
+        """
+        Yield once for every batch of ref file changes, or after
+        RESCAN_INTERVAL seconds without any
+        """
+        try:
+            git_dirs = {inotify.watch(self.git_dir),
+                        inotify.watch(self.common_dir)}
+
+            self._watch_refs(inotify)
+
+            while True:
+                events = inotify.read(RESCAN_INTERVAL)
+                changed = not events
+
+                while events:
+                    for wd, mask, name in events:
+                        created = mask & (IN_CREATE | IN_MOVED_TO)
+
+                        if mask & IN_ISDIR and created:
+                            # new ref namespace, watch it and what it holds
+                            self._watch_refs(inotify)
+
+                        if wd in git_dirs and name not in REF_FILES:
+                            continue
+
+                        if mask & IN_Q_OVERFLOW or not name.endswith('.lock'):
+                            changed = True
+
+                    events = inotify.read(DEBOUNCE) if changed else []
+
+                if changed:
+                    yield
+        finally:
+            inotify.close()
+
+    def _stat_signature(self) -> tuple:
+        paths = [os.path.join(self.git_dir, 'HEAD'),
+                 os.path.join(self.common_dir, 'packed-refs')]
+
+        for directory, _, files in os.walk(os.path.join(self.common_dir,
+                                                        'refs')):
+            paths.extend(os.path.join(directory, name) for name in files)
+
+        signature = []
+
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            signature.append((path, stat.st_ino, stat.st_size,
+                              stat.st_mtime_ns))
+
+        return tuple(signature)
+
+    def _poll_changes(self) -> Iterator[None]:
+        signature = self._stat_signature()
+        last_scan = time.monotonic()
+
+        while True:
+            time.sleep(self.interval)
+            current = self._stat_signature()
+
+            if (current != signature
+                    or time.monotonic() - last_scan > RESCAN_INTERVAL):
+                signature = current
+                last_scan = time.monotonic()
+                yield
+
+    def _rescan(self):
+        with self.app.app_context():
+            refs = git_refs.ref_tips(repository)
+
+        previous, self.refs = self.refs, refs
+
+        for ref in sorted(previous.keys() | refs.keys()):
+            old, new = previous.get(ref), refs.get(ref)
+
+            if old == new:
+                continue
+
+            if ref.startswith('refs/heads/'):
+                git_refs.tips_cache.update(ref[len('refs/heads/'):], new)
+
+            event_bus.publish('ref', {'ref': ref, 'old': old, 'new': new})
+
+
+ref_watcher = RefWatcher()
@@ -1,7 +1,65 @@
-from flask_restful import Resource
-from typing import Union
+from datetime import date
+from flask import request
+from flask_restful import Resource, reqparse
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Tuple, Union
+from urllib.parse import urlencode
 
-from git_repo import repository
+from activity import INTERVALS, activity
+from git_repo import repositories, repository
+from reachability import reachability
+from single_flight import single_flight
+import git_refs
+import http_cache
+import streaming
+
+
+def _base(name: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Name and tip of the branch ahead and behind are counted against, the
+    configured default one when name is None. The tip is None when there is
+    no such branch
+    """
+    name = name or reachability.base
+    return name, git_refs.resolve_branch(repository, name)
+
+
+def _with_counts(branches: Iterable[dict],
+                 base_sha: Optional[str]) -> Iterator[dict]:
+    """
+    Add to the branches how many commits they are ahead and behind the base,
+    None while the counts are not known
+    """
+    for branch in branches:
+        counts = (reachability.get(branch['commit'], base_sha)
+                  if base_sha is not None else None)
+        branch['ahead'] = counts and counts['ahead']
+        branch['behind'] = counts and counts['behind']
+        yield branch
+
+
+def _page(prefix: str,
+          limit: Optional[int],
+          after: Optional[str],
+          base_sha: Optional[str]) -> Tuple[list, Optional[str]]:
+    """
+    Branches starting with prefix after the branch named after, all of them
+    or up to limit, and the cursor of the next page if there is one
+    """
+    branches = git_refs.iter_branches(repository, prefix, after)
+
+    if limit is None:
+        return list(_with_counts(branches, base_sha)), None
+
+    # one extra branch tells if there is a next page
+    page = list(islice(branches, limit + 1))
+    branches.close()
+
+    if len(page) <= limit:
+        return list(_with_counts(page, base_sha)), None
+
+    page = list(_with_counts(page[:limit], base_sha))
+    return page, git_refs.encode_cursor(page[-1]['name'])
 
 
 class Branch(Resource):
@@ -9,18 +67,97 @@ class Branch(Resource):
     Resource for one branch
     """
 
+    parser = reqparse.RequestParser()
+
+    parser.add_argument('base',
+                        type=str,
+                        location='args')
+
     def get(self, branch_name) -> Union[dict, tuple]:
         """
-        Search the requested branch in repository
+        Search the requested branch in repository with how many commits it is
+        ahead and behind base
         """
-        try:
-            branch = repository.heads[branch_name]
-        except IndexError:
+        args = Branch.parser.parse_args()
+        sha = git_refs.resolve_branch(repository, branch_name)
+
+        if sha is None:
             return {'message': f'No branch found with id {branch_name}'}, 404
-        else:
-            return {'name': branch.name,
-                    'commit': branch.commit.hexsha,
-                    'datetime': branch.commit.committed_datetime.isoformat()}
+
+        base, base_sha = _base(args['base'])
+
+        if base_sha is None and args['base'] is not None:
+            return {'message': f'Invalid base {base}'}, 400
+
+        tag = http_cache.etag('branch', branch_name, sha, base, base_sha,
+                              reachability.ready())
+        not_modified = http_cache.not_modified(tag)
+
+        if not_modified:
+            return not_modified
+
+        commit = repository.commit(sha)
+        branch, = _with_counts([{
+            'name': branch_name,
+            'commit': sha,
+            'datetime': commit.committed_datetime.isoformat()
+        }], base_sha)
+
+        return branch, 200, http_cache.headers(tag)
+
+
+class BranchStats(Resource):
+    """
+    Contributors and activity of one branch
+    """
+
+    parser = reqparse.RequestParser()
+
+    parser.add_argument('interval',
+                        type=str,
+                        default='week',
+                        choices=INTERVALS,
+                        location='args',
+                        help="Must be one of day, week or month.")
+
+    parser.add_argument('since',
+                        type=date.fromisoformat,
+                        location='args',
+                        help="Must be a date as YYYY-MM-DD.")
+
+    parser.add_argument('until',
+                        type=date.fromisoformat,
+                        location='args',
+                        help="Must be a date as YYYY-MM-DD.")
+
+    def get(self, branch_name: str) -> Union[dict, tuple]:
+        """
+        Commits, files changed and lines added and deleted by author and by
+        interval in the history of the branch, between the days since and
+        until when given. Read from aggregates brought up to date with the
+        commits since the tip they were last computed for
+        """
+        args = BranchStats.parser.parse_args()
+        sha = git_refs.resolve_branch(repository, branch_name)
+
+        if sha is None:
+            return {'message': f'No branch found with id {branch_name}'}, 404
+
+        tag = http_cache.etag('branch-stats', repositories.name(),
+                              branch_name, sha, args['interval'],
+                              args['since'], args['until'])
+        not_modified = http_cache.not_modified(tag)
+
+        if not_modified:
+            return not_modified
+
+        stats = activity.get(branch_name, args['interval'], args['since'],
+                             args['until'])
+
+        if stats is None:
+            return {'message': f'No branch found with id {branch_name}'}, 404
+
+        return stats, 200, http_cache.headers(tag)
 
 
 class Branches(Resource):
@@ -28,17 +165,84 @@ class Branches(Resource):
     Resource for list of Branch
     """
 
-    def get(self) -> list:
+    parser = reqparse.RequestParser()
+
+    parser.add_argument('prefix',
+                        type=str,
+                        default='',
+                        location='args')
+
+    parser.add_argument('limit',
+                        type=int,
+                        location='args',
+                        help="Must be an integer.")
+
+    parser.add_argument('cursor',
+                        type=str,
+                        location='args')
+
+    parser.add_argument('base',
+                        type=str,
+                        location='args')
+
+    def get(self) -> Union[list, tuple]:
         """
-        Returns a list of branches
+        Returns the branches starting with prefix, all of them or one page of
+        limit branches when a limit is given, with the link to the next page
+        in the Link header. Streamed when the client asks for it.
+
+        Every branch reports how many commits it is ahead and behind base,
+        None until the reachability index of the repository is built
         """
-        branches = []
+        args = Branches.parser.parse_args()
+
+        if args['limit'] is not None and args['limit'] < 1:
+            return {'message': 'limit must be greater than 0'}, 400
+
+        try:
+            after = (git_refs.decode_cursor(args['cursor'])
+                     if args['cursor'] is not None else None)
+        except git_refs.InvalidCursor:
+            return {'message': f'Invalid cursor {args["cursor"]}'}, 400
+
+        base, base_sha = _base(args['base'])
+
+        if base_sha is None and args['base'] is not None:
+            return {'message': f'Invalid base {base}'}, 400
+
+        stream_format = streaming.requested_format()
+        tag = http_cache.etag('branches',
+                              git_refs.branches_digest(repository),
+                              args['prefix'],
+                              args['limit'],
+                              after,
+                              stream_format,
+                              base,
+                              reachability.ready())
+        not_modified = http_cache.not_modified(tag)
+
+        if not_modified:
+            return not_modified
+
+        headers = http_cache.headers(tag)
+
+        if stream_format:
+            branches = _with_counts(
+                git_refs.iter_branches(repository, args['prefix'], after),
+                base_sha)
+            return streaming.stream(islice(branches, args['limit']),
+                                    stream_format,
+                                    headers=headers)
+
+        # identical listings running at the same time share one
+        # for-each-ref, the tag covers every branch tip and parameter
+        page, cursor = single_flight.do(
+            tag, lambda: _page(args['prefix'], args['limit'], after, base_sha))
 
-        for branch in repository.heads:
-            branches.append({
-                'name': branch.name,
-                'commit': branch.commit.hexsha,
-                'datetime': branch.commit.committed_datetime.isoformat()
-            })
+        if cursor is not None:
+            query = urlencode({'prefix': args['prefix'],
+                               'limit': args['limit'],
+                               'cursor': cursor})
+            headers['Link'] = f'<{request.base_url}?{query}>; rel="next"'
 
-        return branches
+        return page, 200, headers
@@ -1,7 +1,38 @@
-from flask_restful import Resource
+from flask import request
+from flask_restful import Resource, reqparse
 from typing import Union
+from urllib.parse import urlencode
 from git_repo import repository
+from cache import commit_cache
+from commit_index import commit_index
+from single_flight import single_flight
+import commit_index as search_index
+import git
+import git_log
+import git_refs
 import gitdb
+import http_cache
+import re
+import streaming
+
+
+FULL_SHA = re.compile(r'[0-9a-f]{40}')
+
+
+def _page(revs: list, limit: int) -> tuple:
+    """
+    Page of commits walked from revs served from the commit cache, only the
+    commits missing from it are read from git
+    """
+    key = (tuple(revs), limit)
+    page = commit_cache.pages.get(key)
+
+    if page is None:
+        page = git_log.walk(repository, revs, limit)
+        commit_cache.pages.put(key, page)
+
+    shas, next_revs = page
+    return commit_cache.load(repository, shas), next_revs
 
 
 class Commit(Resource):
@@ -11,19 +42,51 @@ class Commit(Resource):
 
     def get(self, branch_name: str, commit_sha: str) -> Union[dict, tuple]:
         """
-        Get the specific commit requested
+        Get the specific commit requested, the response is immutable when it
+        is addressed by its full SHA
         """
+        full_sha = FULL_SHA.fullmatch(commit_sha)
+        cache_control = http_cache.IMMUTABLE if full_sha else None
+
+        if full_sha:
+            # the commit cache is shared by every repository, the commit has
+            # to be in this one before it is answered from the cache. The
+            # persistent cat-file process checks it without a new process
+            try:
+                _, kind, _ = repository.git.get_object_header(commit_sha)
+            except ValueError:
+                message = f'No commit found with id {commit_sha}'
+                return {'message': message}, 404
+
+            full_sha = kind == 'commit'
+
+        if full_sha:
+            tag = http_cache.etag('commit', commit_sha)
+            not_modified = http_cache.not_modified(tag, cache_control)
+
+            if not_modified:
+                return not_modified
+
+            cached = commit_cache.get(commit_sha)
+
+            if cached is not None:
+                return cached, 200, http_cache.headers(tag, cache_control)
+
         try:
             commit = repository.commit(commit_sha)
-        except gitdb.exc.BadName:
+        except (gitdb.exc.BadName, ValueError):
             return {'message': f'No commit found with id {commit_sha}'}, 404
 
-        return {'commit': commit.hexsha,
-                'author': commit.author.name,
-                'message': commit.message,
-                'email': commit.author.email,
-                'files': len(commit.stats.files),
-                'datetime': commit.committed_datetime.isoformat()}
+        tag = http_cache.etag('commit', commit.hexsha)
+        not_modified = http_cache.not_modified(tag, cache_control)
+
+        if not_modified:
+            return not_modified
+
+        result, = git_log.get_commits(repository, [commit.hexsha])
+        commit_cache.put_many([result])
+
+        return result, 200, http_cache.headers(tag, cache_control)
 
 
 class Commits(Resource):
@@ -31,28 +94,164 @@ class Commits(Resource):
     Resource for listing many commits from branch
     """
 
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    parser = reqparse.RequestParser()
+
+    parser.add_argument('limit',
+                        type=int,
+                        location='args',
+                        help="Must be an integer.")
+
+    parser.add_argument('cursor',
+                        type=str,
+                        location='args')
+
     def get(self, branch_name: str) -> Union[list, tuple]:
         """
-        TODO: implement pagination
-        search for all the commits in the given branch_name
+        Search one page of commits in the given branch_name, newest first.
+        The link to the next page is sent in the Link header, its cursor
+        tells the walk where to resume instead of skipping previous pages.
+
+        In streaming mode the commits are sent as git produces them, from the
+        cursor up to limit or to the end of history when there is no limit
         """
-        try:
-            repository.heads[branch_name]
-        except IndexError:
+        args = Commits.parser.parse_args()
+        stream_format = streaming.requested_format()
+
+        if args['limit'] is None and not stream_format:
+            args['limit'] = Commits.DEFAULT_LIMIT
+
+        # a stream has bounded memory so it is not capped by MAX_LIMIT
+        if args['limit'] is not None and (
+                args['limit'] < 1 or
+                not stream_format and args['limit'] > Commits.MAX_LIMIT):
+            error = {
+                'message': f'limit must be between 1 and {Commits.MAX_LIMIT}'
+            }
+            return error, 400
+
+        tip = git_refs.resolve_branch(repository, branch_name)
+
+        if tip is None:
             return {'message': f'No branch found with id {branch_name}'}, 404
-        # TODO: use max_count and skip for results pagination
-        commits = list(repository.iter_commits(branch_name))
-
-        result_commits = []
-
-        for commit in commits:
-            result_commits.append({
-                'commit': commit.hexsha,
-                'author': commit.author.name,
-                'message': commit.message,
-                'email': commit.author.email,
-                'files': len(commit.stats.files),
-                'datetime': commit.committed_datetime.isoformat()
-            })
-
-        return result_commits
+
+        try:
+            revs = ([tip] if args['cursor'] is None
+                    else git_log.decode_cursor(args['cursor']))
+        except git_log.InvalidCursor:
+            return {'message': f'Invalid cursor {args["cursor"]}'}, 400
+
+        # pages after the first one start from commits, they never change
+        cache_control = http_cache.IMMUTABLE if args['cursor'] else None
+        tag = http_cache.etag('commits', *revs, args['limit'], stream_format)
+        not_modified = http_cache.not_modified(tag, cache_control)
+
+        if not_modified:
+            return not_modified
+
+        headers = http_cache.headers(tag, cache_control)
+
+        try:
+            if args['cursor'] is not None:
+                # git errors can not be reported once a stream has started
+                repository.git.rev_parse(*(f'{rev}^{{commit}}'
+                                           for rev in revs))
+
+            if stream_format:
+                commits = git_log.iter_commits(repository, revs,
+                                               args['limit'])
+                return streaming.stream(commits, stream_format,
+                                        headers=headers)
+
+            # clients polling a branch that just moved ask for the same page
+            # at once, one walk serves them all
+            commits, next_revs = single_flight.do(
+                tag, lambda: _page(revs, args['limit']))
+        except git.exc.GitCommandError:
+            return {'message': f'Invalid cursor {args["cursor"]}'}, 400
+
+        if next_revs:
+            query = urlencode({'limit': args['limit'],
+                               'cursor': git_log.encode_cursor(next_revs)})
+            headers['Link'] = f'<{request.base_url}?{query}>; rel="next"'
+
+        return commits, 200, headers
+
+
+class SearchCommits(Resource):
+    """
+    Resource for full-text search of commits
+    """
+
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+
+    parser = reqparse.RequestParser()
+
+    parser.add_argument('q',
+                        type=str,
+                        location='args',
+                        required=True,
+                        help="Words to search are required.")
+
+    parser.add_argument('limit',
+                        type=int,
+                        default=DEFAULT_LIMIT,
+                        location='args',
+                        help="Must be an integer.")
+
+    parser.add_argument('cursor',
+                        type=str,
+                        location='args')
+
+    def get(self) -> Union[list, tuple]:
+        """
+        Search one page of the commits of every branch whose message, author
+        name or email contain all the words of q, a word ending in * matches
+        as a prefix. Best matches come first, the link to the next page is
+        sent in the Link header and answers 410 once new commits are indexed
+        """
+        args = SearchCommits.parser.parse_args()
+
+        if not commit_index.enabled:
+            return {'message': 'Commit search needs an SQLite database'}, 501
+
+        if not search_index.match_query(args['q']):
+            return {'message': 'q must contain a word to search'}, 400
+
+        if not 1 <= args['limit'] <= SearchCommits.MAX_LIMIT:
+            error = {
+                'message': f'limit must be between 1 and '
+                           f'{SearchCommits.MAX_LIMIT}'
+            }
+            return error, 400
+
+        try:
+            after = (None if args['cursor'] is None
+                     else search_index.decode_cursor(args['cursor']))
+        except search_index.InvalidCursor:
+            return {'message': f'Invalid cursor {args["cursor"]}'}, 400
+
+        # an update already running is not waited for, its commits show up
+        # in the next searches
+        commit_index.update(wait=False)
+
+        try:
+            results, last = commit_index.search(args['q'], args['limit'],
+                                                after)
+        except search_index.ExpiredCursor:
+            error = {'message': 'Commits were indexed since the first page, '
+                                'search again'}
+            return error, 410
+
+        headers = {}
+
+        if last is not None:
+            query = urlencode({'q': args['q'],
+                               'limit': args['limit'],
+                               'cursor': search_index.encode_cursor(*last)})
+            headers['Link'] = f'<{request.base_url}?{query}>; rel="next"'
+
+        return results, 200, headers
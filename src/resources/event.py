@@ -0,0 +1,50 @@
+from flask import Response
+from flask_restful import Resource
+import json
+import queue
+
+from events import event_bus
+
+
+# comment line sent when nothing happened, so proxies keep the stream open
+HEARTBEAT = 15
+
+
+class Events(Resource):
+    """
+    Server-sent events stream of ref updates, pull request changes and
+    merge job results
+    """
+
+    def get(self) -> Response:
+        """
+        Stream every event published after the request, until the client
+        disconnects
+        """
+        listener = event_bus.listen()
+
+        def generate():
+            try:
+                yield 'retry: 3000\n\n'
+
+                while True:
+                    try:
+                        item = listener.get(timeout=HEARTBEAT)
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+
+                    if item is None:
+                        return
+
+                    event_id, event, data = item
+                    yield (f'id: {event_id}\n'
+                           f'event: {event}\n'
+                           f'data: {json.dumps(data)}\n\n')
+            finally:
+                event_bus.unlisten(listener)
+
+        return Response(generate(),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
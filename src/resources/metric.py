@@ -0,0 +1,18 @@
+from flask import Response
+from flask_restful import Resource
+
+from metrics import metrics
+
+
+class Metrics(Resource):
+    """
+    Service metrics for Prometheus
+    """
+
+    def get(self) -> Response:
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        return Response(metrics.expose(),
+                        content_type='text/plain; version=0.0.4; '
+                                     'charset=utf-8')
@@ -0,0 +1,41 @@
+from flask import Response
+from flask_restful import Resource
+from typing import Union
+
+from profiler import profiler
+
+
+class Profiles(Resource):
+    """
+    Request profiles kept by the profiler, admin only
+    """
+
+    def get(self) -> Union[list, tuple]:
+        """
+        Summary of the stored profiles, newest first
+        """
+        if not profiler.is_admin():
+            return {'message': 'Admin token required'}, 403
+
+        return [profile.as_dict() for profile in profiler.profiles()]
+
+
+class Profile(Resource):
+    """
+    One request profile, admin only
+    """
+
+    def get(self, profile_id: str) -> Union[Response, tuple]:
+        """
+        Sampled stacks of the profile in collapsed format, one stack and its
+        sample count per line
+        """
+        if not profiler.is_admin():
+            return {'message': 'Admin token required'}, 403
+
+        profile = profiler.get(profile_id)
+
+        if not profile:
+            return {'message': f'No profile found with id {profile_id}'}, 404
+
+        return Response(profile.collapsed(), mimetype='text/plain')
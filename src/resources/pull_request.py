@@ -1,8 +1,87 @@
+from cache import commit_cache
+from compare import BranchNotFound, Comparison, compare
+from datetime import datetime
+from events import event_bus
+from flask import Response, request, stream_with_context, url_for
 from flask_restful import Resource, reqparse
-from git_repo import repository
-from typing import Union
+from git_repo import repositories, repository
+from typing import Optional, Tuple, Union
+from urllib.parse import urlencode
+from merge_queue import AlreadyQueued, merge_queue
+from mergeability import mergeability_worker
 from models import models
-import git
+from single_flight import single_flight
+from sqlalchemy.engine import Row
+import base64
+import binascii
+import git_refs
+import http_cache
+import streaming
+
+
+DIFF = 'text/x-diff'
+
+
+def _encode_cursor(pull_request: Row) -> str:
+    """
+    Pack the sort key of the last pull request of a page in an url safe token
+    """
+    key = f'{pull_request.created_at.isoformat()}|{pull_request.id}'
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor: str) -> Optional[Tuple[datetime, int]]:
+    """
+    Unpack a token built by _encode_cursor, None if it is not valid
+    """
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, pull_request_id = key.decode().rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(pull_request_id)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _as_dict(pull_request: Row,
+             tips: dict,
+             fields: Optional[list] = None) -> dict:
+    """
+    Pull request row of a listing restricted to fields with its precomputed
+    mergeability for the branch tips
+    """
+    if fields is None:
+        result = models.PullRequest.serialize(pull_request)
+    else:
+        result = models.PullRequest.serialize(
+            pull_request, (field for field in fields
+                           if field != 'mergeability'))
+
+    if fields is None or 'mergeability' in fields:
+        result['mergeability'] = mergeability_worker.get(pull_request, tips)
+
+    return result
+
+
+def _comparison(pull_request_id: int) -> Union[Comparison, tuple]:
+    """
+    Comparison of the branches of the pull request for id provided, or the
+    error response when it can not be made
+    """
+    pull_request = models.PullRequest.get_by_id(pull_request_id,
+                                                repositories.name())
+
+    if not pull_request:
+        error = {
+            'message': f'No pull request found with id {pull_request_id}'
+        }
+        return error, 404
+
+    try:
+        return compare.comparison(repository,
+                                  pull_request.destiny_branch,
+                                  pull_request.source_branch)
+    except BranchNotFound as error:
+        return {'message': f'No branch found with id {error}'}, 404
 
 
 class PullRequest(Resource):
@@ -31,6 +110,29 @@ class PullRequest(Resource):
                         required=True,
                         help="This field cannot be blank.")
 
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+    FIELDS = models.PullRequest.FIELDS + ('mergeability',)
+
+    list_parser = reqparse.RequestParser()
+
+    for name in models.PullRequest.FILTERS:
+        list_parser.add_argument(name, type=str, location='args')
+
+    list_parser.add_argument('fields',
+                             type=str,
+                             location='args')
+
+    list_parser.add_argument('limit',
+                             type=int,
+                             default=DEFAULT_LIMIT,
+                             location='args',
+                             help="Must be an integer.")
+
+    list_parser.add_argument('cursor',
+                             type=str,
+                             location='args')
+
     def post(self) -> Union[dict, tuple]:
         """
         Create a new pull request
@@ -46,24 +148,100 @@ class PullRequest(Resource):
         git_config = repository.config_reader()
 
         pull_request = models.PullRequest(**data)
+        pull_request.repository = repositories.name()
         pull_request.status = pull_request.OPEN
         pull_request.author = git_config.get_value('user', 'email')
         pull_request.create_or_update()
+        event_bus.publish('pull-request', pull_request.as_dict())
+        mergeability_worker.wake()
 
         return pull_request.as_dict(), 201
 
-    def get(self) -> list:
+    def get(self) -> Union[list, tuple]:
         """
-        TODO: implement pagination
-        TODO: implement filters
-        Retrieve a list of pull requests
+        Retrieve a page of pull requests sorted by creation, matching the
+        filters given and with only the fields asked. The link to the next
+        page is sent in the Link header. Streamed when the client asks for it,
+        from the cursor to the end of the listing.
+
+        Open pull requests report the mergeability computed in background for
+        the current branch tips, None while it is being computed
         """
-        pull_requests = models.PullRequest.get()
+        args = PullRequest.list_parser.parse_args()
+        stream_format = streaming.requested_format()
+
+        if not 0 < args['limit'] <= PullRequest.MAX_LIMIT:
+            error = {
+                'message': 'limit must be between 1 and '
+                           f'{PullRequest.MAX_LIMIT}'
+            }
+            return error, 400
+
+        after = None
+
+        if args['cursor'] is not None:
+            after = _decode_cursor(args['cursor'])
+
+            if after is None:
+                return {'message': f'Invalid cursor {args["cursor"]}'}, 400
 
-        if not pull_requests:
-            return []
+        fields = None
+        columns = None
 
-        return [pr.as_dict() for pr in pull_requests]
+        if args['fields'] is not None:
+            fields = [field.strip() for field in args['fields'].split(',')
+                      if field.strip()]
+            unknown = set(fields) - set(PullRequest.FIELDS)
+
+            if unknown:
+                return {'message': f'Invalid fields {", ".join(unknown)}'}, 400
+
+            columns = {field for field in fields if field != 'mergeability'}
+
+            if 'mergeability' in fields:
+                columns |= {'status', 'source_branch', 'destiny_branch'}
+
+        filters = {name: args[name] for name in models.PullRequest.FILTERS}
+        filters['repository'] = repositories.name()
+
+        if fields is None or 'mergeability' in fields:
+            tips = git_refs.branch_tips(repository)
+        else:
+            tips = {}
+
+        if stream_format:
+            pull_requests = models.PullRequest.iter_all(after, columns,
+                                                        **filters)
+            records = (_as_dict(pr, tips, fields) for pr in pull_requests)
+            return streaming.stream(records, stream_format)
+
+        def listing() -> Tuple[list, Optional[str]]:
+            # one extra pull request tells if there is a next page
+            pull_requests = models.PullRequest.get(args['limit'] + 1,
+                                                   after,
+                                                   columns,
+                                                   **filters)
+            page = [_as_dict(pr, tips, fields)
+                    for pr in pull_requests[:args['limit']]]
+
+            if len(pull_requests) <= args['limit']:
+                return page, None
+
+            return page, _encode_cursor(pull_requests[args['limit'] - 1])
+
+        # identical listings running at the same time share one query
+        key = ('pull-requests', filters['repository'],
+               tuple(sorted(request.args.items(multi=True))))
+        page, cursor = single_flight.do(key, listing)
+
+        if cursor is None:
+            return page
+
+        query = dict(request.args)
+        query['cursor'] = cursor
+        link = f'<{request.base_url}?{urlencode(query)}>; rel="next"'
+
+        return page, 200, {'Link': link}
 
 
 class MergePullRequest(Resource):
@@ -73,9 +251,11 @@ class MergePullRequest(Resource):
 
     def post(self, pull_request_id: int) -> Union[dict, tuple]:
         """
-        Merge pull request for id provided
+        Queue the merge of pull request for id provided, the merge job
+        returned can be polled at the Location sent in the response
         """
-        pull_request = models.PullRequest.get_by_id(pull_request_id)
+        pull_request = models.PullRequest.get_by_id(pull_request_id,
+                                                    repositories.name())
 
         if not pull_request:
             error = {
@@ -85,29 +265,40 @@ class MergePullRequest(Resource):
 
         if pull_request.status != models.PullRequest.OPEN:
             error = {
-                'message': f'Cannot merge a pull request with status {pull_request.status}'
+                'message': 'Cannot merge a pull request with status '
+                           f'{pull_request.status}'
             }
             return error, 400
 
-        repository.git.checkout(pull_request.destiny_branch)
-
         try:
-            result = repository.git.merge(pull_request.source_branch)
-        except git.exc.GitCommandError as err:
-            error = err.stdout
+            job = merge_queue.submit(pull_request)
+        except AlreadyQueued:
+            error = {
+                'message': f'Pull request {pull_request_id} is already '
+                           'queued for merge'
+            }
+            return error, 409
 
-            if error and 'conflict' in error.lower():
-                repository.git.merge('--abort')
-                error = f'Merge was aborted because of server response: {error}'
+        location = url_for('mergejob', job_id=job.id)
 
-            return {'message': error}, 400
-        except Exception as ex:
-            return {'message': str(ex)}, 500
-        else:
-            pull_request.status = models.PullRequest.MERGED
-            pull_request.commit = repository.head.commit.hexsha
-            pull_request.create_or_update()
-            return {'message': result or 'suceess'}
+        return job.as_dict(), 202, {'Location': location}
+
+
+class MergeJob(Resource):
+    """
+    Status of a queued pull request merge
+    """
+
+    def get(self, job_id: str) -> Union[dict, tuple]:
+        """
+        Search the merge job for id provided
+        """
+        job = merge_queue.get(job_id)
+
+        if not job:
+            return {'message': f'No merge job found with id {job_id}'}, 404
+
+        return job.as_dict()
 
 
 class ClosePullRequest(Resource):
@@ -119,7 +310,8 @@ class ClosePullRequest(Resource):
         """
         Merge pull request for id provided
         """
-        pull_request = models.PullRequest.get_by_id(pull_request_id)
+        pull_request = models.PullRequest.get_by_id(pull_request_id,
+                                                    repositories.name())
 
         if not pull_request:
             error = {
@@ -129,10 +321,224 @@ class ClosePullRequest(Resource):
 
         if pull_request.status != models.PullRequest.OPEN:
             error = {
-                'message': f'Cannot close a pull request with status {pull_request.status}'
+                'message': 'Cannot close a pull request with status '
+                           f'{pull_request.status}'
             }
             return error, 400
 
         pull_request.status = models.PullRequest.CLOSED
         pull_request.create_or_update()
+        event_bus.publish('pull-request', pull_request.as_dict())
         return {'message': 'suceess'}
+
+
+class PullRequestBatch(Resource):
+    """
+    Create and close many pull requests at once
+    """
+
+    MAX_OPERATIONS = 1000
+    ACTIONS = ('create', 'close')
+    CREATE_FIELDS = ('title', 'source_branch', 'destiny_branch')
+
+    parser = reqparse.RequestParser()
+
+    parser.add_argument('operations',
+                        type=dict,
+                        action='append',
+                        required=True,
+                        location='json',
+                        help="Must be a list of operations.")
+
+    def post(self) -> Union[dict, tuple]:
+        """
+        Apply the operations in order and answer the result of each one.
+        Every branch is validated against one scan of the refs and every
+        valid operation is stored in a single transaction, an invalid
+        operation fails alone
+        """
+        operations = PullRequestBatch.parser.parse_args()['operations']
+
+        if len(operations) > PullRequestBatch.MAX_OPERATIONS:
+            error = {
+                'message': f'At most {PullRequestBatch.MAX_OPERATIONS} '
+                           'operations are allowed'
+            }
+            return error, 400
+
+        # one scan of the refs and one query for the pull requests to close
+        tips = git_refs.branch_tips(repository)
+        ids = [operation.get('id') for operation in operations
+               if operation.get('action') == 'close']
+        existing = models.PullRequest.get_by_ids(
+            (pull_request_id for pull_request_id in ids
+             if isinstance(pull_request_id, int)), repositories.name())
+        author = None
+        results = []
+        changed = []
+
+        for operation in operations:
+            action = operation.get('action')
+
+            if action == 'create':
+                if author is None:
+                    author = repository.config_reader().get_value('user',
+                                                                  'email')
+
+                result = self._create(operation, tips, author)
+            elif action == 'close':
+                result = self._close(operation, existing)
+            else:
+                actions = ', '.join(PullRequestBatch.ACTIONS)
+                error = {
+                    'message': f'Invalid action {action}, must be one of '
+                               f'{actions}'
+                }
+                result = error, 400
+
+            body, status = result
+
+            if isinstance(body, models.PullRequest):
+                changed.append(body)
+                results.append({'status': status})
+            else:
+                results.append(dict(body, status=status))
+
+        if changed:
+            models.PullRequest.create_or_update_all(changed)
+
+        # ids of the new pull requests are known once they are stored
+        pull_requests = iter(changed)
+
+        for result in results:
+            if result['status'] < 400:
+                result['pull_request'] = next(pull_requests).as_dict()
+                event_bus.publish('pull-request', result['pull_request'])
+
+        if changed:
+            mergeability_worker.wake()
+
+        return {'results': results}
+
+    @staticmethod
+    def _create(operation: dict,
+                tips: dict,
+                author: str) -> Tuple[Union[models.PullRequest, dict], int]:
+        for field in PullRequestBatch.CREATE_FIELDS:
+            if not isinstance(operation.get(field), str) \
+                    or not operation[field]:
+                return {'message': f'{field} cannot be blank.'}, 400
+
+        for branch in ('source_branch', 'destiny_branch'):
+            if operation[branch] not in tips:
+                error = {'message': f'Invalid {branch} {operation[branch]}'}
+                return error, 400
+
+        description = operation.get('description')
+
+        if description is not None and not isinstance(description, str):
+            return {'message': 'description must be a string.'}, 400
+
+        pull_request = models.PullRequest(
+            title=operation['title'],
+            description=description,
+            source_branch=operation['source_branch'],
+            destiny_branch=operation['destiny_branch'])
+        pull_request.repository = repositories.name()
+        pull_request.status = pull_request.OPEN
+        pull_request.author = author
+
+        return pull_request, 201
+
+    @staticmethod
+    def _close(operation: dict,
+               existing: dict) -> Tuple[Union[models.PullRequest, dict], int]:
+        pull_request_id = operation.get('id')
+        pull_request = (existing.get(pull_request_id)
+                        if isinstance(pull_request_id, int) else None)
+
+        if not pull_request:
+            error = {
+                'message': f'No pull request found with id {pull_request_id}'
+            }
+            return error, 404
+
+        if pull_request.status != models.PullRequest.OPEN:
+            error = {
+                'message': 'Cannot close a pull request with status '
+                           f'{pull_request.status}'
+            }
+            return error, 400
+
+        pull_request.status = models.PullRequest.CLOSED
+
+        return pull_request, 200
+
+
+class PullRequestCommits(Resource):
+    """
+    Commits a pull request brings to its destiny branch
+    """
+
+    def get(self, pull_request_id: int) -> Union[dict, tuple]:
+        """
+        Commits reachable from the source branch and not from the destiny
+        branch, newest first, up to the configured cap
+        """
+        comparison = _comparison(pull_request_id)
+
+        if isinstance(comparison, tuple):
+            return comparison
+
+        tag = http_cache.etag('pull-request-commits', *comparison.key)
+        not_modified = http_cache.not_modified(tag)
+
+        if not_modified:
+            return not_modified
+
+        shas, truncated = compare.get_commits(comparison)
+        result = comparison.as_dict()
+        result['commits'] = commit_cache.load(repository, shas)
+        result['truncated'] = truncated
+
+        return result, 200, http_cache.headers(tag)
+
+
+class PullRequestDiff(Resource):
+    """
+    Changes a pull request brings to its destiny branch
+    """
+
+    def get(self, pull_request_id: int) -> Union[dict, tuple, Response]:
+        """
+        Lines added and deleted by file since the merge base of the branches.
+        The unified diff is streamed instead when the client accepts
+        text/x-diff or asks for format=patch, cut at the configured size
+        with a truncation marker
+        """
+        comparison = _comparison(pull_request_id)
+
+        if isinstance(comparison, tuple):
+            return comparison
+
+        patch = (request.accept_mimetypes.best == DIFF
+                 or request.args.get('format') == 'patch')
+        tag = http_cache.etag('pull-request-diff', *comparison.key, patch)
+        not_modified = http_cache.not_modified(tag)
+
+        if not_modified:
+            return not_modified
+
+        headers = http_cache.headers(tag)
+
+        if not patch:
+            result = comparison.as_dict()
+            result.update(compare.get_diffstat(comparison))
+            return result, 200, headers
+
+        diff = compare.get_diff(comparison)
+
+        if diff is None:
+            diff = stream_with_context(compare.iter_diff(comparison))
+
+        return Response(diff, mimetype=DIFF, headers=headers)
@@ -0,0 +1,138 @@
+import mimetypes
+from flask import Response, request, stream_with_context
+from flask_restful import Resource
+from typing import Union
+from werkzeug.datastructures import ContentRange
+
+from git_repo import repository
+from git_tree import iter_blob, trees
+import git_refs
+import http_cache
+
+
+def _lookup(branch_name: str, path: str) -> Union[dict, tuple]:
+    """
+    Entry at path on the tip of the branch, or the error response
+    """
+    tip = git_refs.resolve_branch(repository, branch_name)
+
+    if tip is None:
+        return {'message': f'No branch found with id {branch_name}'}, 404
+
+    entry = trees.lookup(repository, tip, path)
+
+    if entry is None:
+        return {'message': f'No file found at {path}'}, 404
+
+    return entry
+
+
+class Tree(Resource):
+    """
+    Resource for the directories of a branch
+    """
+
+    def get(self, branch_name: str, path: str = '') -> Union[dict, tuple]:
+        """
+        Entries of the directory at path on the tip of the branch, the root
+        directory without path. Directories are validated by their tree SHA
+        """
+        entry = _lookup(branch_name, path)
+
+        if isinstance(entry, tuple):
+            return entry
+
+        if entry['type'] != 'tree':
+            return {'message': f'{path} is not a directory'}, 400
+
+        tag = http_cache.etag('tree', entry['sha'])
+        not_modified = http_cache.not_modified(tag)
+
+        if not_modified:
+            return not_modified
+
+        prefix = path.strip('/')
+        entries = [dict(child,
+                        path=f'{prefix}/{child["name"]}' if prefix
+                        else child['name'])
+                   for child in trees.entries(repository, entry['sha'])]
+
+        return {'path': prefix,
+                'sha': entry['sha'],
+                'entries': entries}, 200, http_cache.headers(tag)
+
+
+class Blob(Resource):
+    """
+    Resource for the files of a branch
+    """
+
+    def get(self, branch_name: str, path: str) -> Union[Response, tuple]:
+        """
+        Stream the content of the file at path on the tip of the branch. A
+        single byte range is honored with a 206 response, the file is
+        never loaded whole in memory
+        """
+        entry = _lookup(branch_name, path)
+
+        if isinstance(entry, tuple):
+            return entry
+
+        if entry['type'] != 'blob':
+            return {'message': f'{path} is not a file'}, 400
+
+        tag = http_cache.etag('blob', entry['sha'])
+        not_modified = http_cache.not_modified(tag)
+
+        if not_modified:
+            return not_modified
+
+        size = entry['size']
+        headers = http_cache.headers(tag)
+        headers['Accept-Ranges'] = 'bytes'
+        mimetype = (mimetypes.guess_type(path)[0]
+                    or 'application/octet-stream')
+        byte_range = self._range(tag, size)
+
+        if byte_range is False:
+            headers['Content-Range'] = ContentRange('bytes', None, None,
+                                                    size).to_header()
+            return Response(status=416, headers=headers)
+
+        start, stop = byte_range or (0, size)
+        status = 200
+
+        if byte_range:
+            status = 206
+            headers['Content-Range'] = ContentRange('bytes', start, stop,
+                                                    size).to_header()
+
+        headers['Content-Length'] = str(stop - start)
+        body = stream_with_context(
+            iter_blob(repository, entry['sha'], size, start, stop))
+
+        return Response(body, status=status, mimetype=mimetype,
+                        headers=headers)
+
+    @staticmethod
+    def _range(tag: str, size: int) -> Union[tuple, None, bool]:
+        """
+        Start and stop of the byte range asked, None to send the whole file
+        and False when the range can not be satisfied
+        """
+        if request.range is None:
+            return None
+
+        # the range was computed on another version of the file
+        if (request.if_range.etag is not None
+                and request.if_range.etag != tag
+                or request.if_range.date is not None):
+            return None
+
+        byte_range = request.range.range_for_length(size)
+
+        if byte_range is None:
+            # several ranges are not supported, a bad one is unsatisfiable
+            return None if len(request.range.ranges) > 1 else False
+
+        return byte_range
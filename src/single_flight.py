@@ -0,0 +1,87 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class _Call:
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce identical reads running at the same time: the first caller of a
+    key computes it, the callers arriving while it runs wait for its result
+    or get the exception it raised. Nothing is kept once the call finished,
+    a later caller computes again.
+
+    A waiter gives up after timeout seconds and computes the key itself, so
+    a stuck computation never blocks the others for longer
+    """
+
+    def __init__(self):
+        self.timeout = 30.0
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.timeout = app.config['SINGLE_FLIGHT_TIMEOUT']
+
+    def do(self,
+           key: Hashable,
+           compute: Callable[[], Any],
+           timeout: Optional[float] = None) -> Any:
+        """
+        Result of compute for key, shared with the identical calls running
+        at the same time. The result is shared, it must not be modified
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if call.done.wait(self.timeout if timeout is None else timeout):
+                if call.error is not None:
+                    raise call.error
+
+                return call.result
+
+            with self._lock:
+                self.timeouts += 1
+
+            return compute()
+
+        try:
+            call.result = compute()
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            # callers arriving from now on compute again
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+    def stats(self) -> dict:
+        return {'size': len(self._calls),
+                'hits': self.coalesced,
+                'misses': self.leaders,
+                'timeouts': self.timeouts}
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,72 @@
+import json
+from flask import Response, request, stream_with_context
+from typing import Iterable, Iterator, Optional
+
+
+NDJSON = 'application/x-ndjson'
+JSON = 'application/json'
+
+# records are grouped in chunks of about this many bytes so the server does
+# not flush one tiny write per record
+CHUNK_SIZE = 16 * 1024
+
+
+def requested_format() -> Optional[str]:
+    """
+    Streaming format asked by the client: NDJSON when it is the preferred
+    type in the Accept header, a chunked JSON array when the query string has
+    stream=true, or None to answer with a regular response
+    """
+    if request.accept_mimetypes.best == NDJSON:
+        return NDJSON
+
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return JSON
+
+    return None
+
+
+def _chunks(parts: Iterable[str]) -> Iterator[str]:
+    buffer = []
+    size = 0
+
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _ndjson(records: Iterable[dict]) -> Iterator[str]:
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def _json_array(records: Iterable[dict]) -> Iterator[str]:
+    separator = '['
+
+    for record in records:
+        yield separator + json.dumps(record)
+        separator = ','
+
+    yield '[]' if separator == '[' else ']'
+
+
+def stream(records: Iterable[dict], mimetype: str, **kwargs) -> Response:
+    """
+    Response sending records as they are produced, memory use is bounded by
+    one chunk whatever the number of records. The request context is kept
+    alive while the body is generated so records can still come from git or
+    the database session
+    """
+    encode = _ndjson if mimetype == NDJSON else _json_array
+
+    return Response(stream_with_context(_chunks(encode(records))),
+                    mimetype=mimetype,
+                    **kwargs)
@@ -1,6 +1,9 @@
 import pytest
 import dotenv
 import os
+import shutil
+import subprocess
+import tempfile
 
 
 @pytest.fixture(scope='class', autouse=True)
@@ -19,3 +22,55 @@ def mock_pull_request() -> dict:
             'description': 'Great feature getting merge',
             'source_branch': 'dev',
             'destiny_branch': 'master'}
+
+
+class ScratchRepo:
+    """
+    Repository created under REPOS_ROOT for one test, served by the api at
+    /repos/:name:
+    """
+
+    def __init__(self, root: str):
+        self.path = tempfile.mkdtemp(prefix='scratch-', dir=root)
+        self.name = os.path.basename(self.path)
+        self.git('init', '-q', '-b', 'master')
+        # pull requests are authored by the configured user
+        self.git('config', 'user.name', 'Scratch')
+        self.git('config', 'user.email', 's@example.com')
+
+    def git(self, *args: str, timestamp: int = 1600000000) -> str:
+        """
+        Run git in the repository, commits are made at timestamp
+        """
+        date = f'{timestamp} +0000'
+        env = dict(os.environ,
+                   GIT_AUTHOR_NAME='Scratch', GIT_AUTHOR_EMAIL='s@example.com',
+                   GIT_COMMITTER_NAME='Scratch',
+                   GIT_COMMITTER_EMAIL='s@example.com',
+                   GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        return subprocess.run(['git', *args], cwd=self.path, env=env,
+                              check=True, capture_output=True,
+                              text=True).stdout.strip()
+
+    def commit(self, message: str, timestamp: int) -> str:
+        """
+        Commit a change to a file named after message, return its SHA
+        """
+        with open(os.path.join(self.path, message), 'w') as file:
+            file.write(f'{message}\n')
+
+        self.git('add', message)
+        self.git('commit', '-q', '-m', message, timestamp=timestamp)
+        return self.git('rev-parse', 'HEAD')
+
+
+@pytest.fixture
+def scratch_repo() -> ScratchRepo:
+    root = os.environ.get('REPOS_ROOT')
+
+    if not root or not os.path.isdir(root):
+        pytest.skip('REPOS_ROOT is not a directory')
+
+    repo = ScratchRepo(root)
+    yield repo
+    shutil.rmtree(repo.path)
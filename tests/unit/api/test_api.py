@@ -1,4 +1,7 @@
+import json
+import os
 import requests
+import time
 
 
 class TestApi:
@@ -24,6 +27,61 @@ class TestApi:
         filds_must_have = ['name', 'commit', 'datetime']
         assert all(field in response_body[0] for field in filds_must_have)
 
+    def test_get_branches_ndjson(self, api_url: str):
+        """
+        Get /branches with Accept: application/x-ndjson
+        - Response must be success with code 200
+        - Response content type must be application/x-ndjson
+        - Every line must be a branch with name, commit and datetime elements
+        (Test repo must have at least one branch)
+        """
+        response = requests.get(f'{api_url}/branches',
+                                headers={'Accept': 'application/x-ndjson'})
+        # validate success response
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        # validate one branch per line
+        branches = [json.loads(line) for line in response.iter_lines()]
+        assert branches
+        filds_must_have = ['name', 'commit', 'datetime']
+        assert all(field in branch
+                   for branch in branches for field in filds_must_have)
+
+    def test_get_branches_pagination(self, api_url: str):
+        """
+        Get /branches?limit=1
+        - Response must be success with code 200
+        - Response must be a list with one branch
+        - Response must have a Link header to the next page
+        - Next page must start after the branch of the first page
+        (Test repo must have master and dev branches)
+        """
+        response = requests.get(f'{api_url}/branches', params={'limit': 1})
+        # validate success response
+        assert response.status_code == 200
+        first_page = response.json()
+        assert len(first_page) == 1
+        # validate next page
+        assert 'next' in response.links
+        next_response = requests.get(response.links['next']['url'])
+        assert next_response.status_code == 200
+        second_page = next_response.json()
+        assert second_page[0]['name'] > first_page[0]['name']
+
+    def test_get_branches_prefix(self, api_url: str):
+        """
+        Get /branches?prefix=ma
+        - Response must be success with code 200
+        - Every branch name must start with the prefix
+        (Test repo must have a branch named master)
+        """
+        response = requests.get(f'{api_url}/branches', params={'prefix': 'ma'})
+        # validate success response
+        assert response.status_code == 200
+        branches = response.json()
+        assert 'master' in [branch['name'] for branch in branches]
+        assert all(branch['name'].startswith('ma') for branch in branches)
+
     def test_get_branch(self, api_url: str):
         """
         Get /branches/:branch_name:
@@ -44,6 +102,126 @@ class TestApi:
         assert all(field in branch for field in filds_must_have)
         assert all(isinstance(branch[field], str) for field in filds_must_have)
 
+    def test_get_branch_ahead_behind(self, api_url: str):
+        """
+        Get /branches/:branch_name:?base=master
+        - Response must be success with code 200
+        - Branch must report how many commits it is ahead and behind base
+        - A branch is neither ahead nor behind itself
+        - Unknown base must fail with code 400
+        """
+        # the reachability index is built in background when the server
+        # starts, counts are None until then
+        for _ in range(50):
+            response = requests.get(f'{api_url}/branches/master',
+                                    params={'base': 'master'})
+            # validate success response
+            assert response.status_code == 200
+            body = response.json()
+
+            if body['ahead'] is not None:
+                break
+
+            time.sleep(0.1)
+
+        # validate counts against itself
+        assert body['ahead'] == 0
+        assert body['behind'] == 0
+
+        # validate every listed branch reports its counts
+        response = requests.get(f'{api_url}/branches')
+        assert all('ahead' in branch and 'behind' in branch
+                   for branch in response.json())
+
+        # validate unknown base
+        response = requests.get(f'{api_url}/branches',
+                                params={'base': 'does-not-exist'})
+        assert response.status_code == 400
+
+    def test_get_branch_stats(self, api_url: str):
+        """
+        Get /branches/:branch_name:/stats
+        - Response must be success with code 200
+        - Commits by author and by interval must add up to the total
+        - Unknown branch must fail with code 404
+        - Invalid interval must fail with code 400
+        """
+        response = requests.get(f'{api_url}/branches/master/stats',
+                                params={'interval': 'day'})
+        # validate success response
+        assert response.status_code == 200
+        stats = response.json()
+        assert stats['commits'] > 0
+        # validate aggregates
+        assert sum(author['commits'] for author in stats['authors']) == \
+            stats['commits']
+        assert sum(day['commits'] for day in stats['activity']) == \
+            stats['commits']
+        for author in stats['authors']:
+            assert all(field in author for field in
+                       ('author', 'email', 'files', 'additions', 'deletions',
+                        'first_day', 'last_day'))
+
+        # validate unknown branch
+        response = requests.get(f'{api_url}/branches/does-not-exist/stats')
+        assert response.status_code == 404
+
+        # validate invalid interval
+        response = requests.get(f'{api_url}/branches/master/stats',
+                                params={'interval': 'year'})
+        assert response.status_code == 400
+
+    def test_get_branch_stats_moves(self, api_url: str, scratch_repo):
+        """
+        Get /repos/:repo:/branches/:branch_name:/stats as the branch moves
+        - Commits must match git rev-list --count after new commits, after a
+          force push and for a branch seeded from master
+        """
+        url = f'{api_url}/repos/{scratch_repo.name}/branches'
+
+        def assert_commits(branch: str):
+            response = requests.get(f'{url}/{branch}/stats')
+            assert response.status_code == 200
+            expected = scratch_repo.git('rev-list', '--count', branch)
+            assert response.json()['commits'] == int(expected)
+
+        for index in range(3):
+            scratch_repo.commit(f'base-{index}', 1600000000 + index * 100)
+        assert_commits('master')
+
+        # validate new commits
+        for index in range(3):
+            scratch_repo.commit(f'master-{index}', 1600001000 + index * 100)
+        assert_commits('master')
+
+        # validate a branch seeded from master
+        scratch_repo.git('checkout', '-q', '-b', 'dev', 'HEAD~2')
+        scratch_repo.commit('dev', 1600002000)
+        scratch_repo.git('checkout', '-q', 'master')
+        assert_commits('dev')
+
+        # validate a force push
+        scratch_repo.git('reset', '-q', '--hard', 'HEAD~4')
+        scratch_repo.commit('rewritten', 1600003000)
+        assert_commits('master')
+        assert_commits('dev')
+
+    def test_get_branch_not_modified(self, api_url: str):
+        """
+        Get /branches/:branch_name: with If-None-Match
+        - Response must have an ETag header
+        - Sending the ETag back must answer 304 with an empty body
+        (Test repo must have at least one branch named master)
+        """
+        response = requests.get(f'{api_url}/branches/master')
+        assert response.status_code == 200
+        # validate the response can be revalidated
+        etag = response.headers['ETag']
+        cached_response = requests.get(f'{api_url}/branches/master',
+                                       headers={'If-None-Match': etag})
+        assert cached_response.status_code == 304
+        assert not cached_response.content
+
     def test_not_existing_branch(self, api_url: str):
         """
         Get /branches/:branch_name:
@@ -62,6 +240,20 @@ class TestApi:
         assert 'message' in response_body
         assert isinstance(response_body['message'], str)
 
+    def test_not_existing_repository(self, api_url: str):
+        """
+        Get /repos/:repo:/branches
+        Test not existing repository
+        - Response must be not found with code 404
+        - Response must be dict with message
+        """
+        response = requests.get(
+            f'{api_url}/repos/not-existing-repository/branches')
+        # validate not found response
+        assert response.status_code == 404
+        # validate error message
+        assert 'message' in response.json()
+
     def test_get_commits(self, api_url: str):
         """
         Get /branches/:branch_name:/commits
@@ -82,6 +274,63 @@ class TestApi:
         filds_must_have = ['commit', 'author', 'email', 'files', 'datetime']
         assert all(field in commit for field in filds_must_have)
 
+    def test_get_commits_pagination(self, api_url: str):
+        """
+        Get /branches/:branch_name:/commits?limit=1
+        - Response must be success with code 200
+        - Response must be a list with one element
+        - Response must have a Link header to the next page
+        - Next page must not repeat the commit of the first page
+        (Test repo must have at least one branch with two commits)
+        """
+        response = requests.get(f'{api_url}/branches/master/commits',
+                                params={'limit': 1})
+        # validate success response
+        assert response.status_code == 200
+        first_page = response.json()
+        assert isinstance(first_page, list)
+        assert len(first_page) == 1
+        # validate next page link
+        assert 'next' in response.links
+        next_response = requests.get(response.links['next']['url'])
+        assert next_response.status_code == 200
+        second_page = next_response.json()
+        assert len(second_page) == 1
+        assert second_page[0]['commit'] != first_page[0]['commit']
+
+    def test_get_commits_pagination_merge(self, api_url: str,
+                                          scratch_repo):
+        """
+        Get /repos/:repo:/branches/master/commits?limit=2 page by page
+        - Pages must list every commit of the branch once, in the order of
+          git rev-list --date-order, with a merged branch older than several
+          commits of master
+        """
+        scratch_repo.commit('base', 1600000000)
+        scratch_repo.git('checkout', '-q', '-b', 'side')
+        scratch_repo.commit('side', 1600000100)
+        scratch_repo.git('checkout', '-q', 'master')
+        for index in range(1, 5):
+            scratch_repo.commit(f'master-{index}', 1600000100 + index * 100)
+        scratch_repo.git('merge', '-q', '--no-ff', '-m', 'merge', 'side',
+                         timestamp=1600001000)
+
+        url = f'{api_url}/repos/{scratch_repo.name}/branches/master/commits'
+        params = {'limit': 2}
+        commits = []
+        while url:
+            response = requests.get(url, params=params)
+            assert response.status_code == 200
+            commits += [commit['commit'] for commit in response.json()]
+            url = response.links.get('next', {}).get('url')
+            params = None
+
+        # validate against git
+        expected = scratch_repo.git('rev-list', '--date-order',
+                                    'master').split()
+        assert len(expected) == 7
+        assert commits == expected
+
     def test_get_commit(self, api_url: str):
         """
         Get /branches/:branch_name:/commits/:commit:
@@ -92,7 +341,8 @@ class TestApi:
          94181465ecc02fbc9f3d0ad25d9f6c59e166a3e1)
         """
         test_commit = '94181465ecc02fbc9f3d0ad25d9f6c59e166a3e1'
-        response = requests.get(f'{api_url}/branches/master/commits/{test_commit}')
+        response = requests.get(
+            f'{api_url}/branches/master/commits/{test_commit}')
         # validate success response
         assert response.status_code == 200
         # validate response fields
@@ -110,7 +360,8 @@ class TestApi:
         - Response must have one element message of type str
         """
         commit_sha = 'thisisawrongshahex'
-        response = requests.get(f'{api_url}/branches/master/commits/{commit_sha}')
+        response = requests.get(
+            f'{api_url}/branches/master/commits/{commit_sha}')
         # validate not found response
         assert response.status_code == 404
         # validate response objetc type dict
@@ -120,6 +371,158 @@ class TestApi:
         assert 'message' in response_body
         assert isinstance(response_body['message'], str)
 
+    def test_commit_of_other_repository(self, api_url: str, scratch_repo):
+        """
+        Get /repos/:repo:/branches/master/commits/:commit_sha:
+        Test commit of another repository
+        - Response must be fail with code 404 even once the commit is cached
+          by the repository it belongs to
+        """
+        scratch_repo.commit('base', 1600000000)
+        response = requests.get(f'{api_url}/branches/master/commits')
+        commit_sha = response.json()[0]['commit']
+        # cache the commit from its own repository
+        response = requests.get(
+            f'{api_url}/branches/master/commits/{commit_sha}')
+        assert response.status_code == 200
+
+        response = requests.get(f'{api_url}/repos/{scratch_repo.name}'
+                                f'/branches/master/commits/{commit_sha}')
+        # validate not found response
+        assert response.status_code == 404
+        assert 'message' in response.json()
+
+    def test_search_commits(self, api_url: str):
+        """
+        Get /commits/search?q=
+        Test commit search
+        - Response must be success with code 200
+        - Response must be a list of commits with a score
+        - Last commit of master must be found by its message
+        - Search without words must fail with code 400
+        """
+        commits_response = requests.get(f'{api_url}/branches/master/commits',
+                                         params={'limit': 1})
+        commit = commits_response.json()[0]
+        words = ' '.join(commit['message'].split()[:3])
+
+        # the index is updated in background when the server starts
+        for _ in range(50):
+            response = requests.get(f'{api_url}/commits/search',
+                                    params={'q': words, 'limit': 100})
+            # validate success response
+            assert response.status_code == 200
+            results = response.json()
+            assert isinstance(results, list)
+
+            if commit['commit'] in [result['commit'] for result in results]:
+                break
+
+            time.sleep(0.1)
+
+        # validate the commit was found and ranked
+        assert commit['commit'] in [result['commit'] for result in results]
+        assert all('score' in result for result in results)
+
+        # validate a search without words fails
+        empty_response = requests.get(f'{api_url}/commits/search',
+                                      params={'q': '"*'})
+        assert empty_response.status_code == 400
+
+    def test_search_commits_pagination(self, api_url: str, scratch_repo):
+        """
+        Get /repos/:repo:/commits/search?q=
+        Test commit search pages
+        - Following the Link headers must return every match once
+        - A next page must fail with code 410 once commits were indexed
+        """
+        for timestamp in range(1600000000, 1600000300, 100):
+            scratch_repo.commit(f'needle {timestamp}', timestamp)
+
+        url = f'{api_url}/repos/{scratch_repo.name}/commits/search'
+        response = requests.get(url, params={'q': 'needle', 'limit': 1})
+        shas = []
+
+        while True:
+            assert response.status_code == 200
+            shas += [result['commit'] for result in response.json()]
+
+            if 'next' not in response.links:
+                break
+
+            response = requests.get(response.links['next']['url'])
+
+        # validate every commit was found once
+        assert len(shas) == 3
+        assert len(set(shas)) == 3
+
+        response = requests.get(url, params={'q': 'needle', 'limit': 1})
+        scratch_repo.commit('needle 1600000300', 1600000300)
+
+        # validate the cursor expired with the new commit
+        next_response = requests.get(response.links['next']['url'])
+        assert next_response.status_code == 410
+
+    def test_get_tree(self, api_url: str):
+        """
+        Get /branches/:branch_name:/tree
+        - Response must be success with code 200
+        - Response must list the entries of the root directory
+        - Unknown path must fail with code 404
+        """
+        response = requests.get(f'{api_url}/branches/master/tree')
+        # validate success response
+        assert response.status_code == 200
+        body = response.json()
+        assert body['path'] == ''
+        # validate entries
+        assert len(body['entries']) > 0
+        for entry in body['entries']:
+            assert entry['type'] in ('blob', 'tree', 'commit')
+            assert entry['path'] == entry['name']
+
+        # validate not modified response
+        response = requests.get(
+            f'{api_url}/branches/master/tree',
+            headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+        # validate unknown path
+        response = requests.get(
+            f'{api_url}/branches/master/tree/does-not-exist')
+        assert response.status_code == 404
+
+    def test_get_blob(self, api_url: str):
+        """
+        Get /branches/:branch_name:/blob/:path:
+        - Response must be success with code 200 and the whole file
+        - Range request must answer 206 with the bytes asked
+        - Unsatisfiable range must fail with code 416
+        """
+        response = requests.get(f'{api_url}/branches/master/tree')
+        blob = next(entry for entry in response.json()['entries']
+                    if entry['type'] == 'blob' and entry['size'] > 0)
+        url = f'{api_url}/branches/master/blob/{blob["path"]}'
+
+        response = requests.get(url)
+        # validate success response
+        assert response.status_code == 200
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert len(response.content) == blob['size']
+        content = response.content
+
+        # validate range response
+        response = requests.get(url, headers={'Range': 'bytes=0-0'})
+        assert response.status_code == 206
+        assert response.content == content[:1]
+        assert response.headers['Content-Range'] == \
+            f'bytes 0-0/{blob["size"]}'
+
+        # validate unsatisfiable range
+        response = requests.get(
+            url, headers={'Range': f'bytes={blob["size"]}-'})
+        assert response.status_code == 416
+
     def test_post_pull_requests(self, api_url: str, mock_pull_request: dict):
         """
         Post /pull-requests
@@ -164,15 +567,113 @@ class TestApi:
         assert isinstance(pull_request, dict)
         filds_must_have = ['id', 'title', 'description', 'status', 'author',
                            'source_branch', 'destiny_branch', 'commit',
-                           'created_at']
+                           'created_at', 'mergeability']
         assert all(field in pull_request for field in filds_must_have)
 
+    def test_get_pull_requests_filters(self, api_url: str,
+                                       mock_pull_request: dict):
+        """
+        Get /pull-requests?status=open&fields=id,status&limit=1
+        - Response must be success with code 200
+        - Response must be a list with at most one pull request
+        - Body elements must have only the id and status fields
+        - Body elements must have status open
+        """
+        # One pull request is created in order to have at least one result
+        post_response = requests.post(f'{api_url}/pull-requests',
+                                      mock_pull_request)
+        assert post_response.status_code == 201
+        # validate GET
+        response = requests.get(f'{api_url}/pull-requests',
+                                params={'status': 'open',
+                                        'fields': 'id,status',
+                                        'limit': 1})
+        assert response.status_code == 200
+        pull_request_collection = response.json()
+        assert len(pull_request_collection) == 1
+        # validate projection and filter
+        pull_request = pull_request_collection[0]
+        assert set(pull_request) == {'id', 'status'}
+        assert pull_request['status'] == 'open'
+
+    def test_get_pull_requests_stream(self, api_url: str,
+                                      mock_pull_request: dict):
+        """
+        Get /pull-requests?stream=true
+        - Response must be success with code 200
+        - Response must be a list with every pull request
+        """
+        # One pull request is created in order to have at least one result
+        post_response = requests.post(f'{api_url}/pull-requests',
+                                      mock_pull_request)
+        assert post_response.status_code == 201
+        # validate GET
+        response = requests.get(f'{api_url}/pull-requests',
+                                params={'stream': 'true'})
+        assert response.status_code == 200
+        ids = [pull_request['id'] for pull_request in response.json()]
+        assert post_response.json()['id'] in ids
+
+    def test_get_pull_request_commits(self, api_url: str,
+                                      mock_pull_request: dict):
+        """
+        Get /pull-requests/:pull_request_id:/commits
+        - Response must be success with code 200
+        - Response must be dict with the merge base, the source tip and the
+          commits the source branch brings
+        """
+        # One pull request is created for test
+        post_response = requests.post(f'{api_url}/pull-requests',
+                                      mock_pull_request)
+        assert post_response.status_code == 201
+        pull_request = post_response.json()
+
+        response = requests.get(
+            f'{api_url}/pull-requests/{pull_request["id"]}/commits')
+        # validate success response
+        assert response.status_code == 200
+        body = response.json()
+        assert isinstance(body['commits'], list)
+        for key in ('merge_base', 'source', 'truncated'):
+            assert key in body
+
+    def test_get_pull_request_diff(self, api_url: str,
+                                   mock_pull_request: dict):
+        """
+        Get /pull-requests/:pull_request_id:/diff
+        - Response must be success with code 200
+        - Response must be dict with the diffstat by file
+        - Unified diff must be sent as text/x-diff with format=patch
+        """
+        # One pull request is created for test
+        post_response = requests.post(f'{api_url}/pull-requests',
+                                      mock_pull_request)
+        assert post_response.status_code == 201
+        pull_request = post_response.json()
+        url = f'{api_url}/pull-requests/{pull_request["id"]}/diff'
+
+        response = requests.get(url)
+        # validate success response
+        assert response.status_code == 200
+        body = response.json()
+        assert isinstance(body['files'], list)
+        for key in ('additions', 'deletions', 'changed_files', 'truncated'):
+            assert key in body
+
+        patch_response = requests.get(url, params={'format': 'patch'})
+        # validate unified diff
+        assert patch_response.status_code == 200
+        assert patch_response.headers['Content-Type'].startswith(
+            'text/x-diff')
+
     def test_merge_pull_request(self, api_url: str, mock_pull_request: dict):
         """
         Post /pull-requests/:pull_request_id:/merge
         Test pull request merging
-        - Response must be success with code 200
-        - Response must be dict
+        - Response must be accepted with code 202
+        - Response must be a dict describing the merge job
+        - Merge job must be retrievable from /merge-jobs/:job_id: until it
+          succeeds
         - Pull requests merged cannot be merged again
             * Validate merge response code for merged PR is 400
         """
@@ -187,10 +688,24 @@ class TestApi:
         merge_response = requests.post(
             f'{api_url}/pull-requests/{pull_request["id"]}/merge'
         )
-        # validate merge success
-        assert merge_response.status_code == 200
-        merge_result = merge_response.json()
-        assert isinstance(merge_result, dict)
+        # validate merge queued
+        assert merge_response.status_code == 202
+        merge_job = merge_response.json()
+        assert isinstance(merge_job, dict)
+
+        # validate merge job finishes with success
+        for _ in range(50):
+            job_response = requests.get(
+                f'{api_url}/merge-jobs/{merge_job["id"]}')
+            assert job_response.status_code == 200
+            merge_job = job_response.json()
+
+            if merge_job['status'] not in ('queued', 'running'):
+                break
+
+            time.sleep(0.1)
+
+        assert merge_job['status'] == 'succeeded'
 
         # validate that a merged pull request cannot be merged again
         merge_try_2_response = requests.post(
@@ -198,6 +713,63 @@ class TestApi:
         )
         assert merge_try_2_response.status_code == 400
 
+    def test_merge_checked_out_branch(self, api_url: str,
+                                      mock_pull_request: dict,
+                                      scratch_repo):
+        """
+        Post /repos/:repo:/pull-requests/:pull_request_id:/merge
+        Test merging into the branch checked out in the repository
+        - Merge job must succeed
+        - The work tree must have the merged files and no pending change
+        """
+        scratch_repo.commit('base', 1600000000)
+        scratch_repo.git('checkout', '-q', '-b', 'dev')
+        scratch_repo.commit('dev', 1600000100)
+        scratch_repo.git('checkout', '-q', 'master')
+        scratch_repo.commit('master', 1600000200)
+
+        url = f'{api_url}/repos/{scratch_repo.name}/pull-requests'
+        pull_request = requests.post(url, json=mock_pull_request).json()
+        merge_job = requests.post(
+            f'{url}/{pull_request["id"]}/merge').json()
+
+        for _ in range(50):
+            merge_job = requests.get(
+                f'{api_url}/merge-jobs/{merge_job["id"]}').json()
+
+            if merge_job['status'] not in ('queued', 'running'):
+                break
+
+            time.sleep(0.1)
+
+        assert merge_job['status'] == 'succeeded'
+        # validate the checkout followed the branch
+        assert scratch_repo.git('status', '--porcelain') == ''
+        assert os.path.exists(os.path.join(scratch_repo.path, 'dev'))
+
+    def test_mergeability_of_deleted_branch(self, api_url: str,
+                                            mock_pull_request: dict,
+                                            scratch_repo):
+        """
+        Get /repos/:repo:/pull-requests
+        Test the mergeability of a pull request whose branch was deleted
+        - Mergeability must not be computable and tell the reason
+        """
+        scratch_repo.commit('base', 1600000000)
+        scratch_repo.git('branch', 'dev')
+
+        url = f'{api_url}/repos/{scratch_repo.name}/pull-requests'
+        pull_request = requests.post(url, json=mock_pull_request).json()
+        scratch_repo.git('branch', '-D', 'dev')
+
+        response = requests.get(url)
+        assert response.status_code == 200
+
+        pull_requests = {item['id']: item for item in response.json()}
+        mergeability = pull_requests[pull_request['id']]['mergeability']
+        assert mergeability['mergeable'] is None
+        assert mergeability['reason'] == 'Branch dev not found'
+
     def test_close_pull_request(self, api_url: str, mock_pull_request: dict):
         """
         Post /pull-requests/:pull_request_id:/close
@@ -226,3 +798,96 @@ class TestApi:
             f'{api_url}/pull-requests/{pull_request["id"]}/close'
         )
         assert close_try_2_response.status_code == 400
+
+    def test_batch_pull_requests(self, api_url: str,
+                                 mock_pull_request: dict):
+        """
+        Post /pull-requests/batch
+        - Response must be success with code 200
+        - Every operation must have its own result, in order
+        - Invalid operations must fail alone
+        """
+        create = dict(mock_pull_request, action='create')
+        response = requests.post(
+            f'{api_url}/pull-requests/batch',
+            json={'operations': [create,
+                                 create,
+                                 dict(create, source_branch='no-branch'),
+                                 {'action': 'close', 'id': 0}]})
+        # validate response success
+        assert response.status_code == 200
+        results = response.json()['results']
+        # validate results of each operation
+        assert [result['status'] for result in results] == [201, 201, 400,
+                                                             404]
+        created = [result['pull_request'] for result in results[:2]]
+        assert all(pull_request['status'] == 'open'
+                   for pull_request in created)
+
+        # close both pull requests, the second close of one must fail
+        close = [{'action': 'close', 'id': pull_request['id']}
+                 for pull_request in created]
+        response = requests.post(f'{api_url}/pull-requests/batch',
+                                 json={'operations': close + close[:1]})
+        results = response.json()['results']
+        assert [result['status'] for result in results] == [200, 200, 400]
+        assert results[0]['pull_request']['status'] == 'closed'
+
+    def test_get_events(self, api_url: str, mock_pull_request: dict):
+        """
+        Get /events
+        Test server-sent events
+        - Response must be success with code 200
+        - Response content type must be text/event-stream
+        - A pull-request event must be sent when a pull request is created
+        """
+        response = requests.get(f'{api_url}/events', stream=True, timeout=10)
+        # validate success response
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith(
+            'text/event-stream')
+
+        post_response = requests.post(f'{api_url}/pull-requests',
+                                      mock_pull_request)
+        # validate resource created
+        assert post_response.status_code == 201
+
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: ') and event == 'pull-request':
+                pull_request = json.loads(line[len('data: '):])
+                if pull_request['id'] == post_response.json()['id']:
+                    break
+        response.close()
+        # validate the event is the pull request created
+        assert pull_request['status'] == 'open'
+
+    def test_get_metrics(self, api_url: str):
+        """
+        Get /metrics
+        - Response must be success with code 200
+        - Response must be in Prometheus text format
+        - Latency of a request served before must be reported
+        """
+        requests.get(f'{api_url}/branches')
+        response = requests.get(f'{api_url}/metrics')
+        # validate success response
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('text/plain')
+        # validate the branches request was measured
+        assert ('http_request_duration_seconds_count{endpoint="branches",'
+                'method="GET",status="200"}') in response.text
+
+    def test_get_profiles_forbidden(self, api_url: str):
+        """
+        Get /admin/profiles without the admin token
+        - Response must be forbidden with code 403
+        - Response must be dict with message
+        """
+        response = requests.get(f'{api_url}/admin/profiles')
+        # validate forbidden response
+        assert response.status_code == 403
+        # validate error message
+        assert 'message' in response.json()